@@ -1,3 +1,11 @@
 from .servicesDefs import GRIDS, SOURCES
 from .mapservice import MapService, TileMatrix, BBoxRequest, BBoxRequestMZ
+from .tilestore import TileStore, TileWriter
 from .gpkg import GeoPackage
+from .coverage import Coverage, coverageReport, formatCoverageReport
+from .mbtiles import MBTiles
+from .rawstore import RawTileStore
+from .transfer import copyTiles, convertToRaw, openTileStore
+from .transport import Transport, PooledTransport, UrllibTransport
+from .scheduler import TileScheduler
+from .tilecache import TileCache
@@ -0,0 +1,124 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import logging
+log = logging.getLogger(__name__)
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncSeeder():
+	'''
+	Asyncio based alternative to the thread-per-worker seeding loop of MapService.seedTiles()
+
+	A fixed number of worker coroutines pull jobs from a TileScheduler, so at most `concurrency` tiles are
+	fetched at the same time, in the scheduler priority order. Blocking work (http requests, tile reprojection, sqlite writes) runs
+	in executors. Fetched tiles go through a bounded queue to a single cache writer coroutine : when
+	the writer lags behind, workers wait on the full queue instead of piling tiles up in memory.
+	Cancellation is cooperative : once MapService.stop() is called or the scheduler is cancelled, workers
+	do not start any new job, tiles already in flight are completed and written to the cache.
+	'''
+
+	def __init__(self, srv, laykey, writer, toDstGrid=True, concurrency=10, buffSize=5000, batchSize=500, cpt=True, validators=None):
+		self.srv = srv
+		self.laykey = laykey
+		self.writer = writer #a TileWriter, flushing and closing it is left to the caller
+		self.toDstGrid = toDstGrid
+		self.concurrency = concurrency
+		self.buffSize = buffSize
+		self.batchSize = min(batchSize, buffSize)
+		self.cpt = cpt
+		self.validators = validators or {} #{(x,y,z) : (etag, last_modified)} of the expired tiles to revalidate
+
+	def run(self, scheduler):
+		'''Seed the cache with the tiles queued in a TileScheduler, block until done or cancelled'''
+		#use a private event loop so this works from any thread, including ones started by Blender
+		loop = asyncio.new_event_loop()
+		try:
+			loop.run_until_complete(self._seed(scheduler))
+		finally:
+			loop.close()
+
+	async def _seed(self, jobs):
+		results = asyncio.Queue(maxsize=self.buffSize)
+
+		with ThreadPoolExecutor(max_workers=self.concurrency) as downloader, \
+			ThreadPoolExecutor(max_workers=1) as writer:
+			workers = [asyncio.ensure_future(self._download(jobs, results, downloader)) for i in range(self.concurrency)]
+			cacheWriter = asyncio.ensure_future(self._write(results, writer))
+
+			def writerDone(future):
+				#if the cache writer fails, stop the workers and free the ones blocked on the full queue
+				if not future.cancelled() and future.exception() is not None:
+					for worker in workers:
+						worker.cancel()
+					while not results.empty():
+						results.get_nowait()
+			cacheWriter.add_done_callback(writerDone)
+
+			try:
+				await asyncio.gather(*workers)
+			except asyncio.CancelledError:
+				if not cacheWriter.done():
+					raise
+			finally:
+				for worker in workers:
+					worker.cancel()
+				if not cacheWriter.done():
+					await results.put(None) #sentinel, no more tiles will come
+				await cacheWriter #re-raise the cache writer error
+
+	async def _download(self, jobs, results, executor):
+		loop = asyncio.get_running_loop()
+		while self.srv.running:
+			tile = jobs.get()
+			if tile is None:
+				break
+			col, row, zoom = tile
+			try:
+				record = await loop.run_in_executor(executor, self.srv.tileRecord, self.laykey, col, row, zoom, self.toDstGrid, self.validators.get(tile))
+			except Exception as e:
+				log.error('Unable to get tile x{} y{} z{}'.format(col, row, zoom), exc_info=True)
+				record = None
+			finally:
+				jobs.done(tile)
+			if record is not None:
+				await results.put(record) #wait here if the cache writer lags behind
+			if self.cpt:
+				self.srv.cptTiles += 1
+
+	async def _write(self, results, executor):
+		loop = asyncio.get_running_loop()
+		done = False
+		while not done:
+			batch = []
+			tile = await results.get()
+			#grab what is already available without waiting, up to the batch size
+			while True:
+				if tile is None:
+					done = True
+					break
+				batch.append(tile)
+				if len(batch) >= self.batchSize or results.empty():
+					break
+				tile = results.get_nowait()
+			if batch:
+				await loop.run_in_executor(executor, self.writer.putTiles, batch)
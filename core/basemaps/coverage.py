@@ -0,0 +1,203 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import logging
+log = logging.getLogger(__name__)
+
+import bisect
+from array import array
+
+
+#Runs are flat sorted lists of column intervals [start0, stop0, start1, stop1, ...], stop excluded.
+#A column is covered when bisect_right(runs, col) is odd.
+
+def toRuns(cols):
+	'''Run-length encode an iterable of columns'''
+	runs = []
+	for col in sorted(set(cols)):
+		if runs and runs[-1] == col:
+			runs[-1] = col + 1
+		else:
+			runs.extend((col, col + 1))
+	return runs
+
+def unionRuns(a, b):
+	intervals = sorted(zip(a[0::2] + b[0::2], a[1::2] + b[1::2]))
+	runs = []
+	for start, stop in intervals:
+		if runs and start <= runs[-1]:
+			runs[-1] = max(runs[-1], stop)
+		else:
+			runs.extend((start, stop))
+	return runs
+
+def subtractRuns(a, b):
+	runs = []
+	for start, stop in zip(a[0::2], a[1::2]):
+		#intervals of b overlapping [start, stop)
+		i = bisect.bisect_right(b, start)
+		if i % 2:
+			i -= 1
+		for bstart, bstop in zip(b[i::2], b[i+1::2]):
+			if bstart >= stop:
+				break
+			if bstart > start:
+				runs.extend((start, bstart))
+			start = max(start, bstop)
+		if start < stop:
+			runs.extend((start, stop))
+	return runs
+
+def runsContain(runs, col):
+	return bisect.bisect_right(runs, col) % 2 == 1
+
+def countRuns(runs, start=None, stop=None):
+	'''Number of columns covered by the runs, optionally only between start and stop (excluded)'''
+	if start is not None:
+		runs = subtractRuns(runs, subtractRuns(runs, [start, stop]))
+	return sum(runs[1::2]) - sum(runs[0::2])
+
+
+class Coverage():
+	'''
+	Coverage index of the tiles stored in a cache : one run-length encoded bitmap of columns per zoom level and row
+
+	Rows also keep the julian day of their oldest tile, so tiles of a row can be known to be fresh without
+	reading their timestamps. The index is persisted by its GeoPackage and tagged with the database
+	version it matches (see GeoPackage.getCoverage), reading it never requires any database query.
+	'''
+
+	def __init__(self):
+		self.rows = {} #{(z, row) : runs}
+		self.oldest = {} #{(z, row) : julian day of the oldest tile of the row}
+		self.version = None
+
+	def __len__(self):
+		'''Number of indexed tiles'''
+		return sum(countRuns(runs) for runs in self.rows.values())
+
+	@staticmethod
+	def encode(runs):
+		return array('q', runs).tobytes()
+
+	@staticmethod
+	def decode(blob):
+		runs = array('q')
+		runs.frombytes(blob)
+		return runs.tolist()
+
+	@staticmethod
+	def groupByRow(tiles):
+		rows = {}
+		for x, y, z in tiles:
+			rows.setdefault((z, y), []).append(x)
+		return rows
+
+	def add(self, tiles, jd):
+		'''Index tiles [(x,y,z)] stored at julian day jd, return the updated rows keys'''
+		rows = self.groupByRow(tiles)
+		for k, cols in rows.items():
+			self.rows[k] = unionRuns(self.rows.get(k, []), toRuns(cols))
+			self.oldest[k] = min(self.oldest.get(k, jd), jd)
+		return rows.keys()
+
+	def remove(self, tiles):
+		'''Remove tiles [(x,y,z)] from the index, return the updated rows keys'''
+		rows = self.groupByRow(tiles)
+		for k, cols in rows.items():
+			runs = subtractRuns(self.rows.get(k, []), toRuns(cols))
+			if runs:
+				self.rows[k] = runs
+			else:
+				self.rows.pop(k, None)
+				self.oldest.pop(k, None)
+		return rows.keys()
+
+	def missing(self, tiles, expired):
+		'''
+		Split the requested tiles [(x,y,z)] in a set of tiles not indexed, and a list of indexed tiles
+		of rows holding tiles older than the expired julian day, whose freshness must be checked in the database
+		'''
+		missing, check = set(), []
+		rows, oldest = self.rows, self.oldest
+		for tile in tiles:
+			x, y, z = tile
+			k = (z, y)
+			runs = rows.get(k)
+			if runs is None or bisect.bisect_right(runs, x) % 2 == 0:
+				missing.add(tile)
+			elif oldest[k] <= expired:
+				check.append(tile)
+		return missing, check
+
+	def bounds(self, z):
+		'''(colMin, rowMin, colMax, rowMax) of the tiles indexed at a zoom level, None if there is none'''
+		keys = [k for k in self.rows if k[0] == z]
+		if not keys:
+			return None
+		rows = [k[1] for k in keys]
+		return min(self.rows[k][0] for k in keys), min(rows), max(self.rows[k][-1] for k in keys) - 1, max(rows)
+
+	def zooms(self):
+		return sorted(set(k[0] for k in self.rows))
+
+
+def coverageReport(gpkg, bbox=None, zooms=None):
+	'''
+	Offline coverage report of a GeoPackage cache, nothing is downloaded
+	bbox : optional extent (xmin, ymin, xmax, ymax) in the cache crs, the coverage ratio of this extent is computed
+	zooms : zoom levels to report, default to the ones holding tiles
+	return a list of dict, one per zoom level : zoom, tiles, rows, runs, bounds (in tiles numbers)
+	and if a bbox is submited, expected (number of tiles of the bbox), covered and ratio
+	'''
+	coverage = gpkg.getCoverage()
+	if zooms is None:
+		zooms = coverage.zooms()
+	report = []
+	for z in zooms:
+		keys = [k for k in coverage.rows if k[0] == z]
+		entry = {
+			'zoom': z,
+			'tiles': sum(countRuns(coverage.rows[k]) for k in keys),
+			'rows': len(keys),
+			'runs': sum(len(coverage.rows[k]) // 2 for k in keys),
+			'bounds': coverage.bounds(z)
+		}
+		if bbox is not None:
+			rq = gpkg.tm.bboxRequest(bbox, z)
+			cols = rq.cols
+			entry['expected'] = rq.nbTiles
+			entry['covered'] = sum(countRuns(coverage.rows.get((z, row), []), cols[0], cols[-1] + 1) for row in rq.rows)
+			entry['ratio'] = entry['covered'] / entry['expected'] if entry['expected'] else 1
+		report.append(entry)
+	return report
+
+
+def formatCoverageReport(report):
+	'''Return a coverage report as a text table'''
+	lines = []
+	for entry in report:
+		line = 'z{zoom:<3} {tiles:>10} tiles {rows:>7} rows {runs:>8} runs'.format(**entry)
+		if entry['bounds'] is not None:
+			line += '   cols {0}-{2} rows {1}-{3}'.format(*entry['bounds'])
+		if 'ratio' in entry:
+			line += '   {covered}/{expected} ({ratio:.1%}) of the extent'.format(**entry)
+		lines.append(line)
+	return '\n'.join(lines)
@@ -22,8 +22,11 @@ log = logging.getLogger(__name__)
 import os
 import io
 import math
-import datetime
 import sqlite3
+import threading
+
+from .tilestore import TileStore, TileWriter, MISSING, NOT_MODIFIED, tileHash
+from .coverage import Coverage, toRuns
 
 
 #http://www.geopackage.org/spec/#tiles
@@ -34,23 +37,80 @@ import sqlite3
 #table_name refer to the name of the table witch contains tiles data
 #here for simplification, table_name will always be named "gpkg_tiles"
 
-class GeoPackage():
+#Besides the GeoPackage tables, the cache records in "missing_tiles" the tiles the server
+#cannot deliver (404, empty or invalid data) so they are not requested again until they expire.
+
+#With the deduplicated layout, tiles data are stored once in "tile_blobs" keyed by a content hash,
+#gpkg_tiles rows reference their blob with blob_id and hold an empty tile_data. Both layouts can be
+#mixed in a same cache, reading queries always resolve the blob of a tile.
+
+#The tiles stored are also indexed in "tile_coverage" as run-length encoded rows (see Coverage) so
+#missing tiles are listed without querying gpkg_tiles. Triggers increment a version in "tile_coverage_state"
+#on each change of gpkg_tiles, a change not made through writeTiles (another application, copyTiles...)
+#is detected by comparing it to the version the coverage table was saved for, and the index is rebuilt.
+#Each saved row is tagged with the version it was saved for and emptied rows are kept with no runs, so when
+#another process wrote tiles an index loaded in memory only reloads the rows saved since its own version,
+#unless the whole table was saved again since (rebuilt_version).
+
+#Timestamps are stored in local time (default of the last_modified columns), so every expiry check compares
+#them to julianday('now','localtime'), whether it is answered by a query or by the coverage index.
+
+#Hot queries, kept as module constants so the statement cache of each pooled connection reuses them already prepared
+GET_TILE_QUERY = "SELECT COALESCE(b.tile_data, t.tile_data) FROM gpkg_tiles t LEFT JOIN tile_blobs b ON b.id = t.blob_id " \
+				"WHERE t.zoom_level=? AND t.tile_column=? AND t.tile_row=? " \
+				"AND julianday('now','localtime') - julianday(t.last_modified) < ?"
+#Existence check of the tiles loaded in request_tiles, answered from the covering index without reading tiles data
+EXISTING_TILES_QUERY = "SELECT t.tile_column, t.tile_row, t.zoom_level FROM request_tiles r " \
+				"JOIN gpkg_tiles t INDEXED BY gpkg_tiles_zxy_modified " \
+				"ON t.zoom_level = r.zoom_level AND t.tile_column = r.tile_column AND t.tile_row = r.tile_row " \
+				"WHERE julianday('now','localtime') - julianday(t.last_modified) < ?"
+PUT_TILE_QUERY = """INSERT OR REPLACE INTO gpkg_tiles
+		(tile_column, tile_row, zoom_level, tile_data, etag, http_last_modified) VALUES (?,?,?,?,?,?)"""
+PUT_BLOB_QUERY = "INSERT OR IGNORE INTO tile_blobs (hash, tile_data) VALUES (?,?)"
+PUT_DEDUP_TILE_QUERY = """INSERT OR REPLACE INTO gpkg_tiles
+		(tile_column, tile_row, zoom_level, tile_data, blob_id, etag, http_last_modified)
+		VALUES (?,?,?,x'',(SELECT id FROM tile_blobs WHERE hash=?),?,?)"""
+
+
+class GeoPackage(TileStore):
+
+	TABLE = 'gpkg_tiles'
 
 	MAX_DAYS = 90
+	MISSING_MAX_DAYS = 1 #lifetime of negative cache entries
+
+	#Size quota in bytes, None for unlimited. When exceeded, least recently used tiles are evicted
+	#until the database size falls below LOW_WATER * MAX_SIZE (see evict)
+	MAX_SIZE = None
+	LOW_WATER = 0.8
+
+	#Reading tiles only record their access time in memory, it is written by batches of this size
+	ACCESS_FLUSH_SIZE = 1000
+
+	#Upper bounds in days of the tiles age histogram returned by stats()
+	AGE_BINS = (1, 7, 30, 90, 365)
+
+	#Store identical tiles only once, see the deduplicated layout above
+	DEDUP = False
+
+	def __init__(self, path, tm, maxSize=None, dedup=None):
+		TileStore.__init__(self, path, tm)
+		if maxSize is not None:
+			self.MAX_SIZE = maxSize
+		if dedup is not None:
+			self.DEDUP = dedup
 
-	def __init__(self, path, tm):
-		self.dbPath = path
-		self.name = os.path.splitext(os.path.basename(path))[0]
+		#Tiles read since the last access time update {(z,x,y)}, see flushAccess()
+		self.accessed = set()
+		self.accessLock = threading.Lock()
+		self.compactLock = threading.Lock()
 
-		#Get props from TileMatrix object
-		self.auth, self.code = tm.CRS.split(':')
-		self.code = int(self.code)
-		self.tileSize = tm.tileSize
-		self.xmin, self.ymin, self.xmax, self.ymax = tm.globalbbox
-		self.resolutions = tm.getResList()
+		#In memory coverage index, loaded on first use, see getCoverage()
+		self.coverage = None
+		self.coverageLock = threading.Lock()
 
-		if not self.isGPKG():
-			self.create()
+		#create() returns False if another process created the schema in the meantime
+		if not self.isGPKG() and self.create():
 			self.insertMetadata()
 
 			self.insertCRS(self.code, str(self.code), self.auth)
@@ -59,6 +119,15 @@ class GeoPackage():
 
 			self.insertTileMatrixSet()
 
+		else:
+			self.upgrade()
+
+	def close(self):
+		"""Close the pooled connections, a later request will open new ones"""
+		if not getattr(self, 'pool', None):
+			return
+		self.flushAccess()
+		TileStore.close(self)
 
 	def isGPKG(self):
 		if not os.path.exists(self.dbPath):
@@ -87,13 +156,24 @@ class GeoPackage():
 
 
 	def create(self):
-		"""Create default geopackage schema on the database."""
-		db = sqlite3.connect(self.dbPath) #this attempt will create a new file if not exist
+		"""Create default geopackage schema on the database, return False if it already exists"""
+		#this attempt will create a new file if not exist, the schema is created in a single transaction
+		db = sqlite3.connect(self.dbPath, timeout=self.BUSY_TIMEOUT, isolation_level=None)
 		cursor = db.cursor()
 
+		# Free pages can be given back to the file system after an eviction, must be set before anything is written
+		cursor.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+
 		# Add GeoPackage version 1.0 ("GP10" in ASCII) to the Sqlite header
 		cursor.execute("PRAGMA application_id = 1196437808;")
 
+		#several processes sharing a cache folder can open a new layer cache at the same time
+		cursor.execute("BEGIN IMMEDIATE;")
+		if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'gpkg_contents'").fetchone() is not None:
+			db.rollback()
+			db.close()
+			return False
+
 		cursor.execute("""
 			CREATE TABLE gpkg_contents (
 				table_name TEXT NOT NULL PRIMARY KEY,
@@ -158,9 +238,117 @@ class GeoPackage():
 				tile_row INTEGER NOT NULL,
 				tile_data BLOB NOT NULL,
 				last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
+				etag TEXT,
+				http_last_modified TEXT,
+				last_access TIMESTAMP,
+				blob_id INTEGER,
 				UNIQUE (zoom_level, tile_column, tile_row));
 		""")
 
+		self._createIndex(cursor)
+		self._createAccessIndex(cursor)
+		self._createMissingTable(cursor)
+		self._createBlobsTable(cursor)
+		self._createCoverageTables(cursor)
+
+		db.commit()
+		db.close()
+		return True
+
+
+	def _createIndex(self, cursor):
+		#covering index of tile lookups, existence and expiration can be checked without reading the table rows
+		cursor.execute("""
+			CREATE INDEX IF NOT EXISTS gpkg_tiles_zxy_modified
+				ON gpkg_tiles (zoom_level, tile_column, tile_row, last_modified);
+		""")
+
+	def _createAccessIndex(self, cursor):
+		#eviction order, a tile never read since it was stored is ranked by its storage date
+		cursor.execute("""
+			CREATE INDEX IF NOT EXISTS gpkg_tiles_access
+				ON gpkg_tiles (COALESCE(last_access, last_modified));
+		""")
+
+	def _createMissingTable(self, cursor):
+		cursor.execute("""
+			CREATE TABLE IF NOT EXISTS missing_tiles (
+				zoom_level INTEGER NOT NULL,
+				tile_column INTEGER NOT NULL,
+				tile_row INTEGER NOT NULL,
+				last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
+				PRIMARY KEY (zoom_level, tile_column, tile_row));
+		""")
+
+
+	def _createBlobsTable(self, cursor):
+		cursor.execute("""
+			CREATE TABLE IF NOT EXISTS tile_blobs (
+				id INTEGER PRIMARY KEY,
+				hash BLOB NOT NULL UNIQUE,
+				tile_data BLOB NOT NULL);
+		""")
+		#find the tiles still referencing a blob, only deduplicated tiles are indexed
+		cursor.execute("CREATE INDEX IF NOT EXISTS gpkg_tiles_blob ON gpkg_tiles (blob_id) WHERE blob_id IS NOT NULL;")
+
+
+	def _createCoverageTables(self, cursor):
+		cursor.execute("""
+			CREATE TABLE IF NOT EXISTS tile_coverage (
+				zoom_level INTEGER NOT NULL,
+				tile_row INTEGER NOT NULL,
+				runs BLOB NOT NULL,
+				oldest DOUBLE NOT NULL,
+				version INTEGER NOT NULL DEFAULT 0,
+				PRIMARY KEY (zoom_level, tile_row)) WITHOUT ROWID;
+		""")
+		self._createCoverageVersionIndex(cursor)
+		#coverage_version is the version the tile_coverage table matches, NULL to rebuild it
+		#rebuilt_version is the version the whole table was last saved for
+		cursor.execute("CREATE TABLE IF NOT EXISTS tile_coverage_state (version INTEGER NOT NULL, coverage_version INTEGER, rebuilt_version INTEGER NOT NULL DEFAULT 0);")
+		cursor.execute("INSERT INTO tile_coverage_state SELECT 0, NULL, 0 WHERE NOT EXISTS (SELECT 1 FROM tile_coverage_state);")
+		for name, event in (('insert', 'INSERT'), ('delete', 'DELETE'), ('update', 'UPDATE OF zoom_level, tile_column, tile_row, last_modified')):
+			cursor.execute("""
+				CREATE TRIGGER IF NOT EXISTS gpkg_tiles_version_{} AFTER {} ON gpkg_tiles
+				BEGIN UPDATE tile_coverage_state SET version = version + 1; END;
+			""".format(name, event))
+		#oldest tile of a row, see refreshOldest()
+		cursor.execute("CREATE INDEX IF NOT EXISTS gpkg_tiles_row_modified ON gpkg_tiles (zoom_level, tile_row, last_modified);")
+
+	def _createCoverageVersionIndex(self, cursor):
+		#rows saved since a version, see _readCoverage()
+		cursor.execute("CREATE INDEX IF NOT EXISTS tile_coverage_version ON tile_coverage (version);")
+
+
+	def upgrade(self):
+		"""Add the columns, indexes and tables missing in a cache created by a previous version"""
+		db = sqlite3.connect(self.dbPath)
+		columns = [row[1] for row in db.execute('PRAGMA table_info(gpkg_tiles)')]
+		tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index', 'trigger')")]
+		with db:
+			if 'etag' not in columns:
+				db.execute('ALTER TABLE gpkg_tiles ADD COLUMN etag TEXT')
+			if 'http_last_modified' not in columns:
+				db.execute('ALTER TABLE gpkg_tiles ADD COLUMN http_last_modified TEXT')
+			if 'last_access' not in columns:
+				db.execute('ALTER TABLE gpkg_tiles ADD COLUMN last_access TIMESTAMP')
+			if 'blob_id' not in columns:
+				db.execute('ALTER TABLE gpkg_tiles ADD COLUMN blob_id INTEGER')
+			if 'gpkg_tiles_access' not in tables:
+				self._createAccessIndex(db)
+			if 'gpkg_tiles_zxy_modified' not in tables:
+				self._createIndex(db)
+			if 'missing_tiles' not in tables:
+				self._createMissingTable(db)
+			if 'tile_blobs' not in tables:
+				self._createBlobsTable(db)
+			if 'tile_coverage' not in tables:
+				self._createCoverageTables(db)
+			elif 'tile_coverage_version' not in tables:
+				db.execute('ALTER TABLE tile_coverage ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+				db.execute('ALTER TABLE tile_coverage_state ADD COLUMN rebuilt_version INTEGER NOT NULL DEFAULT 0')
+				db.execute('UPDATE tile_coverage_state SET rebuilt_version = version')
+				self._createCoverageVersionIndex(db)
 		db.close()
 
 
@@ -221,101 +409,426 @@ class GeoPackage():
 		db.close()
 
 
-	def hasTile(self, x, y, z):
-		if self.getTile(x ,y, z) is not None:
-			return True
-		else:
-			return False
-
 	def getTile(self, x, y, z):
 		'''return tilde_data if tile exists otherwie return None'''
-		#connect with detect_types parameter for automatically convert date to Python object
-		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
-		query = 'SELECT tile_data, last_modified FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
-		result = db.execute(query, (z, x, y)).fetchone()
-		db.close()
+		#expiration is checked by sqlite, this avoid parsing the timestamp with PARSE_DECLTYPES
+		with self.connection() as db:
+			result = db.execute(GET_TILE_QUERY, (z, x, y, self.MAX_DAYS)).fetchone()
 		if result is None:
 			return None
-		timeDelta = datetime.datetime.now() - result[1]
-		if timeDelta.days > self.MAX_DAYS:
-			return None
+		self.recordAccess([(x, y, z)])
 		return result[0]
 
-	def putTile(self, x, y, z, data):
-		db = sqlite3.connect(self.dbPath)
-		query = """INSERT OR REPLACE INTO gpkg_tiles
-		(tile_column, tile_row, zoom_level, tile_data) VALUES (?,?,?,?)"""
-		db.execute(query, (x, y, z, data))
-		db.commit()
-		db.close()
-
 
 	def listExistingTiles(self, tiles):
 		"""
 		input : tiles list [(x,y,z)]
 		output : tiles list set [(x,y,z)] of existing records in cache db"""
 
-		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
-
-		# split out the axises
-		x, y, z = zip(*tiles)
-
-		query = "SELECT tile_column, tile_row, zoom_level FROM gpkg_tiles " \
-				"WHERE julianday() - julianday(last_modified) < ?" \
-				"AND zoom_level BETWEEN ? AND ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"
+		if not tiles:
+			return set()
 
-		result = db.execute(
-			query,
-			(
-				GeoPackage.MAX_DAYS,
-				min(z), max(z),
-				min(x), max(x),
-				min(y), max(y)
-			)
-		).fetchall()
-
-		db.close()
+		with self.connection() as db:
+			self.loadRequest(db, tiles)
+			result = db.execute(EXISTING_TILES_QUERY, (GeoPackage.MAX_DAYS,)).fetchall()
 
 		return set(result)
 
 	def listMissingTiles(self, tiles):
-		existing = self.listExistingTiles(tiles)
-		return set(tiles) - existing # difference
+		"""
+		input : tiles list [(x,y,z)]
+		output : tiles list set [(x,y,z)] of the tiles not in cache db or expired
+		Answered from the coverage index, tiles timestamps are only read for the rows holding old tiles"""
+
+		if not tiles:
+			return set()
+		coverage, now = self._currentCoverage()
+		expired = now - self.MAX_DAYS
+		with self.coverageLock:
+			missing, check = coverage.missing(tiles, expired)
+		if check:
+			#the oldest tile of these rows may have been replaced since, look for the current one
+			self.refreshOldest(coverage, set((z, y) for x, y, z in check))
+			with self.coverageLock:
+				stale, check = coverage.missing(check, expired)
+			missing.update(stale)
+		if check:
+			missing.update(set(check) - self.listExistingTiles(check))
+		return missing
+
+	def getCoverage(self):
+		'''Return the coverage index (see Coverage) of the tiles stored in this cache'''
+		return self._currentCoverage()[0]
+
+	def _currentCoverage(self):
+		"""Return the coverage index matching the database and the current julian day, an index rebuilt from the tiles is saved"""
+		with self.connection() as db:
+			with self.coverageLock:
+				coverage, rebuilt, now = self._readCoverage(db)
+				if rebuilt:
+					snapshot = Coverage()
+					snapshot.rows, snapshot.oldest, snapshot.version = dict(coverage.rows), dict(coverage.oldest), coverage.version
+			if rebuilt:
+				try:
+					with db:
+						db.execute('BEGIN IMMEDIATE')
+						#only if no other writer changed the tiles in the meantime
+						if db.execute('SELECT version FROM tile_coverage_state').fetchone()[0] == snapshot.version:
+							self._saveCoverage(db, snapshot)
+				except sqlite3.Error as e:
+					log.warning('Unable to save the coverage index of cache {} : {}'.format(self.name, e))
+		return coverage, now
+
+	def _readCoverage(self, db):
+		"""
+		Return (coverage, rebuilt, now) : the coverage index matching the state of the database seen by this connection,
+		updated with the rows saved since it was loaded or rebuilt if the tiles changed, and the current julian day.
+		A rebuilt index must be saved with _saveCoverage(). Call it with the coverage lock held.
+		"""
+		version, coverageVersion, rebuiltVersion, now = db.execute("SELECT version, coverage_version, rebuilt_version, "
+			"julianday('now','localtime') FROM tile_coverage_state").fetchone()
+		if self.coverage is not None and self.coverage.version == version:
+			return self.coverage, False, now
+		if coverageVersion == version:
+			if self.coverage is not None and rebuiltVersion <= self.coverage.version < version:
+				#only the rows saved since, emptied rows included
+				coverage = self.coverage
+				query = 'SELECT zoom_level, tile_row, runs, oldest FROM tile_coverage WHERE version > ?', (coverage.version,)
+			else:
+				coverage = Coverage()
+				query = 'SELECT zoom_level, tile_row, runs, oldest FROM tile_coverage', ()
+			for z, row, runs, oldest in db.execute(*query):
+				if runs:
+					coverage.rows[(z, row)] = Coverage.decode(runs)
+					coverage.oldest[(z, row)] = oldest
+				else:
+					coverage.rows.pop((z, row), None)
+					coverage.oldest.pop((z, row), None)
+			coverage.version = version
+			rebuilt = False
+		else:
+			log.debug('Build coverage index of cache {}'.format(self.name))
+			coverage = Coverage()
+			coverage.version = version
+			cols = {}
+			for z, row, col, jd in db.execute('SELECT zoom_level, tile_row, tile_column, julianday(last_modified) FROM gpkg_tiles'):
+				k = (z, row)
+				cols.setdefault(k, []).append(col)
+				coverage.oldest[k] = min(coverage.oldest.get(k, jd), jd)
+			coverage.rows = {k: toRuns(c) for k, c in cols.items()}
+			rebuilt = True
+		self.coverage = coverage
+		return coverage, rebuilt, now
+
+	@staticmethod
+	def _saveCoverage(db, coverage, keys=None):
+		"""
+		Write the rows of the coverage index, all of them or only the submited keys, in the pending transaction.
+		Rows are tagged with the saved version, emptied rows are kept with no runs so other processes see them changed.
+		"""
+		version = db.execute('SELECT version FROM tile_coverage_state').fetchone()[0]
+		if keys is None:
+			db.execute('DELETE FROM tile_coverage')
+			db.execute('UPDATE tile_coverage_state SET rebuilt_version = version')
+			keys = coverage.rows.keys()
+		db.executemany('INSERT OR REPLACE INTO tile_coverage (zoom_level, tile_row, runs, oldest, version) VALUES (?,?,?,?,?)',
+			[(z, row, Coverage.encode(coverage.rows[(z, row)]), coverage.oldest[(z, row)], version) if (z, row) in coverage.rows
+			else (z, row, b'', 0, version) for z, row in keys])
+		db.execute('UPDATE tile_coverage_state SET coverage_version = version')
+		coverage.version = version
+
+	def _beginCoverageUpdate(self, db):
+		"""
+		Start a write transaction and return (coverage, rebuilt, now) before changing gpkg_tiles, the changes
+		are then applied to the index and saved with _saveCoverage(). Call it with the coverage lock held.
+		"""
+		#a first write takes the database lock, so the state read matches the one the changes apply to
+		db.execute('UPDATE tile_coverage_state SET version = version')
+		return self._readCoverage(db)
+
+	def refreshOldest(self, coverage, keys):
+		"""Update the julian day of the oldest tile of some coverage rows {(z, row)}"""
+		with self.connection() as db:
+			oldest = {k: db.execute('SELECT julianday(min(last_modified)) FROM gpkg_tiles WHERE zoom_level=? AND tile_row=?', k).fetchone()[0] for k in keys}
+		with self.coverageLock:
+			for k, jd in oldest.items():
+				if jd is not None and k in coverage.oldest:
+					coverage.oldest[k] = jd
+
+	def listMissingMarkers(self, tiles):
+		"""
+		input : tiles list [(x,y,z)]
+		output : tiles list set [(x,y,z)] recently marked as not available on the server"""
+
+		if not tiles:
+			return set()
+		query = "SELECT m.tile_column, m.tile_row, m.zoom_level FROM request_tiles r JOIN missing_tiles m " \
+				"ON m.zoom_level = r.zoom_level AND m.tile_column = r.tile_column AND m.tile_row = r.tile_row " \
+				"WHERE julianday('now','localtime') - julianday(m.last_modified) < ?"
+		with self.connection() as db:
+			self.loadRequest(db, tiles)
+			result = db.execute(query, (GeoPackage.MISSING_MAX_DAYS,)).fetchall()
+		return set(result)
 
+	def listTilesToFetch(self, tiles):
+		"""Return the tiles to request : missing or expired, except those with a valid negative entry"""
+		missing = self.listMissingTiles(tiles)
+		if not missing:
+			return missing
+		return missing - self.listMissingMarkers(missing)
 
-	def getTiles(self, tiles):
-		"""tiles = list of (x,y,z) tuple
-		return list of (x,y,z,data) tuple"""
+	def getValidators(self, tiles):
+		"""
+		input : tiles list [(x,y,z)]
+		output : {(x,y,z) : (etag, last_modified)} http validators of the cached (and possibly expired) tiles"""
+		if not tiles:
+			return {}
+		query = "SELECT t.tile_column, t.tile_row, t.zoom_level, t.etag, t.http_last_modified FROM request_tiles r JOIN gpkg_tiles t " \
+				"ON t.zoom_level = r.zoom_level AND t.tile_column = r.tile_column AND t.tile_row = r.tile_row " \
+				"WHERE t.etag IS NOT NULL OR t.http_last_modified IS NOT NULL"
+		with self.connection() as db:
+			self.loadRequest(db, tiles)
+			result = db.execute(query).fetchall()
+		return {(x, y, z):(etag, modified) for x, y, z, etag, modified in result}
 
-		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
 
-		# split out the axises
-		x, y, z = zip(*tiles)
+	def getTiles(self, tiles):
+		"""tiles = list of (x,y,z) tuple
+		return list of (x,y,z,data) tuple of the tiles available in cache, in the same order as requested"""
 
-		query = "SELECT tile_column, tile_row, zoom_level, tile_data FROM gpkg_tiles " \
-				"WHERE julianday() - julianday(last_modified) < ?" \
-				"AND zoom_level BETWEEN ? AND ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"
+		if not tiles:
+			return []
 
-		result = db.execute(
-			query,
-			(
-				GeoPackage.MAX_DAYS,
-				min(z), max(z),
-				min(x), max(x),
-				min(y), max(y)
-			)
-		).fetchall()
+		query = "SELECT t.tile_column, t.tile_row, t.zoom_level, COALESCE(b.tile_data, t.tile_data) FROM request_tiles r JOIN gpkg_tiles t " \
+				"ON t.zoom_level = r.zoom_level AND t.tile_column = r.tile_column AND t.tile_row = r.tile_row " \
+				"LEFT JOIN tile_blobs b ON b.id = t.blob_id " \
+				"WHERE julianday('now','localtime') - julianday(t.last_modified) < ? ORDER BY r.idx"
 
-		db.close()
+		with self.connection() as db:
+			self.loadRequest(db, tiles)
+			result = db.execute(query, (GeoPackage.MAX_DAYS,)).fetchall()
 
+		self.recordAccess(result)
 		return result
 
 
-	def putTiles(self, tiles):
-		"""tiles = list of (x,y,z,data) tuple"""
-		db = sqlite3.connect(self.dbPath)
-		query = """INSERT OR REPLACE INTO gpkg_tiles
-		(tile_column, tile_row, zoom_level, tile_data) VALUES (?,?,?,?)"""
-		db.executemany(query, tiles)
-		db.commit()
-		db.close()
+	def writeTiles(self, db, tiles):
+		'''Insert tiles and markers with an opened connection, the transaction is left to the caller'''
+		found, missing, notModified = [], [], []
+		for tile in tiles:
+			x, y, z, data = tile[:4]
+			if data is MISSING:
+				missing.append( (z, x, y) )
+			elif data is NOT_MODIFIED:
+				notModified.append( (z, x, y) )
+			else:
+				etag, modified = tile[4:6] if len(tile) > 4 else (None, None)
+				found.append( (x, y, z, data, etag, modified) )
+		if found or notModified:
+			with self.coverageLock:
+				coverage, rebuilt, now = self._beginCoverageUpdate(db)
+				try:
+					self._writeTiles(db, found, notModified)
+					keys = coverage.add([t[:3] for t in found], now)
+					self._saveCoverage(db, coverage, None if rebuilt else keys)
+				except Exception:
+					#the transaction will be rolled back, the index is reloaded by the next request
+					self.coverage = None
+					raise
+		if missing:
+			db.executemany("""INSERT OR REPLACE INTO missing_tiles
+			(zoom_level, tile_column, tile_row) VALUES (?,?,?)""", missing)
+
+	def _writeTiles(self, db, found, notModified):
+		if found and self.DEDUP:
+			hashes = [tileHash(t[3]) for t in found]
+			db.executemany(PUT_BLOB_QUERY, zip(hashes, (t[3] for t in found)))
+			db.executemany(PUT_DEDUP_TILE_QUERY, ((x, y, z, h, etag, modified) for (x, y, z, data, etag, modified), h in zip(found, hashes)))
+		elif found:
+			db.executemany(PUT_TILE_QUERY, found)
+		if found:
+			db.executemany("DELETE FROM missing_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", [(t[2], t[0], t[1]) for t in found])
+		if notModified:
+			db.executemany("""UPDATE gpkg_tiles SET last_modified=datetime('now','localtime')
+			WHERE zoom_level=? AND tile_column=? AND tile_row=?""", notModified)
+
+	def selectTiles(self, schema='main'):
+		return "SELECT t.zoom_level, t.tile_column, t.tile_row, COALESCE(b.tile_data, t.tile_data) AS tile_data, t.id AS rid " \
+			"FROM {0}.gpkg_tiles t LEFT JOIN {0}.tile_blobs b ON b.id = t.blob_id".format(schema)
+
+	def copyStatements(self, source):
+		if not self.DEDUP:
+			return TileStore.copyStatements(self, source)
+		#tile_hash() is registered on the connection by copyTiles()
+		return [
+			"INSERT OR IGNORE INTO main.tile_blobs (hash, tile_data) SELECT tile_hash(tile_data), tile_data FROM ({})".format(source),
+			"INSERT OR REPLACE INTO main.gpkg_tiles (zoom_level, tile_column, tile_row, tile_data, blob_id) " \
+			"SELECT c.zoom_level, c.tile_column, c.tile_row, x'', (SELECT b.id FROM main.tile_blobs b WHERE b.hash = tile_hash(c.tile_data)) " \
+			"FROM ({}) c".format(source)
+		]
+
+	def recordAccess(self, tiles):
+		"""Note the access time of some read tiles [(x,y,z,...)], they are written to the database by batches"""
+		if not tiles:
+			return
+		with self.accessLock:
+			self.accessed.update((t[2], t[0], t[1]) for t in tiles)
+			flush = len(self.accessed) >= self.ACCESS_FLUSH_SIZE
+		if flush:
+			self.flushAccess()
+
+	def flushAccess(self):
+		"""Write the pending access times to the last_access column"""
+		with self.accessLock:
+			accessed, self.accessed = self.accessed, set()
+		if not accessed:
+			return
+		try:
+			with self.connection() as db:
+				with db:
+					db.executemany("""UPDATE gpkg_tiles SET last_access=datetime('now','localtime')
+					WHERE zoom_level=? AND tile_column=? AND tile_row=?""", accessed)
+		except sqlite3.Error as e:
+			#access times are only used to choose the tiles to evict, losing some is not an issue
+			log.warning('Unable to update tiles access time : {}'.format(e))
+
+	def usedSize(self):
+		"""Size in bytes of the database pages in use, free pages not yet given back to the file system are excluded"""
+		with self.connection() as db:
+			pageSize = db.execute('PRAGMA page_size').fetchone()[0]
+			pageCount = db.execute('PRAGMA page_count').fetchone()[0]
+			freePages = db.execute('PRAGMA freelist_count').fetchone()[0]
+		return (pageCount - freePages) * pageSize
+
+	def evict(self, maxSize=None, lowWater=None, batchSize=500):
+		"""
+		Delete least recently used tiles when the database exceeds maxSize bytes (default to MAX_SIZE),
+		until its size falls below lowWater * maxSize. Tiles are deleted by small transactions so concurrent
+		writers are not blocked for long. Return the number of deleted tiles.
+		"""
+		if maxSize is None:
+			maxSize = self.MAX_SIZE
+		if lowWater is None:
+			lowWater = self.LOW_WATER
+		if not maxSize:
+			return 0
+		used = self.usedSize()
+		if used <= maxSize:
+			return 0
+		self.flushAccess()
+		toFree = used - maxSize * lowWater
+		ids, freed = [], 0
+		with self.connection() as db:
+			#a blob shared by several tiles is only freed with its last tile, freed bytes are overestimated
+			cursor = db.execute('SELECT t.id, t.tile_column, t.tile_row, t.zoom_level, COALESCE(length(b.tile_data), length(t.tile_data)) FROM gpkg_tiles t ' \
+				'LEFT JOIN tile_blobs b ON b.id = t.blob_id ORDER BY COALESCE(t.last_access, t.last_modified), t.id')
+			for id, x, y, z, size in cursor:
+				ids.append( (id, (x, y, z)) )
+				freed += size
+				if freed >= toFree:
+					break
+			cursor.close()
+			for i in range(0, len(ids), batchSize):
+				batch = ids[i:i+batchSize]
+				with db:
+					with self.coverageLock:
+						coverage, rebuilt, now = self._beginCoverageUpdate(db)
+						try:
+							db.executemany('DELETE FROM gpkg_tiles WHERE id=?', [(id,) for id, tile in batch])
+							keys = coverage.remove([tile for id, tile in batch])
+							self._saveCoverage(db, coverage, None if rebuilt else keys)
+						except Exception:
+							self.coverage = None
+							raise
+		self.collectBlobs()
+		log.debug('{} tiles evicted from cache {}, {} bytes freed'.format(len(ids), self.name, freed))
+		return len(ids)
+
+	def collectBlobs(self):
+		"""Delete the blobs no longer referenced by any tile (evicted or replaced tiles), return their number"""
+		with self.connection() as db:
+			with db:
+				return db.execute('DELETE FROM tile_blobs WHERE NOT EXISTS ' \
+					'(SELECT 1 FROM gpkg_tiles WHERE blob_id = tile_blobs.id)').rowcount
+
+	def deduplicate(self, batchSize=1000):
+		"""
+		Move the tiles stored inline to the blobs table, identical tiles then share a same blob.
+		Tiles are converted by batches of ids, data are hashed by a sqlite function so they never leave the database.
+		Call vacuum() afterwards to give the freed space back to the file system. Return the number of converted tiles.
+		"""
+		nbTiles = 0
+		with self.connection() as db:
+			db.create_function('tile_hash', 1, tileHash, deterministic=True)
+			lower = -1
+			while True:
+				upper = db.execute('SELECT max(id) FROM (SELECT id FROM gpkg_tiles WHERE id > ? AND blob_id IS NULL ORDER BY id LIMIT ?)', (lower, batchSize)).fetchone()[0]
+				if upper is None:
+					break
+				with db:
+					db.execute('INSERT OR IGNORE INTO tile_blobs (hash, tile_data) SELECT tile_hash(tile_data), tile_data ' \
+						'FROM gpkg_tiles WHERE id > ? AND id <= ? AND blob_id IS NULL', (lower, upper))
+					nbTiles += db.execute("UPDATE gpkg_tiles SET blob_id = (SELECT id FROM tile_blobs WHERE hash = tile_hash(gpkg_tiles.tile_data)), " \
+						"tile_data = x'' WHERE id > ? AND id <= ? AND blob_id IS NULL", (lower, upper)).rowcount
+				lower = upper
+		return nbTiles
+
+	def vacuum(self, step=256):
+		"""
+		Give the free pages back to the file system with an incremental vacuum, by steps of `step` pages.
+		Caches created before incremental vacuum was enabled are converted once with a full vacuum.
+		Return the number of freed pages.
+		"""
+		with self.connection() as db:
+			if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+				freed = db.execute('PRAGMA freelist_count').fetchone()[0]
+				db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+				db.execute('VACUUM')
+				return freed
+			freed = 0
+			while True:
+				free = db.execute('PRAGMA freelist_count').fetchone()[0]
+				if not free:
+					break
+				db.execute('PRAGMA incremental_vacuum({})'.format(min(step, free))).fetchall()
+				freed += min(step, free)
+			db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+		return freed
+
+	def compact(self):
+		"""Evict tiles over the quota then vacuum, return immediately if a compaction is already running"""
+		if not self.compactLock.acquire(blocking=False):
+			return
+		try:
+			if self.evict():
+				self.vacuum()
+		except sqlite3.Error as e:
+			log.error('Cache compaction failed : {}'.format(e))
+		finally:
+			self.compactLock.release()
+
+	def stats(self):
+		"""
+		Return a dict with tiles count, stored tiles data bytes, number of deduplicated blobs,
+		used database size, number of missing tiles and tiles age histogram"""
+		self.flushAccess()
+		bins = ' '.join("WHEN age < {} THEN {}".format(days, days) for days in self.AGE_BINS)
+		with self.connection() as db:
+			nbTiles, nbBytes = db.execute('SELECT count(*), COALESCE(SUM(length(tile_data)), 0) FROM gpkg_tiles').fetchone()
+			nbBlobs, blobsBytes = db.execute('SELECT count(*), COALESCE(SUM(length(tile_data)), 0) FROM tile_blobs').fetchone()
+			nbMissing = db.execute('SELECT count(*) FROM missing_tiles').fetchone()[0]
+			ages = db.execute("SELECT CASE {} ELSE NULL END AS bin, count(*) FROM " \
+				"(SELECT julianday('now','localtime') - julianday(last_modified) AS age FROM gpkg_tiles) GROUP BY bin".format(bins)).fetchall()
+		ages = dict(ages)
+		return {
+			'tiles': nbTiles,
+			'bytes': nbBytes + blobsBytes,
+			'blobs': nbBlobs,
+			'dbSize': self.usedSize(),
+			'missing': nbMissing,
+			'ages': {days: ages.get(days, 0) for days in self.AGE_BINS + (None,)} #{upper bound in days : count}, None for older
+		}
+
+
+#Kept for backward compatibility, the write-behind writer is shared by all the tile stores
+GeoPackageWriter = TileWriter
@@ -25,18 +25,25 @@ import math
 import threading
 import queue
 import time
-import urllib.request
 import imghdr
 import sys, time, os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 #core imports
 from .servicesDefs import GRIDS, SOURCES
-from .gpkg import GeoPackage
-from ..georaster import NpImage, GeoRef, BigTiffWriter
+from .gpkg import GeoPackage, MISSING, NOT_MODIFIED
+from .rawstore import RawTileStore
+from .transport import PooledTransport
+from .asyncseeder import AsyncSeeder
+from .scheduler import TileScheduler
+from .tilecache import TileCache
+from ..georaster import NpImage, GeoRef, BigTiffWriter, GeoTiffWriter
 from ..utils import BBOX
-from ..proj.reproj import reprojPt, reprojBbox, reprojImg
+from ..proj.reproj import getReproj, reprojPt, reprojBbox, reprojImg
 from ..proj.ellps import dd2meters, meters2dd
 from ..proj.srs import SRS
+from ..checkdeps import HAS_GDAL
 
 from .. import settings
 USER_AGENT = settings.user_agent
@@ -348,6 +355,8 @@ class MapService():
 			format >> 'jpeg' or 'png'
 			style
 			zmin & zmax
+			categorical >> optional boolean, flag layers of class values (no averaging when building zoom levels)
+			storage >> optional, 'raw' to cache the tiles decoded (see RawTileStore) instead of compressed in a GeoPackage
 		urlTemplate
 		referer
 
@@ -362,7 +371,35 @@ class MapService():
 	# resampling algo for reprojection
 	RESAMP_ALG = 'BL' #NN:Nearest Neighboor, BL:Bilinear, CB:Cubic, CBS:Cubic Spline, LCZ:Lanczos
 
-	def __init__(self, srckey, cacheFolder, dstGridKey=None):
+	# number of threads used to decode tiles when building a mosaic
+	DECODE_THREADS = min(8, os.cpu_count() or 1)
+
+	# default engine used to seed the cache
+	SEED_ENGINE = 'THREAD' #THREAD: one thread per downloading worker, ASYNC: asyncio scheduler (see AsyncSeeder)
+
+	# when seeding the destination grid, missing tiles are built by blocks of up to DST_BATCH_SIZE x DST_BATCH_SIZE tiles
+	# from a single source mosaic and a single warp (1 to build tiles one by one)
+	DST_BATCH_SIZE = 8
+
+	# bytes budget of the in memory cache of decoded tiles (see TileCache)
+	MEMORY_CACHE_SIZE = 256 * 1024 * 1024
+
+	# also keep downloaded tiles as individual files under cacheFolder/tiles, on top of the GeoPackage
+	TILES_DIR_CACHE = False
+
+	# size quota in bytes of each layer cache database, None for unlimited. When exceeded after seeding,
+	# least recently used tiles are evicted and the database compacted in a background thread
+	CACHE_MAX_SIZE = None
+
+	# store identical tiles only once in the layers caches databases (see GeoPackage deduplicated layout)
+	CACHE_DEDUP = False
+
+	# layers cached as decoded RGBA tiles in a memory mapped file (see RawTileStore), as 'SRCKEY_LAYKEY' strings.
+	# Mosaics of these layers are built without decoding any tile, at the cost of about 256 KB per 256px tile on disk.
+	# A layer definition can also request it with its 'storage' attribute
+	RAW_LAYERS = set()
+
+	def __init__(self, srckey, cacheFolder, dstGridKey=None, transport=None):
 
 
 		#create class attributes from source dictionnary
@@ -391,9 +428,12 @@ class MapService():
 		#Init cache dict
 		self.cacheFolder = cacheFolder
 		self.caches = {}
-		# disk tile cache
+		#decoded tiles in memory, on top of the GeoPackages
+		self.tileCache = TileCache(self.MEMORY_CACHE_SIZE)
+		#optional files tile cache
 		self.tileCacheDir = os.path.join(self.cacheFolder, "tiles")
-		os.makedirs(self.tileCacheDir, exist_ok=True)
+		if self.TILES_DIR_CACHE:
+			os.makedirs(self.tileCacheDir, exist_ok=True)
 
 		#Fake browser header
 		self.headers = {
@@ -406,8 +446,15 @@ class MapService():
 			'User-Agent' : USER_AGENT,
 			'Referer' : self.referer}
 
+		#Http transport shared by all downloading workers, default one keeps connections alive
+		#between requests so each tile does not pay a new TCP/TLS handshake
+		if transport is None:
+			transport = PooledTransport()
+		self.transport = transport
+
 		#Downloading progress
 		self.running = False #flag using to stop getTiles() / getImage() process
+		self.schedulers = set() #TileScheduler of the running seeding tasks
 		self.nbTiles = 0
 		self.cptTiles = 0
 
@@ -416,6 +463,14 @@ class MapService():
 
 		self.lock = threading.RLock()
 
+	def __del__(self):
+		self.close()
+
+	def close(self):
+		'''Close the connections of the tiles caches databases, they will be reopened if the service is used again'''
+		for cache in getattr(self, 'caches', {}).values():
+			cache.close()
+
 	def reportLoop(self):
 		msg = self.report
 		while self.running:
@@ -436,6 +491,32 @@ class MapService():
 	def stop(self):
 		self.running = False
 
+	def cancelPending(self, keep=None):
+		'''
+		Cancel the tiles queued by the running seeding tasks, tiles already in flight are still fetched and cached
+		so the running tasks end as soon as their workers are done with their current tile
+		keep : optional list of tiles [(x,y,z)] still needed, they stay queued
+		'''
+		with self.lock:
+			schedulers = list(self.schedulers)
+		return sum(scheduler.cancel(keep) for scheduler in schedulers)
+
+	def preempt(self, laykey, bbox, zoom, toDstGrid=True, center=None):
+		'''
+		Switch the running seeding tasks to a new request, typically the new view of a map viewer :
+		their queued tiles not covered by the bbox are dropped, the missing tiles of the new request are queued
+		and everything is reordered around the new center. Tiles already in flight are still fetched and cached.
+		bbox and center are in the tile matrix crs selected by toDstGrid
+		'''
+		tm = self.getTM(toDstGrid)
+		with self.lock:
+			schedulers = [scheduler for scheduler in self.schedulers if scheduler.tm is tm]
+		if not schedulers:
+			return
+		missing = self.getCache(laykey, toDstGrid).listTilesToFetch(BBoxRequest(tm, bbox, zoom).tiles)
+		for scheduler in schedulers:
+			scheduler.preempt(missing, center)
+
 	@property
 	def report(self):
 		if self.status == 0:
@@ -473,14 +554,62 @@ class MapService():
 			tm = self.srcTms
 
 		mapKey = self.srckey + '_' + laykey + '_' + grdkey
-		cache = self.caches.get(mapKey)
-		if cache is None:
-			dbPath = os.path.join(self.cacheFolder, mapKey + ".gpkg")
-			self.caches[mapKey] = GeoPackage(dbPath, tm)
-			return self.caches[mapKey]
-		else:
+		with self.lock: #a cache must be opened only once, even if several threads request it
+			cache = self.caches.get(mapKey)
+			if cache is None:
+				if self.layerStorage(laykey) == 'RAW':
+					cache = RawTileStore(os.path.join(self.cacheFolder, mapKey + ".raw"), tm)
+				else:
+					dbPath = os.path.join(self.cacheFolder, mapKey + ".gpkg")
+					cache = GeoPackage(dbPath, tm, maxSize=self.CACHE_MAX_SIZE, dedup=self.CACHE_DEDUP)
+				self.caches[mapKey] = cache
 			return cache
 
+	def layerStorage(self, laykey):
+		'''Return the cache storage of a layer, 'RAW' (decoded tiles) or 'COMPRESSED' (GeoPackage)'''
+		if self.srckey + '_' + laykey in self.RAW_LAYERS:
+			return 'RAW'
+		if getattr(self.layers[laykey], 'storage', '').lower() == 'raw':
+			return 'RAW'
+		return 'COMPRESSED'
+
+	def compactCache(self, cache, background=True):
+		'''Start the eviction and vacuum of a cache database exceeding its size quota, see GeoPackage.compact()'''
+		if not cache.MAX_SIZE or cache.usedSize() <= cache.MAX_SIZE:
+			return
+		if not background:
+			cache.compact()
+			return
+		t = threading.Thread(target=cache.compact)
+		t.daemon = True
+		t.start()
+		return t
+
+	def cacheStats(self):
+		'''
+		Return usage statistics of the caches opened by this service :
+		tiles count, data bytes and age histogram summed over the layers caches, hits ratio of each cache tier,
+		and details per layer cache ('caches') and per tier ('tiers')
+		'''
+		caches = {cache.name: cache.stats() for cache in self.caches.values()}
+		tiers = self.tileCache.stats()
+		hitRatio = {}
+		for tier, counts in tiers.items():
+			total = counts['hits'] + counts['misses']
+			hitRatio[tier] = counts['hits'] / total if total else None
+		ages = {days: 0 for days in GeoPackage.AGE_BINS + (None,)}
+		for stats in caches.values():
+			for days, n in stats.get('ages', {}).items():
+				ages[days] = ages.get(days, 0) + n
+		return {
+			'tiles': sum(stats['tiles'] for stats in caches.values()),
+			'bytes': sum(stats['bytes'] for stats in caches.values()),
+			'hitRatio': hitRatio,
+			'ages': ages,
+			'tiers': tiers,
+			'caches': caches
+		}
+
 	def getTM(self, dstGrid=False):
 		if dstGrid:
 			if self.dstTms is not None:
@@ -578,14 +707,26 @@ class MapService():
 		Download bytes data of requested tile in source tile matrix space
 		Return None if unable to download a valid stream
 		"""
+		data, etag, modified = self.fetchTile(laykey, col, row, zoom)
+		if isinstance(data, bytes):
+			return data
+		return None
+
+
+	def fetchTile(self, laykey, col, row, zoom, validators=None):
+		"""
+		Download requested tile in source tile matrix space, return a (data, etag, last_modified) tuple
+		data is bytes, None on network or server error, MISSING if the server has no valid data for this tile
+		or NOT_MODIFIED when the submited validators (etag, last_modified) of the cached tile are still valid
+		"""
 
 		cache_dir = os.path.join(self.tileCacheDir, self.srckey, laykey, str(zoom))
 		tile_path = os.path.join(cache_dir, f"{col}_{row}.png")
-		if os.path.exists(tile_path):
+		if self.TILES_DIR_CACHE and os.path.exists(tile_path) and validators is None:
 			with open(tile_path, "rb") as f:
 				data = f.read()
 			if imghdr.what(None, data) is not None:
-				return data
+				return data, None, None
 			try:
 				os.remove(tile_path)
 			except OSError:
@@ -594,31 +735,51 @@ class MapService():
 		url = self.buildUrl(laykey, col, row, zoom)
 		log.debug(url)
 
+		#conditional request to revalidate an expired tile
+		headers = self.headers
+		if validators is not None:
+			etag, modified = validators
+			headers = dict(headers)
+			if etag:
+				headers['If-None-Match'] = etag
+			if modified:
+				headers['If-Modified-Since'] = modified
+
 		try:
 			#make request
-			req = urllib.request.Request(url, None, self.headers)
-			handle = urllib.request.urlopen(req, timeout=TIMEOUT)
-			#open image stream
-			data = handle.read()
-			handle.close()
+			r = self.transport.request(url, headers, timeout=TIMEOUT)
 		except Exception as e:
 			log.error("Can't download tile x{} y{}. Error {}".format(col, row, e))
-			data = None
+			self.tileCache.count('network', misses=1)
+			return None, None, None
+
+		if r.status == 304:
+			self.tileCache.count('network', hits=1)
+			return NOT_MODIFIED, None, None
+		if r.status in (204, 404, 410):
+			log.debug("No tile available for request {}".format(url))
+			self.tileCache.count('network', misses=1)
+			return MISSING, None, None
+		if not r.ok:
+			log.error("Can't download tile x{} y{}. HTTP error {}".format(col, row, r.status))
+			self.tileCache.count('network', misses=1)
+			return None, None, None
 
 		#Make sure the stream is correct
-		if data is not None:
-			format = imghdr.what(None, data)
-			if format is None:
-				data = None
-
-		if data is None:
+		data = r.data
+		format = imghdr.what(None, data)
+		if format is None:
 			log.debug("Invalid tile data for request {}".format(url))
-		else:
+			self.tileCache.count('network', misses=1)
+			return MISSING, None, None
+		self.tileCache.count('network', hits=1)
+
+		if self.TILES_DIR_CACHE:
 			os.makedirs(cache_dir, exist_ok=True)
 			with open(tile_path, "wb") as f:
 				f.write(data)
 
-		return data
+		return data, r.headers.get('etag'), r.headers.get('last-modified')
 
 
 	def tileRequest(self, laykey, col, row, zoom, toDstGrid=True):
@@ -626,6 +787,17 @@ class MapService():
 		Return bytes data of the requested tile or None if unable to get valid data
 		Tile is downloaded from map service and, if needed, reprojected to fit the destination grid
 		"""
+		record = self.tileRecord(laykey, col, row, zoom, toDstGrid)
+		if record is None or not isinstance(record[3], bytes):
+			return None
+		return record[3]
+
+
+	def tileRecord(self, laykey, col, row, zoom, toDstGrid=True, validators=None):
+		"""
+		Return the cache record (x,y,z,data,etag,last_modified) of the requested tile, or None if the request failed
+		data can be a MISSING or NOT_MODIFIED marker (see fetchTile)
+		"""
 
 		#Select tile matrix set
 		tm = self.getTM(toDstGrid)
@@ -635,80 +807,154 @@ class MapService():
 			return None
 
 		if not toDstGrid:
-			data = self.downloadTile(laykey, col, row, zoom)
+			data, etag, modified = self.fetchTile(laykey, col, row, zoom, validators)
 		else:
-			data = self.buildDstTile(laykey, col, row, zoom)
+			data, etag, modified = self.buildDstTile(laykey, col, row, zoom), None, None
 
-		return data
+		if data is None:
+			return None
+		return (col, row, zoom, data, etag, modified)
 
 
 	def buildDstTile(self, laykey, col, row, zoom):
 		'''build a tile that fit the destination tile matrix'''
-
-		#get tile bbox
-		bbox = self.dstTms.getTileBbox(col, row, zoom)
-		xmin, ymin, xmax, ymax = bbox
-
-		#get closest zoom level
-		res = self.dstTms.getRes(zoom)
-		if self.dstTms.units == 'degrees' and self.srcTms.units == 'meters':
-			res2 = dd2meters(res)
-		elif self.srcTms.units == 'degrees' and self.dstTms.units == 'meters':
-			res2 = meters2dd(res)
-		else:
-			res2 = res
-		_zoom = self.srcTms.getNearestZoom(res2)
-		_res = self.srcTms.getRes(_zoom)
-
-		#reproj bbox
+		return self.buildDstTiles(laykey, [(col, row, zoom)], nbThread=4)[0][3]
+
+
+	@staticmethod
+	def _cutTile(data, posx, posy, tileSize):
+		'''Return the tileSize x tileSize block of an image array at (posx, posy), padded with the background color
+		where the image is smaller (rounding of the warped extent)'''
+		tile = data[posy:posy+tileSize, posx:posx+tileSize]
+		h, w = tile.shape[:2]
+		if (h, w) == (tileSize, tileSize):
+			return tile
+		log.debug('Destination tile of {}x{} px padded to {}px'.format(w, h, tileSize))
+		padded = np.empty((tileSize, tileSize) + tile.shape[2:], dtype=tile.dtype)
+		nbBands = tile.shape[2] if tile.ndim == 3 else 1
+		padded[:] = MOSAIC_BKG_COLOR[:nbBands] if tile.ndim == 3 else MOSAIC_BKG_COLOR[0]
+		padded[:h, :w] = tile
+		return padded
+
+
+	def dstTilesBatches(self, tiles, batchSize=None):
+		'''Group a list of destination tiles [(x,y,z)] by zoom level and blocks of batchSize x batchSize tiles'''
+		if batchSize is None:
+			batchSize = self.DST_BATCH_SIZE
+		batches = {}
+		for col, row, zoom in tiles:
+			key = (zoom, col // batchSize, row // batchSize)
+			batches.setdefault(key, []).append( (col, row, zoom) )
+		return list(batches.values())
+
+
+	def buildDstTiles(self, laykey, tiles, nbThread=4):
+		'''
+		Build a batch of tiles that fit the destination tile matrix
+		input: [(x,y,z)] >> output: [(x,y,z,data)], data is None if the tile cannot be built
+		A single source mosaic covering the union of the tiles of a same zoom level is requested and warped once,
+		then all the destination tiles are cut from the warped image. So tiles of a batch should be close to each
+		other, use dstTilesBatches() to split a large list of tiles.
+		'''
 		crs1, crs2 = self.srcTms.CRS, self.dstTms.CRS
-		try:
-			_bbox = reprojBbox(crs2, crs1, bbox)
-		except Exception as e:
-			log.warning('Cannot reproj tile bbox - ' + str(e))
-			return None
+		rprj = getReproj(crs2, crs1)
+		tileSize = self.dstTms.tileSize
+		result = {}
+
+		zooms = sorted(set(tile[2] for tile in tiles))
+		for zoom in zooms:
+			if not self.running:
+				break
+			zTiles = [tile for tile in tiles if tile[2] == zoom]
+
+			#union bbox of the tiles
+			bboxs = [self.dstTms.getTileBbox(col, row, zoom) for col, row, zoom in zTiles]
+			xmin = min(bbox[0] for bbox in bboxs)
+			ymin = min(bbox[1] for bbox in bboxs)
+			xmax = max(bbox[2] for bbox in bboxs)
+			ymax = max(bbox[3] for bbox in bboxs)
+
+			#get closest zoom level
+			res = self.dstTms.getRes(zoom)
+			if self.dstTms.units == 'degrees' and self.srcTms.units == 'meters':
+				res2 = dd2meters(res)
+			elif self.srcTms.units == 'degrees' and self.dstTms.units == 'meters':
+				res2 = meters2dd(res)
+			else:
+				res2 = res
+			_zoom = self.srcTms.getNearestZoom(res2)
 
-		#list, download and merge the tiles required to build this one (recursive call)
-		mosaic = self.getImage(laykey, _bbox, _zoom, toDstGrid=False, nbThread=4, cpt=False)
+			#reproj bbox
+			try:
+				_bbox = rprj.bbox((xmin, ymin, xmax, ymax))
+			except Exception as e:
+				log.warning('Cannot reproj tile bbox - ' + str(e))
+				continue
 
-		if mosaic is None:
-			return None
+			try:
+				#list, download and merge the tiles required to build this batch (recursive call)
+				mosaic = self.getImage(laykey, _bbox, _zoom, toDstGrid=False, nbThread=nbThread, cpt=False)
+				if mosaic is None:
+					continue
 
-		#Reprojection
-		tileSize = self.dstTms.tileSize
-		img = NpImage(reprojImg(crs1, crs2, mosaic.toGDAL(), out_ul=(xmin,ymax), out_size=(tileSize,tileSize), out_res=res, sqPx=True, resamplAlg=self.RESAMP_ALG))
+				#Reprojection of the whole batch at once
+				w = int(round((xmax - xmin) / res))
+				h = int(round((ymax - ymin) / res))
+				img = NpImage(reprojImg(crs1, crs2, mosaic, out_ul=(xmin,ymax), out_size=(w,h), out_res=res, sqPx=True, resamplAlg=self.RESAMP_ALG))
+			except Exception as e:
+				log.error('Cannot build the destination tiles of zoom level {}'.format(zoom), exc_info=True)
+				continue
 
-		return img.toBLOB()
+			#cut the tiles, a failure only skips the tile
+			for tile, bbox in zip(zTiles, bboxs):
+				posx = int(round((bbox[0] - xmin) / res))
+				posy = int(round((ymax - bbox[3]) / res))
+				try:
+					data = self._cutTile(img.data, posx, posy, tileSize)
+					result[tile] = NpImage(data).toBLOB()
+				except Exception as e:
+					log.error('Cannot build the destination tile x{} y{} z{}'.format(*tile), exc_info=True)
 
+		return [(col, row, zoom, result.get((col, row, zoom))) for col, row, zoom in tiles]
 
 
 
-	def seedTiles(self, laykey, tiles, toDstGrid=True, nbThread=10, buffSize=5000, cpt=True):
+
+	def seedTiles(self, laykey, tiles, toDstGrid=True, nbThread=10, buffSize=5000, cpt=True, engine=None, center=None, claim=True):
 		"""
 		Seed the cache by downloading the requested tiles from map service
 		Downloads are performed through thread to speed up
 
 		buffSize : maximum number of tiles keeped in memory before put them in cache database
+		engine : 'THREAD' or 'ASYNC', if None the class attribute SEED_ENGINE is used
+			with the async engine, nbThread is the maximum number of concurrent downloads
+		center : (x,y) coords in tile matrix crs, missing tiles are fetched by zoom level then by distance
+			to this point (default to the center of the requested tiles), see TileScheduler
+		claim : if True, tiles claimed by another process sharing the cache are awaited instead of downloaded
 		"""
-
-		def downloading(laykey, tilesQueue, tilesData, toDstGrid):
-			'''Worker that process the queue and seed tilesData array [(x,y,z,data)]'''
-			#infinite loop that processes items into the queue
-			while not tilesQueue.empty(): #empty is True if all item was get but it not tell if all task was done
-				#cancel thread if requested
-				if not self.running:
+		if engine is None:
+			engine = self.SEED_ENGINE
+		if engine not in ('THREAD', 'ASYNC'):
+			raise ValueError('Unknown seeding engine ' + str(engine))
+
+		def downloading(laykey, scheduler, tilesData, toDstGrid):
+			'''Worker that process the scheduler jobs and seed tilesData array [(x,y,z,data)]'''
+			#loop until there is no more tiles queued in the scheduler
+			while self.running and not failed: #cancel thread if requested or if the tiles can not be written
+				#Get the most urgent job
+				tile = scheduler.get()
+				if tile is None:
 					break
-				#Get a job into the queue
-				col, row, zoom = tilesQueue.get() #get() pop the item from queue
+				col, row, zoom = tile
 				#do the job
-				data = self.tileRequest(laykey, col, row, zoom, toDstGrid)
-				if data is not None:
-					tilesData.put( (col, row, zoom, data) ) #will block if the queue is full
+				try:
+					record = self.tileRecord(laykey, col, row, zoom, toDstGrid, validators.get(tile))
+				finally:
+					scheduler.done(tile)
+				if record is not None:
+					tilesData.put(record) #will block if the queue is full
 				if cpt:
 					self.cptTiles += 1
-				#self.nTaskDone += 1
-				#flag it's done
-				tilesQueue.task_done() #it's just a count of finished tasks used by join() to know if the work is finished
 
 		def finished():
 			#return self.nTaskDone == nMissing
@@ -716,17 +962,32 @@ class MapService():
 			#start multiple threads to seedTiles() and all these process will increments nTaskDone
 			return not any([t.is_alive() for t in threads])
 
-		def putInCache(tilesData, jobs, cache):
-			while True:
-				if tilesData.full() or \
-				( (finished() or not self.running) and not tilesData.empty()):
-					data = [tilesData.get() for i in range(tilesData.qsize())]
-					with self.lock:
-						cache.putTiles(data)
-				if finished() and tilesData.empty():
-					break
-				if not self.running:
-					break
+		def putInCache(tilesData, writer, scheduler):
+			#wait for downloaded tiles and hand them to the write-behind writer
+			#do not leave before all workers are done, otherwise a worker could block on a full queue
+			try:
+				while True:
+					try:
+						tile = tilesData.get(timeout=0.05)
+					except queue.Empty:
+						if finished():
+							break
+						continue
+					writer.put(*tile)
+				#a worker may have put its last tile just before leaving
+				while not tilesData.empty():
+					writer.put(*tilesData.get())
+			except Exception as e:
+				#stop the workers and free the ones blocked on the full queue, the error is raised by seedTiles
+				failed.append(e)
+				scheduler.cancel()
+				while not finished():
+					try:
+						tilesData.get(timeout=0.05)
+					except queue.Empty:
+						pass
+
+		failed = [] #error of the cache writer thread
 
 		if cpt:
 			#init cpt progress
@@ -739,42 +1000,109 @@ class MapService():
 		if cpt:
 			self.status = 1
 		cache = self.getCache(laykey, toDstGrid)
-		missing = cache.listMissingTiles(tiles)
+		missing = cache.listTilesToFetch(tiles)
 		nMissing = len(missing)
-		nExists = self.nbTiles - len(missing)
-		log.debug("{} tiles requested, {} already in cache, {} remains to download".format(self.nbTiles, nExists, nMissing))
-		if cpt:
-			self.cptTiles += nExists
+		nExists = len(tiles) - nMissing
+		self.tileCache.count('gpkg', hits=nExists, misses=nMissing)
+		#tiles already being downloaded by another process sharing the cache are awaited instead
+		if claim:
+			missing, awaited = cache.claimTiles(missing)
+		else:
+			awaited = set()
+		scheduler = None
+		try:
+			#expired tiles are revalidated with a conditional request
+			validators = cache.getValidators(missing)
+			log.debug("{} tiles requested, {} already in cache, {} being downloaded by another process, {} remains to download".format(len(tiles), nExists, len(awaited), len(missing)))
+			if cpt:
+				self.cptTiles += nExists
 
-		#Downloading tiles
-		if cpt:
-			self.status = 2
-		if len(missing) > 0:
-
-			#Result queue
-			tilesData = queue.Queue(maxsize=buffSize)
-
-			#Seed the queue
-			jobs = queue.Queue()
-			for tile in missing:
-				jobs.put(tile)
-
-			#Launch threads
-			threads = []
-			for i in range(nbThread):
-				t = threading.Thread(target=downloading, args=(laykey, jobs, tilesData, toDstGrid))
-				t.setDaemon(True)
-				threads.append(t)
-				t.start()
-
-			seeder = threading.Thread(target=putInCache, args=(tilesData, jobs, cache))
-			seeder.setDaemon(True)
-			seeder.start()
-			seeder.join()
-
-			#Make sure all threads has finished
-			for t in threads:
-				t.join()
+			#Downloading tiles
+			if cpt:
+				self.status = 2
+			if len(missing) > 0:
+				#batched writes through a single connection, flushed and closed once all tiles are downloaded
+				writer = cache.writer(maxTiles=min(buffSize, 1000), lock=self.lock)
+				#priority queue of tiles to fetch, registered so that cancelPending() and preempt() can reach it
+				scheduler = TileScheduler(self.getTM(toDstGrid), missing, center)
+				with self.lock:
+					self.schedulers.add(scheduler)
+
+			if len(missing) > 0 and toDstGrid and self.DST_BATCH_SIZE > 1:
+				#build the destination tiles by blocks, the source tiles of each block are downloaded
+				#in parallel by the recursive getImage() call
+				#blocks are pulled from the scheduler so they follow its priority order and a preemption
+				try:
+					while self.running:
+						batch = scheduler.getBlock(self.DST_BATCH_SIZE)
+						if not batch:
+							break
+						try:
+							for tile in self.buildDstTiles(laykey, batch, nbThread=nbThread):
+								if tile[3] is not None:
+									writer.put(*tile)
+						finally:
+							for tile in batch:
+								scheduler.done(tile)
+						if cpt:
+							self.cptTiles += len(batch)
+				finally:
+					writer.close()
+
+			elif len(missing) > 0 and engine == 'ASYNC':
+				seeder = AsyncSeeder(self, laykey, writer, toDstGrid=toDstGrid, concurrency=nbThread, buffSize=buffSize, cpt=cpt, validators=validators)
+				try:
+					seeder.run(scheduler)
+				finally:
+					writer.close()
+
+			elif len(missing) > 0:
+
+				#Result queue
+				tilesData = queue.Queue(maxsize=buffSize)
+
+				#Launch threads
+				threads = []
+				for i in range(nbThread):
+					t = threading.Thread(target=downloading, args=(laykey, scheduler, tilesData, toDstGrid))
+					t.setDaemon(True)
+					threads.append(t)
+					t.start()
+
+				seeder = threading.Thread(target=putInCache, args=(tilesData, writer, scheduler))
+				seeder.setDaemon(True)
+				seeder.start()
+				seeder.join()
+
+				#Make sure all threads has finished
+				for t in threads:
+					t.join()
+
+				try:
+					if failed:
+						raise failed[0]
+				finally:
+					writer.close()
+		finally:
+			#also on failure, so the scheduler does not leak and other processes do not wait for the claimed tiles
+			if scheduler is not None:
+				with self.lock:
+					self.schedulers.discard(scheduler)
+			if len(missing) > 0:
+				#claims of the tiles that could not be downloaded
+				cache.releaseClaims(missing)
+				#decoded copies of the expired tiles that have just been downloaded again
+				self.tileCache.discard(cache.name, missing)
+				self.compactCache(cache)
+
+		if awaited:
+			left = cache.waitTiles(awaited, stop=lambda: not self.running)
+			self.tileCache.discard(cache.name, awaited)
+			if cpt:
+				self.cptTiles += len(awaited) - len(left)
+			#the other process failed to get these tiles, has been stopped or is too slow to reach them
+			if left and self.running:
+				self.seedTiles(laykey, list(left), toDstGrid=toDstGrid, nbThread=nbThread, buffSize=buffSize, cpt=False, engine=engine, center=center, claim=False)
 
 		#Reinit status and cpt progress
 		if cpt:
@@ -788,15 +1116,21 @@ class MapService():
 		input: [(x,y,z)] >> output: [(x,y,z,data)]
 		Tiles are downloaded from map service or directly pick up from cache database.
 		"""
-		#seed the cache
-		self.seedTiles(laykey, tiles, toDstGrid=toDstGrid, nbThread=10, cpt=cpt)
-		#request the cache and return
+		#seed the cache, a standalone call does not require the service to be started
+		standalone = not self.running
+		self.running = True
+		try:
+			self.seedTiles(laykey, tiles, toDstGrid=toDstGrid, nbThread=10, cpt=cpt)
+		finally:
+			if standalone:
+				self.running = False
+		#request the cache and return, in the requested order
 		cache = self.getCache(laykey, toDstGrid)
 		return cache.getTiles(tiles) #[(x,y,z,data)]
 
 
 	def getTile(self, laykey, col, row, zoom, toDstGrid=True):
-		return self.getTiles(laykey, [col, row, zoom], toDstGrid)[0]
+		return self.getTiles(laykey, [(col, row, zoom)], toDstGrid)[0]
 
 
 	def bboxRequest(self, bbox, zoom, dstGrid=True):
@@ -805,20 +1139,154 @@ class MapService():
 		return BBoxRequest(tm, bbox, zoom)
 
 
-	def seedCache(self, laykey, bbox, zoom, toDstGrid=True, nbThread=10, buffSize=5000):
+	def seedCache(self, laykey, bbox, zoom, toDstGrid=True, nbThread=10, buffSize=5000, cpt=True, engine=None, center=None, pyramid=False):
 		"""
 		Seed the cache with the tiles covering the requested bbox
+		pyramid (bool) : with a list of zoom levels, download only the finest one and build the others
+		from it (see buildPyramid)
 		"""
 		#Select tile matrix set
 		tm = self.getTM(toDstGrid)
+		if isinstance(zoom, list) and pyramid and len(zoom) > 1:
+			if self.isQuadTree(tm, min(zoom), max(zoom)):
+				self.seedTiles(laykey, BBoxRequest(tm, bbox, max(zoom)).tiles, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=buffSize, cpt=cpt, engine=engine, center=center)
+				self.buildPyramid(laykey, bbox, zoom, toDstGrid=toDstGrid, nbThread=nbThread, cpt=cpt, engine=engine)
+				return
+			log.warning('Tile matrix levels are not nested, cannot build the cache as a pyramid')
 		if isinstance(zoom, list):
 			rq = BBoxRequestMZ(tm, bbox, zoom)
 		else:
 			rq = BBoxRequest(tm, bbox, zoom)
-		self.seedTiles(laykey, rq.tiles, toDstGrid=toDstGrid, nbThread=10, buffSize=5000)
+		self.seedTiles(laykey, rq.tiles, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=buffSize, cpt=cpt, engine=engine, center=center)
+
+
+	def isQuadTree(self, tm, zmin, zmax):
+		'''Check if each tile of the zoom levels between zmin and zmax exactly covers 2x2 tiles of the next level'''
+		for z in range(zmin, zmax):
+			if not math.isclose(tm.getRes(z) / tm.getRes(z+1), 2):
+				return False
+		return True
 
 
-	def getImage(self, laykey, bbox, zoom, path=None, bigTiff=False, outCRS=None, toDstGrid=True, nbThread=10, cpt=True):
+	def buildPyramid(self, laykey, bbox, zooms, toDstGrid=True, nbThread=10, cpt=True, engine=None, categorical=None):
+		"""
+		Build the coarser zoom levels of a cache from its finest one
+		Each tile is computed from its 4 children of the next zoom level with a 2x2 downsampling :
+		area averaging for imagery or nearest neighbour (top left pixel) for categorical layers,
+		and directly written to the cache. All levels between min(zooms) and max(zooms) are built,
+		the finest one must have been seeded before. Tiles whose children are not all available
+		(out of the bbox of the finest level or failed downloads) are downloaded instead.
+		categorical (bool) : default to the optional 'categorical' attribute of the layer definition
+		"""
+		tm = self.getTM(toDstGrid)
+		cache = self.getCache(laykey, toDstGrid)
+		lay = self.layers[laykey]
+		if categorical is None:
+			categorical = getattr(lay, 'categorical', False)
+		fmt = 'JPEG' if lay.format in ('jpeg', 'jpg') else 'PNG'
+		zmin, zmax = min(zooms), max(zooms)
+
+		for z in range(zmax - 1, zmin - 1, -1):
+			if not self.running:
+				break
+			tiles = BBoxRequest(tm, bbox, z).tiles
+			missing = cache.listMissingTiles(tiles)
+			if cpt:
+				self.status = 3
+				self.nbTiles = len(tiles)
+				self.cptTiles = len(tiles) - len(missing)
+			log.debug('Building zoom level {} from level {}, {} tiles'.format(z, z+1, len(missing)))
+
+			toDownload = []
+			#children rows from top to bottom, with a south west origin the row index increase to the north
+			rows = (0, 1) if tm.originLoc == 'NW' else (1, 0)
+			missing = sorted(missing, key=lambda tile: (tile[1], tile[0]))
+			chunkSize = 256 #parent tiles processed at once
+			writer = cache.writer(lock=self.lock)
+			try:
+				for i in range(0, len(missing), chunkSize):
+					if not self.running:
+						break
+					parents = missing[i:i+chunkSize]
+					children = [(2*col+dx, 2*row+dy, z+1) for col, row, _z in parents for dy in (0, 1) for dx in (0, 1)]
+					children = {tile[:3]:tile[3] for tile in cache.getTiles(children)}
+					for col, row, _z in parents:
+						quad = [children.get((2*col+dx, 2*row+dy, z+1)) for dy in rows for dx in (0, 1)]
+						data = None
+						if all(d is not None for d in quad):
+							try:
+								data = self._deriveTile(quad, tm.tileSize, categorical, fmt)
+							except Exception as e:
+								log.error('Unable to build tile x{} y{} z{} from its children'.format(col, row, z), exc_info=True)
+						if data is None:
+							toDownload.append( (col, row, z) )
+						else:
+							writer.put(col, row, z, data)
+							if cpt:
+								self.cptTiles += 1
+			finally:
+				writer.close()
+
+			if toDownload and self.running:
+				self.seedTiles(laykey, toDownload, toDstGrid=toDstGrid, nbThread=nbThread, cpt=cpt, engine=engine)
+
+		if cpt:
+			self.status = 0
+			self.nbTiles, self.cptTiles = 0, 0
+
+
+	def _deriveTile(self, quad, tileSize, categorical=False, fmt='PNG'):
+		'''Merge 4 tiles data [top left, top right, bottom left, bottom right] and downsample the result to a single tile'''
+		imgs = [NpImage(data).data for data in quad]
+		nbBands = max(1 if img.ndim == 2 else img.shape[2] for img in imgs)
+		mosaic = np.zeros((2*tileSize, 2*tileSize, nbBands), dtype=np.uint8)
+		if nbBands == 4:
+			mosaic[:, :, 3] = 255
+		for img, (x, y) in zip(imgs, ((0, 0), (1, 0), (0, 1), (1, 1))):
+			if img.ndim == 2:
+				img = img[:, :, np.newaxis]
+			n = min(img.shape[2], nbBands)
+			mosaic[y*tileSize:(y+1)*tileSize, x*tileSize:(x+1)*tileSize, :n] = img[:, :, :n]
+			if img.shape[2] == 1 and nbBands >= 3:
+				mosaic[y*tileSize:(y+1)*tileSize, x*tileSize:(x+1)*tileSize, :3] = img
+		if categorical:
+			data = mosaic[::2, ::2]
+		else:
+			data = mosaic.reshape(tileSize, 2, tileSize, 2, nbBands).astype(np.uint16).sum(axis=(1, 3))
+			data = ((data + 2) // 4).astype(np.uint8)
+		if fmt == 'JPEG' and nbBands == 4:
+			data = data[:, :, :3]
+		return NpImage(np.ascontiguousarray(data)).toBLOB(fmt)
+
+
+	def _decodeTile(self, data, tileSize):
+		'''Return a NpImage from tile bytes data, or a colored tile if data is empty or corrupted'''
+		#TODO corrupted or empty tiles must be deleted from cache are fetched again
+		if data is None:
+			#create an empty tile
+			return NpImage.new(tileSize, tileSize, bkgColor=EMPTY_TILE_COLOR)
+		try:
+			return NpImage(data)
+		except Exception as e:
+			log.error('Corrupted tile on cache', exc_info=True)
+			#create an empty tile if we are unable to get a valid stream
+			return NpImage.new(tileSize, tileSize, bkgColor=CORRUPTED_TILE_COLOR)
+
+	def _pasteTile(self, mosaic, rq, tile):
+		'''Paste a decoded tile (x,y,z,array) into its place of an in memory mosaic, array is None for a corrupted tile'''
+		if not self.running:
+			return
+		col, row, z, arr = tile
+		tileSize = rq.tileSize
+		posx = (col - rq.firstCol) * tileSize
+		posy = abs((row - rq.firstRow)) * tileSize
+		if arr is None:
+			mosaic.fill(CORRUPTED_TILE_COLOR, posx, posy, tileSize, tileSize)
+			return
+		mosaic.pasteArray(arr, posx, posy)
+
+
+	def getImage(self, laykey, bbox, zoom, path=None, bigTiff=False, outCRS=None, toDstGrid=True, nbThread=10, cpt=True, engine=None, decodeThreads=None, center=None):
 		"""
 		Build a mosaic of tiles covering the requested bounding box
 		#laykey (str)
@@ -826,18 +1294,27 @@ class MapService():
 		#zoom (int)
 		#path (str): if None the function will return a georeferenced NpImage object. If not None, then the resulting output will be
 		writen as geotif file on disk and the function will return None
-		#bigTiff (bool): if true then the raster will be writen by small part with the help of GDAL API. If false the raster will be
-		writen at one, in this case all the tiles must fit in memory otherwise it will raise a memory overflow error
+		#bigTiff (bool): if true then the raster will be writen by small part with the help of GDAL API, or streamed row by row
+		to a deflate compressed GeoTiff when GDAL is not available. If false the raster will be writen at one, in this case all the
+		tiles must fit in memory otherwise it will raise a memory overflow error
 		#outCRS : destination CRS if a reprojection if expected (require GDAL support)
 		#toDstGrid (bool) : decide if the function will seed the destination tile matrix sets for this MapService instance
 		(different from the source tile matrix set)
 		#nbThread (int) : nimber of threads that will be used for downloading tiles
 		#cpt (bool) : define if the service must report or not tiles downloading count for this request
+		#engine (str) : seeding engine, 'THREAD' or 'ASYNC' (default to SEED_ENGINE class attribute)
+		#decodeThreads (int) : number of threads used to decode the tiles (default to DECODE_THREADS class attribute)
+		#center (tuple) : (x,y) point in tile matrix crs from which tiles are downloaded first (default to bbox center)
 		"""
 
 		#Select tile matrix set
 		tm = self.getTM(toDstGrid)
 
+		#Without GDAL, big tiff are streamed to disk and cannot be reprojected afterwards
+		streamTiff = bigTiff and not HAS_GDAL
+		if streamTiff and outCRS is not None and outCRS != tm.CRS:
+			raise NotImplementedError('Reprojecting a bigTiff output requires GDAL')
+
 		#Get request
 		rq = BBoxRequest(tm, bbox, zoom)
 		tileSize = rq.tileSize
@@ -846,9 +1323,17 @@ class MapService():
 		rqTiles = rq.tiles #[(x,y,z)]
 
 		##method 1) Seed the cache with all required tiles
-		self.seedCache(laykey, bbox, zoom, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=5000)
+		#in memory mosaics go through the tiered cache, only the tiles not already decoded in memory are seeded
+		if bigTiff:
+			self.seedCache(laykey, bbox, zoom, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=5000, cpt=cpt, engine=engine, center=center)
 		cache = self.getCache(laykey, toDstGrid)
 
+		def seed(tiles):
+			self.seedTiles(laykey, tiles, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=5000, cpt=cpt, engine=engine, center=center)
+			if cpt:
+				self.status = 3
+			return self.running
+
 		if not self.running:
 			if cpt:
 				self.status = 0
@@ -866,55 +1351,70 @@ class MapService():
 			#Create numpy image in memory
 			mosaic = NpImage.new(img_w, img_h, bkgColor=MOSAIC_BKG_COLOR, georef=georef)
 			chunkSize = rq.nbTiles
-		else:
+		elif not streamTiff:
 			#Create bigtiff file on disk
 			mosaic = BigTiffWriter(path, img_w, img_h, georef)
 			ds = mosaic.ds
 			chunkSize = 5 #number of tiles to extract in one cache request
+		else:
+			#Stream the tiles to a GeoTiff file, one row of tiles at a time from top to bottom
+			mosaic = GeoTiffWriter(path, img_w, img_h, georef, tileSize=tileSize, bkgColor=MOSAIC_BKG_COLOR)
+			rqTiles = sorted(rqTiles, key=lambda tile: (abs(tile[1] - rq.firstRow), tile[0]))
+			chunkSize = len(cols)
 
 		#Build mosaic
-		for i in range(0, rq.nbTiles, chunkSize):
-			chunkTiles = rqTiles[i:i+chunkSize]
+		if decodeThreads is None:
+			decodeThreads = self.DECODE_THREADS
+		with ThreadPoolExecutor(max_workers=decodeThreads) as pool:
+			for i in range(0, rq.nbTiles, chunkSize):
+				chunkTiles = rqTiles[i:i+chunkSize]
+
+				if not bigTiff and isinstance(cache, RawTileStore):
+					#tiles are stored decoded, they are copied from the mapped file without going through the memory cache
+					missing = cache.listTilesToFetch(chunkTiles)
+					if missing:
+						seed(list(missing))
+					if cpt:
+						self.status = 3
+					for tile in cache.getArrays(chunkTiles):
+						self._pasteTile(mosaic, rq, tile)
+				elif not bigTiff:
+					#decoded tiles from memory, the others are downloaded if needed then read from the cache database
+					#and decoded in parallel
+					tiles = self.tileCache.getTiles(cache.name, cache, chunkTiles, decode=mosaic.decodeBLOB, fetch=seed, map=pool.map,
+						maxDays=cache.MAX_DAYS) #[(x,y,z,array)]
+					if cpt:
+						self.status = 3
+					for tile in tiles:
+						self._pasteTile(mosaic, rq, tile)
+				else:
+					##method 1) Get cached tiles
+					tiles = cache.getTiles(chunkTiles) #[(x,y,z,data)]
+
+					##method 2) Get tiles from www or cache (all tiles must fit in memory)
+					#tiles = self.getTiles(laykey, chunkTiles, toDstGrid, nbThread, cpt)
 
-			##method 1) Get cached tiles
-			tiles = cache.getTiles(chunkTiles) #[(x,y,z,data)]
+					if cpt:
+						self.status = 3
 
-			##method 2) Get tiles from www or cache (all tiles must fit in memory)
-			#tiles = self.getTiles(laykey, chunkTiles, toDstGrid, nbThread, cpt)
 
-			if cpt:
-				self.status = 3
-			for tile in tiles:
+					#decode in parallel but write sequentially, tiff writers must not be written from several threads
+					for tile, img in zip(tiles, pool.map(lambda tile: self._decodeTile(tile[3], tileSize), tiles)):
+						if not self.running:
+							break
+						col, row, z, data = tile
+						posx = (col - rq.firstCol) * tileSize
+						posy = abs((row - rq.firstRow)) * tileSize
+						mosaic.paste(img, posx, posy)
 
 				if not self.running:
+					if streamTiff:
+						#do not leave a complete looking but mostly empty file
+						mosaic.abort()
 					if cpt:
 						self.status = 0
 					return None
 
-				col, row, z, data = tile
-
-				#TODO corrupted or empty tiles must be deleted from cache are fetched again
-				if data is None:
-					#create an empty tile
-					img = NpImage.new(tileSize, tileSize, bkgColor=EMPTY_TILE_COLOR)
-				else:
-					try:
-						img = NpImage(data)
-					except Exception as e:
-						log.error('Corrupted tile on cache', exc_info=True)
-						#create an empty tile if we are unable to get a valid stream
-						img = NpImage.new(tileSize, tileSize, bkgColor=CORRUPTED_TILE_COLOR)
-
-
-				posx = (col - rq.firstCol) * tileSize
-				posy = abs((row - rq.firstRow)) * tileSize
-				mosaic.paste(img, posx, posy)
-
-		if not self.running:
-			if cpt:
-				self.status = 0
-			return None
-
 		#Reproject if needed
 		if outCRS is not None and outCRS != tm.CRS:
 			if cpt:
@@ -922,13 +1422,15 @@ class MapService():
 			time.sleep(0.1) #make sure client have enough time to get the new status...
 
 			if not bigTiff:
-				mosaic = NpImage(reprojImg(tm.CRS, outCRS, mosaic.toGDAL(), sqPx=True, resamplAlg=self.RESAMP_ALG))
+				mosaic = NpImage(reprojImg(tm.CRS, outCRS, mosaic, sqPx=True, resamplAlg=self.RESAMP_ALG))
 			else:
 				outPath = path[:-4] + '_' + str(outCRS) + '.tif'
 				ds = reprojImg(tm.CRS, outCRS, mosaic.ds, sqPx=True, resamplAlg=self.RESAMP_ALG, path=outPath)
 
 		#build overviews for file output
-		if bigTiff:
+		if streamTiff:
+			mosaic.close()
+		elif bigTiff:
 			ds.BuildOverviews(overviewlist=[2,4,8,16,32])
 			ds = None
 
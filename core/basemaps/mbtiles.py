@@ -0,0 +1,154 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import sqlite3
+
+from .tilestore import TileStore, MISSING, NOT_MODIFIED
+
+
+#https://github.com/mapbox/mbtiles-spec/blob/master/1.3/spec.md
+
+#MBTiles rows are numbered from the bottom of the tile matrix (TMS scheme), the rows of
+#a TileMatrix with a north west origin are flipped when they are read or written.
+#The format has no timestamps : stored tiles never expire and http validators or missing
+#tiles markers are not recorded.
+
+PUT_TILE_QUERY = "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?,?,?,?)"
+
+
+class MBTiles(TileStore):
+
+	TABLE = 'tiles'
+	VERSION = '1.3'
+
+	def __init__(self, path, tm, format='png'):
+		TileStore.__init__(self, path, tm)
+		self.format = format
+		if self.CRS != 'EPSG:3857':
+			log.warning('MBTiles {} uses {}, most readers only support EPSG:3857'.format(self.name, self.CRS))
+		if not self.isMBTiles():
+			self.create()
+			self.insertMetadata()
+
+	@property
+	def rowsFromTop(self):
+		return False
+
+	def isMBTiles(self):
+		if not os.path.exists(self.dbPath):
+			return False
+		db = sqlite3.connect(self.dbPath)
+		try:
+			db.execute('SELECT name, value FROM metadata LIMIT 1')
+			db.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles LIMIT 1')
+		except Exception as e:
+			log.error('Incorrect MBTiles schema', exc_info=True)
+			return False
+		else:
+			return True
+		finally:
+			db.close()
+
+	def create(self):
+		"""Create the MBTiles schema on the database"""
+		db = sqlite3.connect(self.dbPath)
+		with db:
+			db.execute("CREATE TABLE metadata (name TEXT, value TEXT, UNIQUE (name));")
+			db.execute("""
+				CREATE TABLE tiles (
+					zoom_level INTEGER NOT NULL,
+					tile_column INTEGER NOT NULL,
+					tile_row INTEGER NOT NULL,
+					tile_data BLOB NOT NULL);
+			""")
+			db.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);")
+		db.close()
+
+	def insertMetadata(self):
+		metadata = {
+			'name': self.name,
+			'format': self.format,
+			'type': 'baselayer',
+			'version': self.VERSION,
+			'description': 'Created with BlenderGIS',
+			'minzoom': 0,
+			'maxzoom': len(self.resolutions) - 1,
+			#not part of the spec, lets a reader check the tile matrix of a non web mercator file
+			'crs': self.CRS
+		}
+		db = sqlite3.connect(self.dbPath)
+		with db:
+			db.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?,?)", [(k, str(v)) for k, v in metadata.items()])
+		db.close()
+
+	def getMetadata(self):
+		with self.connection() as db:
+			return dict(db.execute('SELECT name, value FROM metadata').fetchall())
+
+
+	def flipRow(self, row, zoom):
+		'''Convert a tile row between the TileMatrix and the TMS numbering, the conversion is its own inverse'''
+		if self.originLoc == 'NW':
+			return self.matrixHeight(zoom) - 1 - row
+		return row
+
+	def getTiles(self, tiles):
+		"""tiles = list of (x,y,z) tuple
+		return list of (x,y,z,data) tuple of the tiles available, in the same order as requested"""
+		if not tiles:
+			return []
+		query = "SELECT t.tile_column, t.tile_row, t.zoom_level, t.tile_data FROM request_tiles r JOIN tiles t " \
+				"ON t.zoom_level = r.zoom_level AND t.tile_column = r.tile_column AND t.tile_row = r.tile_row ORDER BY r.idx"
+		with self.connection() as db:
+			self.loadRequest(db, [(x, self.flipRow(y, z), z) for x, y, z in tiles])
+			result = db.execute(query).fetchall()
+		return [(x, self.flipRow(y, z), z, data) for x, y, z, data in result]
+
+	def listExistingTiles(self, tiles):
+		"""
+		input : tiles list [(x,y,z)]
+		output : tiles list set [(x,y,z)] of existing records in the database"""
+		if not tiles:
+			return set()
+		query = "SELECT t.tile_column, t.tile_row, t.zoom_level FROM request_tiles r JOIN tiles t " \
+				"ON t.zoom_level = r.zoom_level AND t.tile_column = r.tile_column AND t.tile_row = r.tile_row"
+		with self.connection() as db:
+			self.loadRequest(db, [(x, self.flipRow(y, z), z) for x, y, z in tiles])
+			result = db.execute(query).fetchall()
+		return set((x, self.flipRow(y, z), z) for x, y, z in result)
+
+	def writeTiles(self, db, tiles):
+		'''Insert tiles with an opened connection, markers are ignored, the transaction is left to the caller'''
+		found = []
+		for tile in tiles:
+			x, y, z, data = tile[:4]
+			if data is MISSING or data is NOT_MODIFIED:
+				continue
+			found.append( (z, x, self.flipRow(y, z), data) )
+		if found:
+			db.executemany(PUT_TILE_QUERY, found)
+
+	def stats(self):
+		"""Return a dict with tiles count and tiles data bytes"""
+		with self.connection() as db:
+			nbTiles, nbBytes = db.execute('SELECT count(*), COALESCE(SUM(length(tile_data)), 0) FROM tiles').fetchone()
+		return {'tiles': nbTiles, 'bytes': nbBytes}
@@ -0,0 +1,270 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import math
+import threading
+
+import numpy as np
+
+from .tilestore import TileStore, MISSING, NOT_MODIFIED
+from ..georaster import NpImage
+
+
+#Tiles are kept decoded as RGBA uint8 arrays in fixed size slots of a memory mapped file (the .slots file
+#next to the index database), slot i starts at byte i * tileSize * tileSize * 4. The sqlite index maps
+#each (z,x,y) to its slot. Reading a tile is a view on the mapped file, so a mosaic is assembled with plain
+#memory copies. A replaced tile is written in its previous slot, slots are never freed.
+#Like in GeoPackage caches, the tiles the server cannot deliver are recorded in "missing_tiles".
+
+
+class RawTileStore(TileStore):
+	'''
+	Tile store of decoded RGBA tiles, for the layers that are displayed often
+
+	Tiles submited as encoded bytes (png, jpeg...) are decoded once before they are written (see prepareTiles),
+	numpy arrays are stored as is. getTiles() returns RGBA arrays instead of bytes.
+	A raw store uses about 4 * tileSize * tileSize bytes per tile (256 KB for 256px tiles),
+	it is not size limited.
+	'''
+
+	TABLE = 'raw_tiles'
+	MAX_DAYS = 90
+	MAX_SIZE = None
+	MISSING_MAX_DAYS = 1 #lifetime of negative cache entries
+	SLOTS_GROWTH = 256 #the slots file is extended by this number of slots at once
+
+	def __init__(self, path, tm):
+		TileStore.__init__(self, path, tm)
+		self.slotsPath = os.path.splitext(path)[0] + '.slots'
+		self.slotShape = (self.tileSize, self.tileSize, 4)
+		self.slotSize = self.tileSize * self.tileSize * 4
+		self.slots = None #np.memmap (nbSlots, tileSize, tileSize, 4)
+		self.mapLock = threading.Lock()
+		with self.connection() as db:
+			with db:
+				self.create(db)
+		if not os.path.exists(self.slotsPath):
+			open(self.slotsPath, 'wb').close()
+
+	@staticmethod
+	def create(db):
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS raw_tiles (
+				zoom_level INTEGER NOT NULL,
+				tile_column INTEGER NOT NULL,
+				tile_row INTEGER NOT NULL,
+				slot INTEGER NOT NULL,
+				last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
+				PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID;
+		""")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS missing_tiles (
+				zoom_level INTEGER NOT NULL,
+				tile_column INTEGER NOT NULL,
+				tile_row INTEGER NOT NULL,
+				last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
+				PRIMARY KEY (zoom_level, tile_column, tile_row));
+		""")
+		db.execute("CREATE TABLE IF NOT EXISTS raw_state (nb_slots INTEGER NOT NULL);")
+		db.execute("INSERT INTO raw_state SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM raw_state);")
+
+	def close(self):
+		TileStore.close(self)
+		mapLock = getattr(self, 'mapLock', None)
+		if mapLock is None:
+			return
+		with mapLock:
+			if self.slots is not None:
+				self.slots.flush()
+			#views returned by getArrays() keep the mapping alive until they are released
+			self.slots = None
+
+	def mapSlots(self, nbSlots):
+		'''Return the mapped slots array holding at least nbSlots slots, the file is extended and mapped again if needed'''
+		with self.mapLock:
+			slots = self.slots
+			if slots is not None and len(slots) >= nbSlots:
+				return slots
+			size = os.path.getsize(self.slotsPath) // self.slotSize
+			if size < nbSlots:
+				size = math.ceil(nbSlots / self.SLOTS_GROWTH) * self.SLOTS_GROWTH
+				with open(self.slotsPath, 'r+b') as f:
+					f.truncate(size * self.slotSize)
+			if slots is not None:
+				slots.flush()
+			#an older mapping still used by another thread stays valid, it is released with its last view
+			self.slots = np.memmap(self.slotsPath, dtype=np.uint8, mode='r+', shape=(size,) + self.slotShape)
+			return self.slots
+
+	def toRGBA(self, data):
+		'''Return the RGBA uint8 array of a tile given as encoded bytes or as a numpy array'''
+		arr = data if isinstance(data, np.ndarray) else NpImage(data).data
+		if arr.shape == self.slotShape and arr.dtype == np.uint8:
+			return arr
+		if arr.shape[:2] != self.slotShape[:2]:
+			raise ValueError('Tile of {}x{} pixels in a {}px tile matrix'.format(arr.shape[1], arr.shape[0], self.tileSize))
+		if arr.ndim == 2:
+			arr = arr[:, :, np.newaxis]
+		nbBands = arr.shape[2]
+		rgba = np.empty(self.slotShape, dtype=np.uint8)
+		if nbBands <= 2: #gray or gray + alpha
+			rgba[:, :, :3] = arr[:, :, :1]
+		else:
+			rgba[:, :, :3] = arr[:, :, :3]
+		if nbBands in (2, 4):
+			rgba[:, :, 3] = arr[:, :, -1]
+		else:
+			rgba[:, :, 3] = 255
+		return rgba
+
+
+	def getArrays(self, tiles):
+		"""
+		tiles = list of (x,y,z) tuple
+		return list of (x,y,z,array) tuple of the tiles available, in the same order as requested.
+		Arrays are read only views of the mapped file : copy them to keep them after the tile could be replaced
+		"""
+		if not tiles:
+			return []
+		query = "SELECT t.tile_column, t.tile_row, t.zoom_level, t.slot FROM request_tiles r JOIN raw_tiles t " \
+				"ON t.zoom_level = r.zoom_level AND t.tile_column = r.tile_column AND t.tile_row = r.tile_row " \
+				"WHERE julianday('now','localtime') - julianday(t.last_modified) < ? ORDER BY r.idx"
+		with self.connection() as db:
+			self.loadRequest(db, tiles)
+			result = db.execute(query, (self.MAX_DAYS,)).fetchall()
+		if not result:
+			return []
+		slots = self.mapSlots(max(slot for x, y, z, slot in result) + 1)
+		arrays = []
+		for x, y, z, slot in result:
+			arr = slots[slot].view(np.ndarray)
+			arr.flags.writeable = False
+			arrays.append((x, y, z, arr))
+		return arrays
+
+	def getTiles(self, tiles):
+		"""tiles = list of (x,y,z) tuple
+		return list of (x,y,z,array) tuple of the tiles available, in the same order as requested, arrays are RGBA copies"""
+		return [(x, y, z, arr.copy()) for x, y, z, arr in self.getArrays(tiles)]
+
+	def listExistingTiles(self, tiles):
+		"""
+		input : tiles list [(x,y,z)]
+		output : tiles list set [(x,y,z)] of existing records in the database"""
+		if not tiles:
+			return set()
+		query = "SELECT t.tile_column, t.tile_row, t.zoom_level FROM request_tiles r JOIN raw_tiles t " \
+				"ON t.zoom_level = r.zoom_level AND t.tile_column = r.tile_column AND t.tile_row = r.tile_row " \
+				"WHERE julianday('now','localtime') - julianday(t.last_modified) < ?"
+		with self.connection() as db:
+			self.loadRequest(db, tiles)
+			result = db.execute(query, (self.MAX_DAYS,)).fetchall()
+		return set(result)
+
+	def listMissingMarkers(self, tiles):
+		"""
+		input : tiles list [(x,y,z)]
+		output : tiles list set [(x,y,z)] recently marked as not available on the server"""
+		if not tiles:
+			return set()
+		query = "SELECT m.tile_column, m.tile_row, m.zoom_level FROM request_tiles r JOIN missing_tiles m " \
+				"ON m.zoom_level = r.zoom_level AND m.tile_column = r.tile_column AND m.tile_row = r.tile_row " \
+				"WHERE julianday('now','localtime') - julianday(m.last_modified) < ?"
+		with self.connection() as db:
+			self.loadRequest(db, tiles)
+			result = db.execute(query, (self.MISSING_MAX_DAYS,)).fetchall()
+		return set(result)
+
+	def listTilesToFetch(self, tiles):
+		"""Return the tiles to request : missing or expired, except those with a valid negative entry"""
+		missing = self.listMissingTiles(tiles)
+		if not missing:
+			return missing
+		return missing - self.listMissingMarkers(missing)
+
+	def prepareTiles(self, tiles):
+		'''Decode the tiles to RGBA arrays before they are written, corrupted tiles are logged and skipped'''
+		prepared = []
+		for tile in tiles:
+			x, y, z, data = tile[:4]
+			if data is not MISSING and data is not NOT_MODIFIED:
+				try:
+					data = self.toRGBA(data)
+				except Exception as e:
+					log.error('Unable to decode tile x{} y{} z{}'.format(x, y, z), exc_info=True)
+					continue
+			prepared.append( (x, y, z, data) )
+		return prepared
+
+	def writeTiles(self, db, tiles):
+		'''Insert tiles prepared by prepareTiles() and markers with an opened connection, the transaction is left to the caller'''
+		found, missing, notModified = [], [], []
+		for tile in tiles:
+			x, y, z, data = tile[:4]
+			if data is MISSING:
+				missing.append( (z, x, y) )
+			elif data is NOT_MODIFIED:
+				notModified.append( (z, x, y) )
+			else:
+				found.append( ((x, y, z), data) )
+		if notModified:
+			db.executemany("""UPDATE raw_tiles SET last_modified=datetime('now','localtime')
+			WHERE zoom_level=? AND tile_column=? AND tile_row=?""", notModified)
+		if missing:
+			db.executemany("""INSERT OR REPLACE INTO missing_tiles
+			(zoom_level, tile_column, tile_row) VALUES (?,?,?)""", missing)
+		if not found:
+			return
+		#a first write takes the database lock, so slots are not allocated twice by concurrent writers
+		db.execute('UPDATE raw_state SET nb_slots = nb_slots')
+		nbSlots = db.execute('SELECT nb_slots FROM raw_state').fetchone()[0]
+		slots = {}
+		for (x, y, z), arr in found:
+			if (x, y, z) in slots:
+				continue
+			row = db.execute('SELECT slot FROM raw_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?', (z, x, y)).fetchone()
+			if row is None:
+				slots[(x, y, z)] = nbSlots
+				nbSlots += 1
+			else:
+				slots[(x, y, z)] = row[0]
+		mapped = self.mapSlots(nbSlots)
+		for tile, arr in found:
+			mapped[slots[tile]] = arr
+		db.execute('UPDATE raw_state SET nb_slots = ?', (nbSlots,))
+		db.executemany("""INSERT OR REPLACE INTO raw_tiles (zoom_level, tile_column, tile_row, slot)
+			VALUES (?,?,?,?)""", [(z, x, y, slot) for (x, y, z), slot in slots.items()])
+		db.executemany("DELETE FROM missing_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", [(z, x, y) for x, y, z in slots])
+
+	def selectTiles(self, schema='main'):
+		raise NotImplementedError('Raw tiles cannot be copied with SQL, use convertToRaw()')
+
+	def copyStatements(self, source):
+		raise NotImplementedError('Raw tiles cannot be copied with SQL, use convertToRaw()')
+
+	def stats(self):
+		"""Return a dict with tiles count, tiles data bytes, number of allocated slots and number of missing tiles"""
+		with self.connection() as db:
+			nbTiles = db.execute('SELECT count(*) FROM raw_tiles').fetchone()[0]
+			nbSlots = db.execute('SELECT nb_slots FROM raw_state').fetchone()[0]
+			nbMissing = db.execute('SELECT count(*) FROM missing_tiles').fetchone()[0]
+		return {'tiles': nbTiles, 'bytes': nbTiles * self.slotSize, 'slots': nbSlots, 'missing': nbMissing}
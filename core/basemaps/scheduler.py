@@ -0,0 +1,164 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import logging
+log = logging.getLogger(__name__)
+
+import heapq
+import itertools
+import threading
+
+
+class TileScheduler():
+	'''
+	Thread safe priority queue of the tiles [(x,y,z)] to fetch, shared by the seeding workers
+
+	Tiles are served by zoom level (coarser first) then by distance to the center of the view,
+	so the visible center of a map is available first whatever the size of the request.
+	Queued tiles can be cancelled at any time (all of them or only the ones a new view does not need
+	anymore), tiles already handed to a worker are left in flight so their download is not wasted.
+
+	tm : the TileMatrix of the tiles
+	center : (x,y) coords of the view center in tile matrix crs, if None the center of the submited tiles is used
+	'''
+
+	def __init__(self, tm, tiles=None, center=None):
+		self.tm = tm
+		self.center = center
+		self.lock = threading.Lock()
+		self.heap = [] #[(priority, order, tile)]
+		self.queued = set()
+		self.inFlight = set()
+		self.order = itertools.count() #tie breaker, keep submission order for same priority
+		self.cancelled = False
+		if tiles:
+			self.put(tiles)
+
+	def __len__(self):
+		'''Number of queued tiles'''
+		with self.lock:
+			return len(self.queued)
+
+	def _tilesCenter(self, tiles):
+		bboxs = [self.tm.getTileBbox(*tile) for tile in tiles]
+		xmin = min(bbox[0] for bbox in bboxs)
+		ymin = min(bbox[1] for bbox in bboxs)
+		xmax = max(bbox[2] for bbox in bboxs)
+		ymax = max(bbox[3] for bbox in bboxs)
+		return ( (xmin + xmax) / 2, (ymin + ymax) / 2 )
+
+	def priority(self, tile):
+		'''Return the sort key of a tile : (zoom, squared distance from the view center in tiles)'''
+		col, row, zoom = tile
+		cx, cy = self.center
+		xmin, ymin, xmax, ymax = self.tm.getTileBbox(col, row, zoom)
+		geoTileSize = xmax - xmin
+		dx = ( (xmin + xmax) / 2 - cx ) / geoTileSize
+		dy = ( (ymin + ymax) / 2 - cy ) / geoTileSize
+		return (zoom, dx*dx + dy*dy)
+
+	def put(self, tiles):
+		'''Queue some tiles, those already queued or in flight are ignored'''
+		tiles = [tuple(tile) for tile in tiles]
+		if not tiles:
+			return
+		with self.lock:
+			if self.center is None:
+				self.center = self._tilesCenter(tiles)
+			self.cancelled = False
+			for tile in tiles:
+				if tile in self.queued or tile in self.inFlight:
+					continue
+				self.queued.add(tile)
+				heapq.heappush(self.heap, (self.priority(tile), next(self.order), tile))
+
+	def get(self):
+		'''Pop the most urgent tile and mark it in flight, return None if there is nothing left to do'''
+		with self.lock:
+			while self.heap:
+				_, _, tile = heapq.heappop(self.heap)
+				if tile in self.queued: #skip cancelled entries
+					self.queued.remove(tile)
+					self.inFlight.add(tile)
+					return tile
+			return None
+
+	def getBlock(self, size):
+		'''
+		Pop the most urgent tile and the other queued tiles of the same block of size x size tiles at its zoom level,
+		mark them in flight and return them, return an empty list if there is nothing left to do
+		'''
+		tile = self.get()
+		if tile is None:
+			return []
+		col, row, zoom = tile
+		key = (zoom, col // size, row // size)
+		with self.lock:
+			block = [t for t in self.queued if (t[2], t[0] // size, t[1] // size) == key]
+			self.queued.difference_update(block)
+			self.inFlight.update(block)
+		return [tile] + block
+
+	def done(self, tile):
+		'''Flag a tile returned by get() as processed'''
+		with self.lock:
+			self.inFlight.discard(tile)
+
+	def cancel(self, keep=None):
+		'''
+		Drop queued tiles, tiles in flight are not affected
+		keep : optional list of tiles still needed, they stay queued
+		return the number of dropped tiles
+		'''
+		with self.lock:
+			if keep is None:
+				n = len(self.queued)
+				self.queued.clear()
+				self.heap = []
+				self.cancelled = True
+			else:
+				keep = set(tuple(tile) for tile in keep)
+				stale = self.queued - keep
+				n = len(stale)
+				self.queued -= stale
+				self.heap = [entry for entry in self.heap if entry[2] in self.queued]
+				heapq.heapify(self.heap)
+		log.debug('{} queued tiles cancelled'.format(n))
+		return n
+
+	def recenter(self, center):
+		'''Move the view center and reorder the queued tiles accordingly'''
+		with self.lock:
+			self.center = center
+			self.heap = [(self.priority(tile), order, tile) for _, order, tile in self.heap if tile in self.queued]
+			heapq.heapify(self.heap)
+
+	def preempt(self, tiles, center=None):
+		'''
+		Switch to a new request : queued tiles not in the new list are cancelled,
+		the new tiles are queued and everything is reordered around the new center
+		'''
+		tiles = [tuple(tile) for tile in tiles]
+		if not tiles:
+			self.cancel()
+			return
+		self.cancel(keep=tiles)
+		self.recenter(center if center is not None else self._tilesCenter(tiles))
+		self.put(tiles)
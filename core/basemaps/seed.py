@@ -0,0 +1,280 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+'''
+Headless and resumable cache seeding, without Blender
+
+Run from the addon folder :
+	python -m core.basemaps.seed OSM MAPNIK --cache ~/gis_cache --bbox 5.8 45.1 6.2 45.4 --zoom 10-15
+
+Bboxs are given in --crs (default to lon/lat) or taken from the extent of a shapefile.
+The requested tiles are split in blocks of tiles (chunks) seeded one after the other, each completed
+chunk is appended to a journal so an interrupted job started again with the same arguments only
+processes the chunks left. A chunk is complete when all its tiles are in the cache or known to be
+missing on the server, so tiles that failed to download are retried by the next run.
+With --report, the coverage of the extents by the cache is printed instead, without downloading anything.
+'''
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import sys
+import math
+import json
+import time
+import signal
+import argparse
+import datetime
+import threading
+
+from .servicesDefs import GRIDS, SOURCES
+from .mapservice import MapService
+from .coverage import coverageReport, formatCoverageReport
+from ..proj.reproj import reprojBbox
+
+
+class SeedJob():
+	'''
+	Seed a layer cache over a list of bboxs and zoom levels by chunks of tiles, keeping a journal of the completed ones
+
+	srv : the MapService
+	bboxs : list of (xmin, ymin, xmax, ymax) in the crs of the cache tile matrix
+	zooms : list of zoom levels
+	journal : path of the journal file, default to a file next to the layer cache
+	chunkSize : approximative number of tiles of a chunk
+	out : stream of the progress messages, default to stderr
+	interval : seconds between two progress messages
+	'''
+
+	def __init__(self, srv, laykey, bboxs, zooms, toDstGrid=False, journal=None, chunkSize=1024,
+		nbThread=10, engine=None, out=None, interval=5):
+		self.srv = srv
+		self.laykey = laykey
+		self.bboxs = [tuple(bbox) for bbox in bboxs]
+		self.zooms = sorted(set(zooms))
+		self.toDstGrid = toDstGrid
+		self.chunkSize = max(1, chunkSize)
+		self.nbThread = nbThread
+		self.engine = engine
+		self.out = out if out is not None else sys.stderr
+		self.interval = interval
+		self.tm = srv.getTM(toDstGrid)
+		self.grdkey = srv.dstGridKey if toDstGrid else srv.srcGridKey
+		if journal is None:
+			journal = os.path.join(srv.cacheFolder, '{}_{}_{}.journal'.format(srv.srckey, laykey, self.grdkey))
+		self.journal = journal
+		#progress
+		self.nbTiles = 0 #tiles of the job
+		self.doneTiles = 0 #tiles of the completed chunks, including the ones of previous runs
+		self.startTiles = 0 #value of doneTiles when this run started
+		self.t0 = None
+		self.running = False
+
+	@property
+	def header(self):
+		'''Definition of the job, a journal is only resumed by the same job'''
+		return {
+			'source': self.srv.srckey,
+			'layer': self.laykey,
+			'grid': self.grdkey,
+			'bboxs': [list(bbox) for bbox in self.bboxs],
+			'zooms': self.zooms,
+			'chunk': self.chunkSize
+		}
+
+	def chunks(self):
+		'''Yield (key, tiles) of each chunk, coarser zoom levels first. key is [z, firstCol, lastCol, firstRow, lastRow]'''
+		side = max(1, math.isqrt(self.chunkSize))
+		for z in self.zooms:
+			for bbox in self.bboxs:
+				rq = self.srv.bboxRequest(bbox, z, self.toDstGrid)
+				cols, rows = rq.cols, rq.rows
+				for i in range(0, len(rows), side):
+					for j in range(0, len(cols), side):
+						cc, rr = cols[j:j+side], rows[i:i+side]
+						tiles = [(c, r, z) for r in rr for c in cc if self.srv.isTileInMapsBounds(c, r, z, self.tm)]
+						if tiles:
+							yield [z, cc[0], cc[-1], rr[0], rr[-1]], tiles
+
+	def loadJournal(self):
+		'''Return the keys of the chunks completed by previous runs, start a new journal if it belongs to another job'''
+		entries = []
+		if os.path.exists(self.journal):
+			with open(self.journal) as f:
+				lines = f.read().splitlines()
+			try:
+				header = json.loads(lines[0]) if lines else None
+			except ValueError:
+				header = None
+			if header == self.header:
+				for line in lines[1:]:
+					try:
+						entries.append(json.loads(line))
+					except ValueError:
+						break #last line truncated by a killed process
+			else:
+				log.warning('Journal {} belongs to another job, starting over'.format(self.journal))
+		#rewrite the journal so new entries never follow a truncated line
+		with open(self.journal, 'w') as f:
+			f.write(json.dumps(self.header) + '\n')
+			for entry in entries:
+				f.write(json.dumps(entry) + '\n')
+		return set(tuple(entry['done']) for entry in entries)
+
+	def logChunk(self, key, nbTiles):
+		with open(self.journal, 'a') as f:
+			f.write(json.dumps({'done': key, 'tiles': nbTiles}) + '\n')
+
+	def progress(self):
+		'''Return a progress message : tiles done, throughput and estimated remaining time'''
+		done = self.doneTiles + (self.srv.cptTiles if self.running else 0)
+		elapsed = time.monotonic() - self.t0
+		rate = (done - self.startTiles) / elapsed if elapsed > 0 else 0
+		if rate > 0:
+			eta = str(datetime.timedelta(seconds=int((self.nbTiles - done) / rate)))
+		else:
+			eta = '--:--:--'
+		percent = done / self.nbTiles if self.nbTiles else 1
+		return '{}/{} tiles ({:.1%}) - {:.1f} tiles/s - ETA {}'.format(done, self.nbTiles, percent, rate, eta)
+
+	def reportLoop(self):
+		while self.running:
+			time.sleep(0.1)
+			if time.monotonic() - self.lastReport >= self.interval:
+				print(self.progress(), file=self.out, flush=True)
+				self.lastReport = time.monotonic()
+
+	def stop(self):
+		'''Stop the job, the chunk in progress is completed by the next run'''
+		self.srv.stop()
+
+	def run(self):
+		'''
+		Seed the chunks not completed yet, return True if the job is complete
+		and False if it has been stopped or some tiles could not be downloaded
+		'''
+		done = self.loadJournal()
+		chunks = list(self.chunks())
+		self.nbTiles = sum(len(tiles) for key, tiles in chunks)
+		self.doneTiles = self.startTiles = sum(len(tiles) for key, tiles in chunks if tuple(key) in done)
+		todo = [(key, tiles) for key, tiles in chunks if tuple(key) not in done]
+		print('{} chunks, {} already done'.format(len(chunks), len(chunks) - len(todo)), file=self.out, flush=True)
+
+		cache = self.srv.getCache(self.laykey, self.toDstGrid)
+		self.t0 = self.lastReport = time.monotonic()
+		self.srv.running = self.running = True
+		reporter = threading.Thread(target=self.reportLoop, daemon=True)
+		reporter.start()
+		complete = True
+		try:
+			for key, tiles in todo:
+				self.srv.seedTiles(self.laykey, tiles, toDstGrid=self.toDstGrid, nbThread=self.nbThread, engine=self.engine)
+				if not self.srv.running:
+					complete = False
+					break
+				failed = cache.listTilesToFetch(tiles)
+				if failed:
+					log.warning('{} tiles of chunk {} could not be downloaded'.format(len(failed), key))
+					complete = False
+				else:
+					self.logChunk(key, len(tiles))
+				self.doneTiles += len(tiles)
+		finally:
+			self.running = False
+			self.srv.running = False
+			reporter.join()
+		print(self.progress(), file=self.out, flush=True)
+		return complete
+
+
+def parseZooms(value):
+	'''"12" or "10-15" to a list of zoom levels'''
+	zmin, _, zmax = value.partition('-')
+	zmin = int(zmin)
+	zmax = int(zmax) if zmax else zmin
+	return list(range(min(zmin, zmax), max(zmin, zmax) + 1))
+
+
+def shpExtent(path):
+	from ..lib.shapefile import Reader as shpReader
+	return tuple(shpReader(path).bbox)
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog='python -m core.basemaps.seed', description='Seed a basemap cache without Blender, an interrupted job resumes when started again')
+	parser.add_argument('source', choices=sorted(SOURCES), help='map service key')
+	parser.add_argument('layer', help='layer key of the map service')
+	parser.add_argument('--cache', required=True, help='cache folder')
+	parser.add_argument('--grid', choices=sorted(GRIDS), help='destination tile matrix, default to the one of the source')
+	parser.add_argument('--bbox', nargs=4, type=float, action='append', default=[], metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+		help='extent to seed, can be repeated')
+	parser.add_argument('--shp', action='append', default=[], help='seed the extent of a shapefile, can be repeated')
+	parser.add_argument('--crs', default='EPSG:4326', help='crs of the bboxs and shapefiles (default EPSG:4326)')
+	parser.add_argument('--zoom', type=parseZooms, required=True, help='zoom level or range of zoom levels, ie 10-15')
+	parser.add_argument('--threads', type=int, default=10, help='number of concurrent downloads')
+	parser.add_argument('--engine', choices=('THREAD', 'ASYNC'), help='seeding engine')
+	parser.add_argument('--chunk', type=int, default=1024, help='number of tiles of a journaled chunk')
+	parser.add_argument('--journal', help='journal file, default to a file next to the layer cache')
+	parser.add_argument('--interval', type=float, default=5, help='seconds between progress messages')
+	parser.add_argument('--report', action='store_true', help='print the coverage of the extents by the cache and exit, nothing is downloaded')
+	args = parser.parse_args(args)
+
+	if args.layer not in SOURCES[args.source]['layers']:
+		parser.error('unknown layer {} for source {}'.format(args.layer, args.source))
+	extents = [tuple(bbox) for bbox in args.bbox] + [shpExtent(path) for path in args.shp]
+	if not extents:
+		parser.error('at least one --bbox or --shp is required')
+
+	os.makedirs(args.cache, exist_ok=True)
+	srv = MapService(args.source, args.cache, dstGridKey=args.grid)
+	toDstGrid = srv.dstGridKey is not None
+	tm = srv.getTM(toDstGrid)
+	bboxs = [reprojBbox(args.crs, tm.CRS, bbox) if args.crs != tm.CRS else bbox for bbox in extents]
+	if args.report:
+		cache = srv.getCache(args.layer, toDstGrid)
+		for bbox in bboxs:
+			print(formatCoverageReport(coverageReport(cache, bbox, args.zoom)))
+		srv.close()
+		return 0
+	job = SeedJob(srv, args.layer, bboxs, args.zoom, toDstGrid=toDstGrid, journal=args.journal,
+		chunkSize=args.chunk, nbThread=args.threads, engine=args.engine, interval=args.interval)
+
+	#Ctrl+C or a kill let the tiles in flight be written to the cache before leaving
+	def interrupt(signum, frame):
+		print('Stopping, run the same command again to resume', file=sys.stderr, flush=True)
+		job.stop()
+	handlers = {}
+	if threading.current_thread() is threading.main_thread():
+		for signum in (signal.SIGINT, signal.SIGTERM):
+			handlers[signum] = signal.signal(signum, interrupt)
+
+	try:
+		complete = job.run()
+	finally:
+		for signum, handler in handlers.items():
+			signal.signal(signum, handler)
+		srv.close()
+	if not complete:
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
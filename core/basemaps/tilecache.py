@@ -0,0 +1,195 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import threading
+import weakref
+from collections import OrderedDict
+
+from .tilestore import tileHash
+
+
+class TileCache():
+	'''
+	Tiered tiles cache used by MapService : in memory decoded tiles > GeoPackage > network
+
+	The memory tier is a LRU of decoded numpy tiles shared by all the layers of a service and bounded
+	by a bytes budget, so panning over an already displayed area does not read nor decode anything.
+	Tiles missing in memory are read from the GeoPackage of the layer, after the ones missing there
+	have been fetched from the network by the caller supplied function (usually MapService.seedTiles).
+	Hits and misses of each tier are counted, see stats().
+	Identical tiles (same encoded data) are decoded once and share a same read-only array,
+	which is only counted once in the memory budget.
+	Decoded tiles expire like their GeoPackage copy (maxDays) counted from the time they were loaded,
+	and the ones downloaded again must be dropped with discard() so the new data is read.
+	'''
+
+	TIERS = ('memory', 'gpkg', 'network')
+
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self.nbBytes = 0
+		self.tiles = OrderedDict() #{(key, x, y, z) : array}, least recently used first
+		self.loaded = {} #{(key, x, y, z) : time the tile was loaded}
+		self.refs = {} #{id(array) : number of tiles sharing this array}
+		self.shared = weakref.WeakValueDictionary() #{(key, data hash) : array} of the decoded arrays still alive
+		self.lock = threading.Lock()
+		self.counters = {tier: [0, 0] for tier in self.TIERS} #[hits, misses]
+
+	def __len__(self):
+		return len(self.tiles)
+
+	def count(self, tier, hits=0, misses=0):
+		'''Increment the hits and misses counters of a tier'''
+		with self.lock:
+			self.counters[tier][0] += hits
+			self.counters[tier][1] += misses
+
+	def stats(self):
+		'''Return {tier : {'hits', 'misses'}} counters, plus the memory usage of the decoded tiles'''
+		with self.lock:
+			stats = {tier: {'hits': hits, 'misses': misses} for tier, (hits, misses) in self.counters.items()}
+			stats['memory'].update({'tiles': len(self.tiles), 'arrays': len(self.refs), 'bytes': self.nbBytes, 'maxBytes': self.maxBytes})
+		return stats
+
+	def getDecoded(self, key, tiles, maxDays=None):
+		'''
+		Return {(x,y,z) : array} of the requested tiles available in memory
+		key : identifier of the tiles set (layer and grid)
+		maxDays : optional lifetime of the decoded tiles, older ones are dropped
+		'''
+		found = {}
+		expired = None if maxDays is None else time.time() - maxDays * 86400
+		with self.lock:
+			for tile in tiles:
+				k = (key,) + tuple(tile)
+				arr = self.tiles.get(k)
+				if arr is not None and expired is not None and self.loaded[k] < expired:
+					self._drop(k)
+					arr = None
+				if arr is not None:
+					self.tiles.move_to_end(k)
+					found[tuple(tile)] = arr
+			self.counters['memory'][0] += len(found)
+			self.counters['memory'][1] += len(tiles) - len(found)
+		return found
+
+	def putDecoded(self, key, tile, arr):
+		'''Keep a decoded tile in memory, least recently used tiles are dropped to stay within the budget'''
+		if arr.nbytes > self.maxBytes:
+			return
+		k = (key,) + tuple(tile)
+		with self.lock:
+			if k in self.tiles:
+				self._drop(k)
+			self.tiles[k] = arr
+			self.loaded[k] = time.time()
+			self._hold(arr)
+			while self.nbBytes > self.maxBytes:
+				self._drop(next(iter(self.tiles)))
+
+	def _drop(self, k):
+		self.loaded.pop(k)
+		self._release(self.tiles.pop(k))
+
+	def _hold(self, arr):
+		n = self.refs.get(id(arr), 0)
+		if not n:
+			self.nbBytes += arr.nbytes
+		self.refs[id(arr)] = n + 1
+
+	def _release(self, arr):
+		n = self.refs[id(arr)] - 1
+		if n:
+			self.refs[id(arr)] = n
+		else:
+			del self.refs[id(arr)]
+			self.nbBytes -= arr.nbytes
+
+	def clear(self, key=None):
+		'''Drop the decoded tiles, all of them or only the ones of a tiles set'''
+		with self.lock:
+			if key is None:
+				self.tiles.clear()
+				self.loaded.clear()
+				self.refs.clear()
+				self.nbBytes = 0
+				return
+			for k in [k for k in self.tiles if k[0] == key]:
+				self._drop(k)
+
+	def discard(self, key, tiles):
+		'''Drop the decoded tiles [(x,y,z)] of a tiles set, for example because they have been downloaded again'''
+		with self.lock:
+			for tile in tiles:
+				k = (key,) + tuple(tile)
+				if k in self.tiles:
+					self._drop(k)
+
+	def decode(self, key, data, decode):
+		'''Return the decoded array of a tile data, reusing the array of an identical tile of the same tiles set if one is still in use'''
+		h = (key, tileHash(data))
+		arr = self.shared.get(h)
+		if arr is None:
+			arr = decode(data)
+			arr.flags.writeable = False #shared by all the identical tiles
+			with self.lock:
+				arr = self.shared.setdefault(h, arr)
+		return arr
+
+	def getTiles(self, key, gpkg, tiles, decode, fetch=None, map=map, maxDays=None):
+		'''
+		Return the decoded tiles [(x,y,z,array)] in request order, array is None if the tile data can not be decoded
+		gpkg : the GeoPackage holding the encoded tiles of this tiles set
+		decode : function returning a numpy array from tile bytes data
+		fetch : optional function called with the tiles missing in memory, it must store in the GeoPackage
+			the ones it can get from the network. If it returns False, the request is cancelled and only
+			the tiles found in memory are returned
+		map : map function used to decode the tiles, for example the one of a thread pool
+		maxDays : optional lifetime of the decoded tiles, usually the one of the GeoPackage
+		Tiles neither in memory nor in the GeoPackage are omitted.
+		'''
+		tiles = [tuple(tile) for tile in tiles]
+		found = self.getDecoded(key, tiles, maxDays)
+		missing = [tile for tile in tiles if tile not in found]
+		if missing:
+			if fetch is not None and fetch(missing) is False:
+				return [tile + (found[tile],) for tile in tiles if tile in found]
+			encoded = gpkg.getTiles(missing)
+
+			def load(data):
+				try:
+					return self.decode(key, data, decode)
+				except Exception as e:
+					log.error('Corrupted tile on cache', exc_info=True)
+					return None
+
+			#identical tiles of the request are decoded only once
+			distinct = list({tile[3]: None for tile in encoded})
+			arrays = dict(zip(distinct, map(load, distinct)))
+			for x, y, z, data in encoded:
+				arr = arrays[data]
+				if arr is not None:
+					self.putDecoded(key, (x, y, z), arr)
+				found[(x, y, z)] = arr
+		return [tile + (found[tile],) for tile in tiles if tile in found]
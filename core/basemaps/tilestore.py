@@ -0,0 +1,467 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import math
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+
+#Markers that can be submited instead of tile data to putTiles() or to a writer
+MISSING = 'MISSING' #the server has no valid data for this tile (negative cache entry)
+NOT_MODIFIED = 'NOT_MODIFIED' #the server confirmed the cached tile is still valid, only refresh its timestamp
+
+
+def tileHash(data):
+	'''Content hash of a tile data, used to store and decode identical tiles only once'''
+	return hashlib.blake2b(data, digest_size=20).digest()
+
+
+def isBusyError(e):
+	'''True if a sqlite error is due to a lock held by another connection, the operation can be tried again'''
+	msg = str(e)
+	return isinstance(e, sqlite3.OperationalError) and ('locked' in msg or 'busy' in msg)
+
+
+class TileStore():
+	'''
+	Base class of the sqlite tiles storage backends (GeoPackage, MBTiles)
+
+	Tiles are always exchanged as (x,y,z) numbers of the TileMatrix given at init, whatever the way a backend
+	stores the rows. Subclasses define the name of their tiles table (TABLE), the rows order they use
+	on disk (rowsFromTop) and implement getTiles, listExistingTiles and writeTiles.
+	This base class handles the pool of sqlite connections shared by all threads.
+
+	Several processes can share a store : writes wait for the lock of another process (BUSY_TIMEOUT)
+	and are retried if it is still held, and tiles being downloaded are claimed (see claimTiles)
+	so the other processes wait for them instead of downloading them again.
+	'''
+
+	TABLE = None #name of the table (or view) with zoom_level, tile_column, tile_row and tile_data columns
+
+	#Connections settings
+	POOL_SIZE = 8 #max number of idle connections kept open
+	MMAP_SIZE = 256 * 1024 * 1024 #memory mapped I/O size in bytes, 0 to disable
+	CACHED_STATEMENTS = 64 #number of prepared statements kept by each connection
+
+	#Sharing settings
+	BUSY_TIMEOUT = 30 #seconds a statement waits for a lock held by another connection
+	RETRIES = 3 #number of times a write transaction is tried again after a busy timeout
+	RETRY_DELAY = 0.5 #seconds before the first retry, doubled at each attempt
+	CLAIM_TTL = 120 #seconds a claim stays valid if it is not refreshed, the claims of a killed process expire
+	CLAIM_POLL = 0.5 #seconds between two checks of the tiles claimed by another process
+	CLAIM_WAIT = 40 #maximum number of checks before the tiles still claimed by another process are fetched locally
+
+	def __init__(self, path, tm):
+		self.dbPath = path
+		self.name = os.path.splitext(os.path.basename(path))[0]
+
+		#Pool of long-lived connections shared by all threads, see connection()
+		self.pool = []
+		self.poolLock = threading.Lock()
+
+		#Tiles claimed by this store, see claimTiles()
+		self.owner = uuid.uuid4().hex
+		self.claimed = set()
+		self.claimsLock = threading.Lock()
+
+		#Get props from TileMatrix object
+		self.tm = tm
+		self.auth, self.code = tm.CRS.split(':')
+		self.code = int(self.code)
+		self.tileSize = tm.tileSize
+		self.xmin, self.ymin, self.xmax, self.ymax = tm.globalbbox
+		self.resolutions = tm.getResList()
+		self.originLoc = tm.originLoc
+
+	def __del__(self):
+		self.close()
+
+	@property
+	def CRS(self):
+		return '{}:{}'.format(self.auth, self.code)
+
+	@property
+	def rowsFromTop(self):
+		'''True if the stored tile_row numbers start from the top of the tile matrix'''
+		return self.originLoc == 'NW'
+
+	def matrixWidth(self, zoom):
+		return math.ceil( (self.xmax - self.xmin) / (self.tileSize * self.resolutions[zoom]) )
+
+	def matrixHeight(self, zoom):
+		return math.ceil( (self.ymax - self.ymin) / (self.tileSize * self.resolutions[zoom]) )
+
+	def openConnection(self):
+		"""
+		Open a new connection to the database, tuned for a tiles cache :
+		WAL journal (readers do not block the writer), relaxed synchronous mode and memory mapped reads.
+		The connection can be used by any thread, but not by two threads at the same time.
+		"""
+		db = sqlite3.connect(self.dbPath, timeout=self.BUSY_TIMEOUT, check_same_thread=False, cached_statements=self.CACHED_STATEMENTS)
+		db.execute('PRAGMA journal_mode=WAL')
+		db.execute('PRAGMA synchronous=NORMAL')
+		db.execute('PRAGMA mmap_size={}'.format(int(self.MMAP_SIZE)))
+		#connection private table holding the tiles of a request, see loadRequest()
+		db.execute('PRAGMA temp_store=MEMORY')
+		db.execute('CREATE TEMP TABLE request_tiles (idx INTEGER PRIMARY KEY, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER)')
+		return db
+
+	@staticmethod
+	def loadRequest(db, tiles):
+		"""
+		Fill the temporary request_tiles table of a connection with a list of tiles [(x,y,z)]
+		so queries can join exactly the requested set instead of reading a whole bounding range.
+		idx column keeps the request order.
+		"""
+		with db:
+			db.execute('DELETE FROM request_tiles')
+			db.executemany('INSERT INTO request_tiles (zoom_level, tile_column, tile_row) VALUES (?,?,?)', ((z, x, y) for x, y, z in tiles))
+
+	@contextmanager
+	def connection(self):
+		"""
+		Borrow a connection from the pool, usage : with store.connection() as db: ...
+		A new connection is opened if all pooled ones are in use, and closed on release if the pool is full.
+		"""
+		with self.poolLock:
+			db = self.pool.pop() if self.pool else None
+		if db is None:
+			db = self.openConnection()
+		try:
+			yield db
+		finally:
+			if db.in_transaction: #never give back a connection with a pending transaction
+				db.rollback()
+			with self.poolLock:
+				if len(self.pool) < self.POOL_SIZE:
+					self.pool.append(db)
+					db = None
+			if db is not None:
+				db.close()
+
+	def close(self):
+		"""Close the pooled connections, a later request will open new ones"""
+		pool = getattr(self, 'pool', None)
+		if not pool:
+			return
+		with self.poolLock:
+			pool, self.pool = self.pool, []
+		for db in pool:
+			db.close()
+
+
+	def getTile(self, x, y, z):
+		'''return tile data if tile exists otherwise return None'''
+		tiles = self.getTiles([(x, y, z)])
+		if not tiles:
+			return None
+		return tiles[0][3]
+
+	def hasTile(self, x, y, z):
+		return self.getTile(x, y, z) is not None
+
+	def getTiles(self, tiles):
+		"""tiles = list of (x,y,z) tuple
+		return list of (x,y,z,data) tuple of the tiles available, in the same order as requested"""
+		raise NotImplementedError
+
+	def listExistingTiles(self, tiles):
+		"""
+		input : tiles list [(x,y,z)]
+		output : tiles list set [(x,y,z)] of existing records in the database"""
+		raise NotImplementedError
+
+	def listMissingTiles(self, tiles):
+		existing = self.listExistingTiles(tiles)
+		return set(tiles) - existing # difference
+
+	def listTilesToFetch(self, tiles):
+		"""Return the tiles to request from the map service"""
+		if not tiles:
+			return set()
+		return self.listMissingTiles(tiles)
+
+	def getValidators(self, tiles):
+		"""Return {(x,y,z) : (etag, last_modified)} http validators of the stored tiles, if the backend records them"""
+		return {}
+
+	def writeTiles(self, db, tiles):
+		'''Insert tiles and markers with an opened connection, the transaction is left to the caller'''
+		raise NotImplementedError
+
+	def prepareTiles(self, tiles):
+		'''
+		Return the tiles in the form writeTiles expects, called before the write transaction and without any lock held
+		so a backend converting the tiles data (see RawTileStore) does not block the other threads meanwhile
+		'''
+		return tiles
+
+	def putTile(self, x, y, z, data):
+		self.putTiles([(x, y, z, data)])
+
+	def putTiles(self, tiles):
+		"""
+		tiles = list of (x,y,z,data) or (x,y,z,data,etag,last_modified) tuple
+		data can also be one of the MISSING or NOT_MODIFIED markers"""
+		tiles = self.prepareTiles(tiles)
+		with self.connection() as db:
+			self.retry(self.writeBatch, db, tiles)
+
+	def writeBatch(self, db, tiles):
+		'''Write tiles in a single transaction and release the claims on them'''
+		with db: #one transaction, commit on success or rollback on error
+			self.writeTiles(db, tiles)
+			self.updateClaims(db, tiles)
+
+	def retry(self, func, *args):
+		'''Call func(*args), again after a delay if it failed because another process held the database lock'''
+		delay = self.RETRY_DELAY
+		for attempt in range(self.RETRIES + 1):
+			try:
+				return func(*args)
+			except sqlite3.OperationalError as e:
+				if not isBusyError(e) or attempt == self.RETRIES:
+					raise
+				log.warning('Cache {} is locked by another process, retrying in {}s'.format(self.name, delay))
+				time.sleep(delay)
+				delay *= 2
+
+	def _createClaimsTable(self, db):
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS tile_claims (
+				zoom_level INTEGER NOT NULL,
+				tile_column INTEGER NOT NULL,
+				tile_row INTEGER NOT NULL,
+				owner TEXT NOT NULL,
+				expires DOUBLE NOT NULL,
+				PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID;
+		""")
+
+	def claimTiles(self, tiles):
+		'''
+		Advisory claim of tiles [(x,y,z)] before downloading them
+		return (claimed, awaited) : the tiles now claimed by this store, to be fetched then written or released
+		with releaseClaims(), and the tiles already claimed by another process, see waitTiles()
+		'''
+		tiles = set(tiles)
+		if not tiles:
+			return set(), set()
+
+		def claim(db):
+			with db:
+				self._createClaimsTable(db)
+				now = time.time()
+				db.execute('DELETE FROM tile_claims WHERE expires < ?', (now,))
+				db.executemany('INSERT OR IGNORE INTO tile_claims VALUES (?,?,?,?,?)',
+					[(z, x, y, self.owner, now + self.CLAIM_TTL) for x, y, z in tiles])
+				return set((x, y, z) for z, x, y in db.execute('SELECT zoom_level, tile_column, tile_row FROM tile_claims WHERE owner=?', (self.owner,)))
+
+		with self.connection() as db:
+			owned = self.retry(claim, db)
+		claimed = tiles & owned
+		with self.claimsLock:
+			self.claimed |= claimed
+		return claimed, tiles - claimed
+
+	def updateClaims(self, db, tiles):
+		'''Release the claims on written tiles and extend the other claims of this store, in the pending transaction'''
+		with self.claimsLock:
+			if not self.claimed:
+				return
+			written = set(tile[:3] for tile in tiles) & self.claimed
+			self.claimed -= written
+			left = bool(self.claimed)
+		db.executemany('DELETE FROM tile_claims WHERE zoom_level=? AND tile_column=? AND tile_row=? AND owner=?',
+			[(z, x, y, self.owner) for x, y, z in written])
+		if left:
+			db.execute('UPDATE tile_claims SET expires=? WHERE owner=?', (time.time() + self.CLAIM_TTL, self.owner))
+
+	def releaseClaims(self, tiles):
+		'''Release the claims on tiles that will not be written, ie their download failed'''
+		with self.claimsLock:
+			tiles = set(tiles) & self.claimed
+			self.claimed -= tiles
+		if not tiles:
+			return
+
+		def release(db):
+			with db:
+				db.executemany('DELETE FROM tile_claims WHERE zoom_level=? AND tile_column=? AND tile_row=? AND owner=?',
+					[(z, x, y, self.owner) for x, y, z in tiles])
+
+		with self.connection() as db:
+			self.retry(release, db)
+
+	def waitTiles(self, tiles, stop=None):
+		'''
+		Wait for the tiles claimed by other processes to be written
+		stop : optional function, the wait is cancelled as soon as it returns True
+		return the tiles still to fetch : their claims have been released or have expired, or they are still
+		claimed after CLAIM_WAIT checks (a long seeding in another process can keep claims on tiles it will reach late)
+		'''
+		pending = set(tiles)
+		for i in range(self.CLAIM_WAIT):
+			if not pending or (stop is not None and stop()):
+				break
+			time.sleep(self.CLAIM_POLL)
+			pending = self.listTilesToFetch(list(pending))
+			with self.connection() as db:
+				claims = set((x, y, z) for z, x, y in db.execute('SELECT zoom_level, tile_column, tile_row FROM tile_claims ' \
+					'WHERE owner != ? AND expires >= ?', (self.owner, time.time())))
+			if not pending & claims:
+				break
+		return pending
+
+	def selectTiles(self, schema='main'):
+		'''SQL query of all the stored tiles as zoom_level, tile_column, tile_row, tile_data and rid (rowid in the tiles table)'''
+		return "SELECT zoom_level, tile_column, tile_row, tile_data, rowid AS rid FROM {}.{}".format(schema, self.TABLE)
+
+	def copyStatements(self, source):
+		'''
+		SQL statements inserting the tiles returned by the source query (zoom_level, tile_column, tile_row, tile_data
+		with rows numbered like this store), the rowcount of the last statement is the number of inserted tiles
+		'''
+		return ["INSERT OR REPLACE INTO main.{} (zoom_level, tile_column, tile_row, tile_data) {}".format(self.TABLE, source)]
+
+	def writer(self, **kwargs):
+		'''Return a write-behind TileWriter for this store, see TileWriter for parameters'''
+		return TileWriter(self, **kwargs)
+
+
+class TileWriter():
+	'''
+	Write-behind tiles writer for a TileStore
+
+	Tiles are accumulated in memory and inserted by batch, each batch in a single transaction
+	through one long-lived connection opened in WAL mode. A batch is written as soon as one of the
+	limits is reached : number of tiles, cumulated bytes size or time elapsed since the oldest
+	buffered tile, the latter is also checked by a timer so tiles are written even if no other tile
+	comes. Remaining tiles are written with flush() or close().
+
+	The writer can be fed from several threads. The optional lock is held while writing a batch,
+	so writes can be serialized with other cache operations.
+	'''
+
+	def __init__(self, store, maxTiles=1000, maxBytes=32*1024*1024, maxDelay=2, lock=None):
+		self.store = store
+		self.maxTiles = maxTiles
+		self.maxBytes = maxBytes
+		self.maxDelay = maxDelay
+		self.extLock = lock
+		self.lock = threading.Lock()
+		self.buffer = []
+		self.nbBytes = 0
+		self.t0 = None #time of the oldest buffered tile
+		self.timer = None #writes the buffer maxDelay after t0
+		self.nbTiles = 0 #total number of tiles written
+		self.nbBatches = 0
+		self.db = store.openConnection()
+
+	def put(self, x, y, z, data, etag=None, modified=None):
+		self.putTiles([(x, y, z, data, etag, modified)])
+
+	def putTiles(self, tiles):
+		'''tiles = list of (x,y,z,data) or (x,y,z,data,etag,last_modified) tuple, see TileStore.putTiles()'''
+		#converted in the calling thread, outside of the writer and external locks
+		tiles = self.store.prepareTiles(tiles)
+		with self.lock:
+			if self.db is None:
+				raise IOError('Tiles writer is closed')
+			if self.t0 is None:
+				self.t0 = time.monotonic()
+				self._arm(self.maxDelay)
+			self.buffer.extend(tiles)
+			self.nbBytes += sum(len(t[3]) if isinstance(t[3], bytes) else getattr(t[3], 'nbytes', 0) for t in tiles)
+			if len(self.buffer) >= self.maxTiles or self.nbBytes >= self.maxBytes \
+			or time.monotonic() - self.t0 >= self.maxDelay:
+				self._write()
+
+	def _write(self):
+		if not self.buffer:
+			return
+		if self.extLock is not None:
+			self.extLock.acquire()
+		try:
+			self.store.retry(self.store.writeBatch, self.db, self.buffer)
+		finally:
+			if self.extLock is not None:
+				self.extLock.release()
+		self.nbTiles += len(self.buffer)
+		self.nbBatches += 1
+		self.buffer = []
+		self.nbBytes = 0
+		self.t0 = None
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+
+	def _arm(self, delay):
+		self.timer = threading.Timer(delay, self._writeLate)
+		self.timer.daemon = True
+		self.timer.start()
+
+	def _writeLate(self):
+		with self.lock:
+			#the buffer may have been written meanwhile, and new tiles buffered since
+			if self.db is None or self.t0 is None:
+				return
+			delay = self.t0 + self.maxDelay - time.monotonic()
+			if delay > 0:
+				if self.timer is threading.current_thread(): #woken up a bit early
+					self._arm(delay)
+				return
+			try:
+				self._write()
+			except Exception as e:
+				#tiles are kept in the buffer, the error is raised by the next put or by close()
+				log.warning('Unable to write the tiles buffered for {}s : {}'.format(self.maxDelay, e))
+
+	def flush(self):
+		'''Write all buffered tiles'''
+		with self.lock:
+			if self.db is not None:
+				self._write()
+
+	def close(self):
+		'''Flush and close the connection'''
+		with self.lock:
+			if self.db is None:
+				return
+			try:
+				self._write()
+			finally:
+				if self.timer is not None:
+					self.timer.cancel()
+					self.timer = None
+				self.db.close()
+				self.db = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
@@ -0,0 +1,152 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from .tilestore import tileHash
+from .gpkg import GeoPackage
+from .mbtiles import MBTiles
+from .rawstore import RawTileStore
+
+
+def openTileStore(path, tm, **kwargs):
+	'''Open or create the tile store matching the file extension, .mbtiles, .raw or GeoPackage for anything else'''
+	ext = os.path.splitext(path)[1].lower()
+	if ext == '.mbtiles':
+		return MBTiles(path, tm, **kwargs)
+	if ext == '.raw':
+		return RawTileStore(path, tm, **kwargs)
+	return GeoPackage(path, tm, **kwargs)
+
+
+def checkCompatibility(src, dst):
+	'''Raise a ValueError if the tiles of src cannot be copied as is into dst'''
+	if src.CRS != dst.CRS:
+		raise ValueError('Cannot copy tiles from {} to {}'.format(src.CRS, dst.CRS))
+	if src.tileSize != dst.tileSize:
+		raise ValueError('Cannot copy {}px tiles to a {}px tile matrix'.format(src.tileSize, dst.tileSize))
+	srcBbox = (src.xmin, src.ymin, src.xmax, src.ymax)
+	dstBbox = (dst.xmin, dst.ymin, dst.xmax, dst.ymax)
+	if not all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6) for a, b in zip(srcBbox, dstBbox)):
+		raise ValueError('Tile matrix extents do not match')
+	for z, (r1, r2) in enumerate(zip(src.resolutions, dst.resolutions)):
+		if not math.isclose(r1, r2, rel_tol=1e-9):
+			raise ValueError('Resolutions of zoom level {} do not match'.format(z))
+
+
+def copyTiles(src, dst, zooms=None, batchSize=5000):
+	'''
+	Bulk copy the tiles of a TileStore into another one (GeoPackage or MBTiles) without decoding them
+
+	The source database is attached to a connection of the destination and tiles are transfered with
+	INSERT ... SELECT statements, each one moving a batch of source rows (paginated by rowid) in its own
+	transaction, so memory use stays flat whatever the size of the cache. Rows are flipped in SQL when
+	the two stores do not number them from the same side. Existing tiles of the destination are replaced,
+	and they are hashed in SQL if it uses a deduplicated layout.
+	zooms : optional list of the zoom levels to copy, all by default
+	return the number of copied tiles
+	'''
+	checkCompatibility(src, dst)
+	levels = range(min(len(src.resolutions), len(dst.resolutions)))
+	if zooms is not None:
+		levels = [z for z in levels if z in zooms]
+	if src.rowsFromTop != dst.rowsFromTop:
+		row = 'h.height - 1 - s.tile_row'
+	else:
+		row = 's.tile_row'
+	source = "SELECT s.zoom_level, s.tile_column, {} AS tile_row, s.tile_data FROM ({}) s " \
+			"JOIN copy_levels h ON h.zoom_level = s.zoom_level " \
+			"WHERE s.rid > ? AND s.rid <= ?".format(row, src.selectTiles('src'))
+	statements = dst.copyStatements(source)
+	nextBound = "SELECT max(rowid) FROM (SELECT rowid FROM src.{} WHERE rowid > ? ORDER BY rowid LIMIT ?)".format(src.TABLE)
+
+	nbTiles = 0
+	with dst.connection() as db:
+		db.create_function('tile_hash', 1, tileHash, deterministic=True)
+		db.execute('ATTACH DATABASE ? AS src', (src.dbPath,))
+		try:
+			with db:
+				db.execute('CREATE TEMP TABLE IF NOT EXISTS copy_levels (zoom_level INTEGER PRIMARY KEY, height INTEGER)')
+				db.execute('DELETE FROM copy_levels')
+				#rows are flipped with the height of the matrix on the side of the TMS numbering
+				db.executemany('INSERT INTO copy_levels VALUES (?,?)', [(z, dst.matrixHeight(z)) for z in levels])
+			lower = -1
+			while True:
+				upper = db.execute(nextBound, (lower, batchSize)).fetchone()[0]
+				if upper is None:
+					break
+				with db:
+					for statement in statements:
+						count = db.execute(statement, (lower, upper)).rowcount
+				nbTiles += count
+				lower = upper
+		finally:
+			db.execute('DETACH DATABASE src')
+	log.info('{} tiles copied from {} to {}'.format(nbTiles, src.name, dst.name))
+	return nbTiles
+
+
+def convertToRaw(src, dst, zooms=None, batchSize=256, nbThread=None):
+	'''
+	Fill a RawTileStore with the tiles of a GeoPackage or MBTiles store
+
+	Tiles are read by batches of source rows (paginated by rowid), decoded in parallel
+	and written to the raw store, existing tiles of the destination are replaced.
+	zooms : optional list of the zoom levels to convert, all by default
+	return the number of converted tiles
+	'''
+	checkCompatibility(src, dst)
+	query = "SELECT s.zoom_level, s.tile_column, s.tile_row, s.tile_data, s.rid FROM ({}) s " \
+			"WHERE s.rid > ? ORDER BY s.rid LIMIT ?".format(src.selectTiles())
+	flip = src.rowsFromTop != dst.rowsFromTop
+
+	def decode(row):
+		z, x, y, data = row[:4]
+		try:
+			return dst.toRGBA(data)
+		except Exception as e:
+			log.error('Unable to decode tile x{} y{} z{} of {}'.format(x, y, z, src.name), exc_info=True)
+			return None
+
+	nbTiles = 0
+	lower = -1
+	with ThreadPoolExecutor(max_workers=nbThread) as pool:
+		while True:
+			with src.connection() as db:
+				rows = db.execute(query, (lower, batchSize)).fetchall()
+			if not rows:
+				break
+			lower = rows[-1][4]
+			if zooms is not None:
+				rows = [row for row in rows if row[0] in zooms]
+			tiles = []
+			for (z, x, y, data, rid), arr in zip(rows, pool.map(decode, rows)):
+				if arr is None:
+					continue
+				if flip:
+					y = dst.matrixHeight(z) - 1 - y
+				tiles.append( (x, y, z, arr) )
+			dst.putTiles(tiles)
+			nbTiles += len(tiles)
+	log.info('{} tiles converted from {} to {}'.format(nbTiles, src.name, dst.name))
+	return nbTiles
@@ -0,0 +1,240 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import threading
+import http.client
+import urllib.request
+import urllib.error
+import urllib.parse
+
+
+# Default pool parameters
+POOL_SIZE = 10 #maximum number of idle connections kept open for each host
+MAX_PER_HOST = 10 #maximum number of simultaneous connections opened to the same host
+IDLE_TIMEOUT = 30 #seconds after which an idle connection is discarded instead of reused
+MAX_REDIRECTS = 5
+
+# Errors raised by http.client when the server has silently closed a keep-alive connection
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+	http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+
+class Response():
+	'''Minimal http response returned by transports'''
+
+	def __init__(self, url, status, headers, data):
+		self.url = url
+		self.status = status
+		self.headers = headers #dict with lower case keys
+		self.data = data
+
+	@property
+	def ok(self):
+		return 200 <= self.status < 300
+
+	def __repr__(self):
+		return 'Response({}, {}, {} bytes)'.format(self.status, self.url, len(self.data or b''))
+
+
+class Transport():
+	'''
+	Base class of the layer used by MapService to fetch tiles
+	Subclasses must implement request() and can override close()
+	'''
+
+	def request(self, url, headers=None, timeout=None):
+		'''Perform a GET request and return a Response object, raise on network error'''
+		raise NotImplementedError
+
+	def get(self, url, headers=None, timeout=None):
+		'''Return the body of a successful request, raise on network or http error'''
+		r = self.request(url, headers, timeout)
+		if not r.ok:
+			raise urllib.error.HTTPError(url, r.status, 'HTTP error {}'.format(r.status), r.headers, None)
+		return r.data
+
+	def close(self):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class UrllibTransport(Transport):
+	'''Open a new connection for each request (no keep-alive), also handle non http schemes like file://'''
+
+	def request(self, url, headers=None, timeout=None):
+		req = urllib.request.Request(url, None, headers or {})
+		try:
+			handle = urllib.request.urlopen(req, timeout=timeout)
+		except urllib.error.HTTPError as e:
+			#http errors are returned as a response, as with the pooled transport
+			data = e.read()
+			e.close()
+			return Response(url, e.code, {k.lower():v for k, v in e.headers.items()}, data)
+		with handle:
+			data = handle.read()
+			status = getattr(handle, 'status', None) or 200
+			headers = {k.lower():v for k, v in handle.headers.items()}
+		return Response(url, status, headers, data)
+
+
+class _HostPool():
+	'''Idle connections and connection count of one (scheme, host, port)'''
+
+	def __init__(self, maxPerHost):
+		self.idle = [] #[(conn, lastUsedTime)]
+		self.slots = threading.BoundedSemaphore(maxPerHost)
+
+
+class PooledTransport(Transport):
+	'''
+	Keep persistent http(s) connections to each host and reuse them between requests
+	to avoid paying a TCP (and TLS) handshake for every tile.
+
+	Instances are thread safe : each thread checks out its own connection from the host pool
+	so several downloading workers can share the same transport.
+
+	poolSize : maximum number of idle connections kept open for a host
+	maxPerHost : maximum number of connections simultaneously opened to the same host,
+		requests beyond this limit wait for a connection to be released
+	idleTimeout : idle connections older than this number of seconds are closed instead of reused
+	'''
+
+	def __init__(self, poolSize=POOL_SIZE, maxPerHost=MAX_PER_HOST, idleTimeout=IDLE_TIMEOUT):
+		self.poolSize = poolSize
+		self.maxPerHost = maxPerHost
+		self.idleTimeout = idleTimeout
+		self.pools = {}
+		self.lock = threading.Lock()
+		#plain urllib is used for other schemes and when a proxy is configured
+		self.fallback = UrllibTransport()
+		self.proxies = urllib.request.getproxies()
+		#some stats
+		self.nbConnections = 0
+		self.nbRequests = 0
+
+	def _getPool(self, key):
+		with self.lock:
+			pool = self.pools.get(key)
+			if pool is None:
+				pool = _HostPool(self.maxPerHost)
+				self.pools[key] = pool
+			return pool
+
+	def _checkout(self, key, pool, timeout):
+		'''Return an (conn, reused) tuple, an existing idle connection is used when possible'''
+		now = time.monotonic()
+		with self.lock:
+			while pool.idle:
+				conn, lastUsed = pool.idle.pop()
+				if now - lastUsed < self.idleTimeout:
+					conn.timeout = timeout
+					return conn, True
+				conn.close()
+		scheme, host, port = key
+		if scheme == 'https':
+			conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+		else:
+			conn = http.client.HTTPConnection(host, port, timeout=timeout)
+		with self.lock:
+			self.nbConnections += 1
+		return conn, False
+
+	def _release(self, pool, conn):
+		with self.lock:
+			if len(pool.idle) < self.poolSize:
+				pool.idle.append( (conn, time.monotonic()) )
+				return
+		conn.close()
+
+	def _useFallback(self, scheme, host):
+		if scheme not in ('http', 'https'):
+			return True
+		if scheme in self.proxies and not urllib.request.proxy_bypass(host):
+			return True
+		return False
+
+	def request(self, url, headers=None, timeout=None, _redirects=0):
+		u = urllib.parse.urlsplit(url)
+		scheme = u.scheme.lower()
+		if self._useFallback(scheme, u.hostname or ''):
+			return self.fallback.request(url, headers, timeout)
+
+		port = u.port or (443 if scheme == 'https' else 80)
+		key = (scheme, u.hostname, port)
+		path = u.path or '/'
+		if u.query:
+			path += '?' + u.query
+		hdrs = dict(headers or {})
+		hdrs.pop('Proxy-Connection', None)
+		hdrs['Connection'] = 'keep-alive'
+
+		pool = self._getPool(key)
+		pool.slots.acquire()
+		try:
+			while True:
+				conn, reused = self._checkout(key, pool, timeout)
+				try:
+					conn.request('GET', path, headers=hdrs)
+					resp = conn.getresponse()
+					data = resp.read()
+				except STALE_ERRORS:
+					conn.close()
+					if reused:
+						#the server closed this keep-alive connection in the meantime, retry with a new one
+						continue
+					raise
+				except Exception:
+					conn.close()
+					raise
+				break
+			with self.lock:
+				self.nbRequests += 1
+			rHeaders = {k.lower():v for k, v in resp.getheaders()}
+			if resp.will_close:
+				conn.close()
+			else:
+				self._release(pool, conn)
+		finally:
+			pool.slots.release()
+
+		if resp.status in (301, 302, 303, 307, 308) and 'location' in rHeaders:
+			if _redirects >= MAX_REDIRECTS:
+				raise urllib.error.HTTPError(url, resp.status, 'Too many redirections', rHeaders, None)
+			location = urllib.parse.urljoin(url, rHeaders['location'])
+			return self.request(location, headers, timeout, _redirects+1)
+
+		return Response(url, resp.status, rHeaders, data)
+
+	def close(self):
+		'''Close all idle connections'''
+		with self.lock:
+			for pool in self.pools.values():
+				for conn, lastUsed in pool.idle:
+					conn.close()
+				pool.idle = []
@@ -2,4 +2,5 @@ from .georef import GeoRef
 from .georaster import GeoRaster
 from .npimg import NpImage
 from .bigtiffwriter import BigTiffWriter
+from .geotiffwriter import GeoTiffWriter
 from .img_utils import getImgFormat, getImgDim, isValidStream
@@ -0,0 +1,319 @@
+# -*- coding:utf-8 -*-
+
+# This file is part of BlenderGIS
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import struct
+import zlib
+import numpy as np
+
+from .npimg import NpImage
+from ..lib.Tyf import ifd, gkd, TYPES
+
+
+# Classic tiff offsets are 32 bits, above this size (including some room for the ifd) switch to BigTIFF
+CLASSIC_TIFF_MAX_SIZE = 2**32 - 2**24
+
+# Tiff tag types not handled by Tyf
+LONG8 = 16
+
+
+class GeoTiffWriter():
+	'''
+	Write a tiled and georeferenced tiff file with only numpy and zlib (no GDAL dependency)
+
+	Data must be pasted from top to bottom : the writer only keeps in memory one row of tiff tiles,
+	each time a paste reaches a new row of tiles, the previous ones are compressed and appended
+	to the file. Tile offsets and tags are written at the end of the file when closing.
+	Compression is DEFLATE, the file is written as BigTIFF when it can exceed 4GB.
+	Georeferencing uses GeoTIFF keys (ModelTiepoint + ModelPixelScale) built with Tyf.
+	'''
+
+	def __del__(self):
+		#a writer dropped without close() (after an error) must not leave a complete looking file
+		self.abort()
+
+	def __init__(self, path, w, h, georef, tileSize=256, nbBands=4, compress=True, bigTiff=None, bkgColor=(0,0,0,0), worldFile=True):
+		'''
+		path = file system path for the output tiff
+		w, h = width and height in pixels
+		georef : a Georef object used to set georeferencing informations, optional
+		tileSize : size in pixels of the tiff internal tiles
+		nbBands : 3 (RGB) or 4 (RGBA)
+		compress : use DEFLATE compression
+		bigTiff : force (True) or disable (False) BigTIFF format, by default it's used only if required
+		bkgColor : color of the area never pasted
+		worldFile : also write a .tfw world file next to the tiff
+		'''
+		if nbBands not in (3, 4):
+			raise ValueError('Only RGB or RGBA images are supported')
+
+		self.w = w
+		self.h = h
+		self.size = (w, h)
+		self.path = path
+		self.georef = georef
+		self.tileSize = tileSize
+		self.nbBands = nbBands
+		self.compress = compress
+		self.bkgColor = bkgColor
+		self.worldFile = worldFile
+
+		self.nbTilesX = -(-w // tileSize)
+		self.nbTilesY = -(-h // tileSize)
+		if bigTiff is None:
+			rawSize = self.nbTilesX * self.nbTilesY * tileSize**2 * nbBands
+			#deflate output can be slightly larger than raw input on noisy data
+			bigTiff = rawSize * 1.01 > CLASSIC_TIFF_MAX_SIZE
+		self.bigTiff = bigTiff
+
+		self.offsets = []
+		self.byteCounts = []
+		self.row = 0 #index of the row of tiff tiles held in the buffer
+		self.buff = self._newBuffer()
+
+		self.file = open(path, 'wb')
+		#header, the offset of the ifd is written when closing
+		if self.bigTiff:
+			self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+		else:
+			self.file.write(b'II' + struct.pack('<HL', 42, 0))
+
+	def _newBuffer(self):
+		buff = np.empty((self.tileSize, self.nbTilesX * self.tileSize, self.nbBands), dtype=np.uint8)
+		buff[:] = self.bkgColor[:self.nbBands]
+		return buff
+
+	@property
+	def closed(self):
+		return getattr(self, 'file', None) is None or self.file.closed
+
+	def paste(self, data, x, y):
+		'''
+		data = numpy array or NpImage
+		x, y = pixel coords of the upper left corner of data in the output image
+		Rows of tiff tiles above the current one have already been written, so data can not be pasted there
+		'''
+		if isinstance(data, NpImage):
+			data = data.data
+		if data.ndim == 2:
+			data = data[:, :, np.newaxis]
+		img_h, img_w, nbBands = data.shape
+		if y < self.row * self.tileSize:
+			raise ValueError('Rows above y={} have already been written'.format(self.row * self.tileSize))
+
+		#clip to the output image
+		x1, y1 = max(x, 0), max(y, 0)
+		x2, y2 = min(x + img_w, self.w), min(y + img_h, self.h)
+		if x1 >= x2 or y1 >= y2:
+			return
+		data = data[y1-y:y2-y, x1-x:x2-x]
+
+		#split data over the rows of tiff tiles it overlaps
+		top = y1
+		while top < y2:
+			row = top // self.tileSize
+			while self.row < row:
+				self._flushRow()
+			bottom = min((row + 1) * self.tileSize, y2)
+			part = data[top-y1:bottom-y1]
+			dst = self.buff[top - row*self.tileSize:bottom - row*self.tileSize, x1:x2]
+			if nbBands == 1:
+				dst[:, :, :3] = part
+			else:
+				n = min(nbBands, self.nbBands)
+				dst[:, :, :n] = part[:, :, :n]
+			if nbBands < 4 and self.nbBands == 4:
+				dst[:, :, 3] = 255
+			top = bottom
+
+	def _flushRow(self):
+		'''Compress and append the tiles of the buffered row then move to the next row'''
+		ts = self.tileSize
+		for col in range(self.nbTilesX):
+			tile = np.ascontiguousarray(self.buff[:, col*ts:(col+1)*ts]).tobytes()
+			if self.compress:
+				tile = zlib.compress(tile, 6)
+			self.offsets.append(self.file.tell())
+			self.byteCounts.append(len(tile))
+			self.file.write(tile)
+		self.row += 1
+		if self.row < self.nbTilesY:
+			self.buff = self._newBuffer()
+
+	def _geoTags(self):
+		'''Return a Tyf ifd filled with GeoTIFF tags'''
+		georef = self.georef
+		geotags = gkd.Gkd()
+		#GeoKeyDirectory header, Tyf default revision is not understood by libgeotiff
+		geotags.version = 1
+		geotags.revision = (1, 0)
+		geotags['GTRasterTypeGeoKey'] = 1 #RasterPixelIsArea
+		crs = georef.crs
+		if crs is not None and crs.isEPSG:
+			if crs.isGeo:
+				geotags['GTModelTypeGeoKey'] = 2
+				geotags['GeographicTypeGeoKey'] = crs.code
+			else:
+				geotags['GTModelTypeGeoKey'] = 1
+				geotags['ProjectedCSTypeGeoKey'] = crs.code
+		else:
+			geotags['GTModelTypeGeoKey'] = 1
+			geotags['ProjectedCSTypeGeoKey'] = 32767 #user defined
+			log.warning('The output crs has no EPSG code and will not be written to the tiff file')
+
+		xmin, resx, rotx, ymax, roty, resy = georef.toGDAL()
+		if rotx == 0 and roty == 0:
+			geotags._33922 = ( (0., 0., 0., xmin, ymax, 0.), )
+			geotags._33550 = (resx, -resy, 0.)
+		else:
+			geotags._34264 = (resx, rotx, 0., xmin, roty, resy, 0., ymax, 0., 0., 0., 0., 0., 0., 0., 1.)
+
+		tags = geotags.to_ifd()
+		if rotx == 0 and roty == 0:
+			del tags[34264]
+		else:
+			del tags[33922]
+			del tags[33550]
+		#drop empty parameter tags
+		for tag in (34736, 34737):
+			if not tags.get(tag).value:
+				del tags[tag]
+		return tags
+
+	def _ifd(self):
+		'''Return a Tyf ifd filled with all tags except tile offsets and byte counts'''
+		tags = ifd.Ifd()
+		tags.set(256, 4, self.w) #ImageWidth
+		tags.set(257, 4, self.h) #ImageLength
+		tags.set(258, 3, (8,) * self.nbBands) #BitsPerSample
+		tags.set(259, 3, 8 if self.compress else 1) #Compression : Adobe deflate or none
+		tags.set(262, 3, 2) #PhotometricInterpretation : RGB
+		tags.set(277, 3, self.nbBands) #SamplesPerPixel
+		tags.set(284, 3, 1) #PlanarConfiguration : chunky
+		tags.set(322, 3, self.tileSize) #TileWidth
+		tags.set(323, 3, self.tileSize) #TileLength
+		if self.nbBands == 4:
+			tags.set(338, 3, 2) #ExtraSamples : unassociated alpha
+		tags.set(339, 3, (1,) * self.nbBands) #SampleFormat : unsigned int
+		if self.georef is not None:
+			tags.update(self._geoTags())
+		return tags
+
+	def _writeIfd(self):
+		'''Write the image file directory at the end of the file and return its offset'''
+		entries = {} #{tag : (type, count, packed value)}
+		for tag in self._ifd().tags():
+			fmt = TYPES[tag.type][0][0]
+			if tag.type in (2, 7):
+				value = bytes(tag.value)
+				if tag.type == 2 and not value.endswith(b'\x00'):
+					value += b'\x00'
+				count = len(value)
+			else:
+				value = struct.pack('<{}{}'.format(len(tag.value), fmt), *tag.value)
+				count = tag.count
+			entries[tag.tag] = (tag.type, count, value)
+		offsetType, offsetFmt = (LONG8, 'Q') if self.bigTiff else (4, 'L')
+		n = len(self.offsets)
+		entries[324] = (offsetType, n, struct.pack('<{}{}'.format(n, offsetFmt), *self.offsets)) #TileOffsets
+		entries[325] = (offsetType, n, struct.pack('<{}{}'.format(n, offsetFmt), *self.byteCounts)) #TileByteCounts
+
+		if self.bigTiff:
+			countFmt, entryFmt, nextFmt, inline = '<Q', '<HHQ', '<Q', 8
+		else:
+			countFmt, entryFmt, nextFmt, inline = '<H', '<HHL', '<L', 4
+		entrySize = struct.calcsize(entryFmt) + inline
+
+		#the ifd must begin on a word boundary
+		self.file.seek(0, os.SEEK_END)
+		if self.file.tell() % 2:
+			self.file.write(b'\x00')
+		ifdOffset = self.file.tell()
+		dataOffset = ifdOffset + struct.calcsize(countFmt) + len(entries) * entrySize + struct.calcsize(nextFmt)
+
+		ifdData = [struct.pack(countFmt, len(entries))]
+		extData = []
+		for tag in sorted(entries):
+			typ, count, value = entries[tag]
+			ifdData.append(struct.pack(entryFmt, tag, typ, count))
+			if len(value) <= inline:
+				ifdData.append(value.ljust(inline, b'\x00'))
+			else:
+				ifdData.append(struct.pack('<' + offsetFmt, dataOffset))
+				if len(value) % 2:
+					value += b'\x00'
+				extData.append(value)
+				dataOffset += len(value)
+		ifdData.append(struct.pack(nextFmt, 0)) #no other ifd
+		self.file.write(b''.join(ifdData + extData))
+		if not self.bigTiff and self.file.tell() > 2**32:
+			raise OverflowError('Tiff file exceeds 4GB, use BigTIFF format')
+		return ifdOffset
+
+	def close(self):
+		'''Write remaining tiles, tags and close the file'''
+		if self.closed:
+			return
+		try:
+			while self.row < self.nbTilesY:
+				self._flushRow()
+			self.buff = None
+			ifdOffset = self._writeIfd()
+			if self.bigTiff:
+				self.file.seek(8)
+				self.file.write(struct.pack('<Q', ifdOffset))
+			else:
+				self.file.seek(4)
+				self.file.write(struct.pack('<L', ifdOffset))
+		finally:
+			self.file.close()
+		if self.worldFile and self.georef is not None:
+			self.georef.toWorldFile(os.path.splitext(self.path)[0] + '.tfw')
+
+	def abort(self):
+		'''Close the file without writing the rows not pasted yet and delete it, the output is left incomplete'''
+		if self.closed:
+			return
+		self.buff = None
+		self.file.close()
+		os.remove(self.path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, *args):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+	def __repr__(self):
+		return '\n'.join([
+		"* Data infos :",
+		" size {}".format(self.size),
+		" type {}".format('BigTIFF' if self.bigTiff else 'TIFF'),
+		" number of bands {}".format(self.nbBands),
+		" compression {}".format('DEFLATE' if self.compress else 'NONE'),
+		"* Georef & Geometry : \n{}".format(self.georef)
+		])
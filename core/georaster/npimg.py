@@ -135,7 +135,7 @@ class NpImage():
 
 		#init from PIL Image instance
 		if HAS_PIL:
-			if Image.isImageType(data):
+			if isinstance(data, Image.Image):
 				self.data = self._npFromPIL(data)
 
 		if self.data is None:
@@ -263,7 +263,9 @@ class NpImage():
 		if img.mode == 'P': #palette (indexed color)
 			img = img.convert('RGBA')
 		data = np.asarray(img)
-		data.setflags(write=True) #PIL return a non writable array
+		if not data.flags.writeable:
+			#PIL return a non writable array and recent Numpy refuse to change the flag of a buffer it does not own
+			data = data.copy()
 		return self._applySubBox(data)
 
 	def _npFromGDAL(self, ds):
@@ -415,20 +417,57 @@ class NpImage():
 	def paste(self, data, x, y):
 
 		img = NpImage(data)
-		data = img.data
-		w, h = img.size
+		self._pasteArray(img.data, x, y)
 
-		if img.isOneBand and self.isOneBand:
+	def _pasteArray(self, data, x, y):
+		'''Copy a numpy array into the given position, band count is adjusted to fit this image'''
+		h, w = data.shape[0], data.shape[1]
+		oneBand = len(data.shape) == 2
+
+		if oneBand and self.isOneBand:
 			self.data[y:y+h, x:x+w] = data
-		elif (not img.isOneBand and self.isOneBand) or (img.isOneBand and not self.isOneBand):
+			return
+		elif (not oneBand and self.isOneBand) or (oneBand and not self.isOneBand):
 			raise ValueError('Paste error, cannot mix one band with multiband')
 
-		if self.hasAlpha:
-			n = img.nbBands
-			self.data[y:y+h, x:x+w, 0:n] = data
+		n = min(data.shape[2], self.nbBands)
+		self.data[y:y+h, x:x+w, 0:n] = data[:, :, 0:n]
+
+	def pasteBLOB(self, data, x, y):
+		'''
+		Decode bytes data (an encoded image like a png or jpeg tile) and write it directly
+		into the given position of this image, without building an intermediate NpImage.
+		Writing different areas from several threads is safe, this is used to build mosaics in parallel.
+		'''
+		self._pasteArray(self.decodeBLOB(data), x, y)
+
+	def decodeBLOB(self, data):
+		'''Decode bytes data to a numpy array whose bands layout can be pasted into this image'''
+		if self.IFACE == 'PIL':
+			img = Image.open(io.BytesIO(data))
+			if img.mode == 'P': #palette (indexed color)
+				img = img.convert('RGBA')
+			elif img.mode == 'LA':
+				img = img.convert('RGBA')
+			elif img.mode == 'L' and not self.isOneBand:
+				img = img.convert('RGB')
+			arr = np.asarray(img) #read only view is enough, the data is copied into the mosaic array
+		else:
+			arr = self._npFromBLOB(data)
+			if len(arr.shape) == 2 and not self.isOneBand:
+				arr = np.dstack([arr, arr, arr])
+		return arr
+
+	def pasteArray(self, data, x, y):
+		'''Write a numpy array (as returned by decodeBLOB) into the given position of this image'''
+		self._pasteArray(data, x, y)
+
+	def fill(self, color, x, y, w, h):
+		'''Fill a rectangle area with a color tuple (one value per band)'''
+		if self.isOneBand:
+			self.data[y:y+h, x:x+w] = color[0]
 		else:
-			n = self.nbBands
-			self.data[y:y+h, x:x+w, :] = data[:, :, 0:n]
+			self.data[y:y+h, x:x+w, :] = color[0:self.nbBands]
 
 	def cast2float(self):
 		if not self.isFloat:
@@ -460,10 +499,9 @@ class NpImage():
 			self.data = replace_nans(self.data, max_iter=5, tolerance=0.5, kernel_size=2, method='localmean')
 
 	def reproj(self, crs1, crs2, out_ul=None, out_size=None, out_res=None, sqPx=False, resamplAlg='BL'):
-		ds1 = self.toGDAL()
 		if not self.isGeoref:
 			raise IOError('Unable to reproject non georeferenced image')
-		ds2 = reprojImg(crs1, crs2, ds1, out_ul=out_ul, out_size=out_size, out_res=out_res, sqPx=sqPx, resamplAlg=resamplAlg)
+		ds2 = reprojImg(crs1, crs2, self, out_ul=out_ul, out_size=out_size, out_res=out_res, sqPx=sqPx, resamplAlg=resamplAlg)
 		return NpImage(ds2)
 
 	def __repr__(self):
@@ -1,4 +1,5 @@
 from .srs import SRS
-from .reproj import Reproj, reprojPt, reprojPts, reprojBbox, reprojImg
+from .reproj import Reproj, ReprojRegistry, getReproj, reprojPt, reprojPts, reprojBbox, reprojImg
 from .srv import EPSGIO, TWCC
+from .epsgdb import EpsgDB, epsgDB
 from .ellps import dd2meters, meters2dd, Ellps, GRS80
@@ -0,0 +1,338 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+import logging
+log = logging.getLogger(__name__)
+
+import math
+
+import numpy as np
+
+from .epsgdb import epsgDB
+
+
+#Conformal projections of the built in reprojection engine : transverse mercator (Poder/Engsager Krüger series
+#at order 6, like PROJ default tmerc algorithm), lambert conformal conic 1SP/2SP and polar stereographic.
+#Coordinates are processed as (N,2) numpy arrays. Only datums considered equal to WGS84 are supported
+#(no datum shift), so lon/lat are WGS84 ones.
+
+
+ELLIPSOIDS = {
+	'GRS80': (6378137.0, 298.257222101),
+	'WGS84': (6378137.0, 298.257223563)
+}
+
+#datums without shift from WGS84 and their ellipsoid
+DATUMS = {
+	'WGS84': 'WGS84',
+	'NAD83': 'GRS80'
+}
+
+UNITS = {
+	'm': 1.0,
+	'ft': 0.3048,
+	'us-ft': 1200 / 3937
+}
+
+
+def parseProj4(proj4):
+	'''Return a dict of the parameters of a proj4 string, flags have True value'''
+	params = {}
+	for param in proj4.split():
+		k, _, v = param.lstrip('+').partition('=')
+		params[k] = v if v else True
+	return params
+
+
+def conformalLat(phi, e):
+	'''Conformal latitude of geodetic latitudes phi (radians)'''
+	sinphi = np.sin(phi)
+	return np.arctan(np.sinh(np.arctanh(sinphi) - e * np.arctanh(e * sinphi)))
+
+def geodeticLat(chi, e):
+	'''Geodetic latitude of conformal latitudes chi (radians), series expansion accurate to e^8'''
+	e2 = e * e
+	e4, e6, e8 = e2 * e2, e2 * e2 * e2, e2 * e2 * e2 * e2
+	return (chi + (e2 / 2 + 5 * e4 / 24 + e6 / 12 + 13 * e8 / 360) * np.sin(2 * chi)
+		+ (7 * e4 / 48 + 29 * e6 / 240 + 811 * e8 / 11520) * np.sin(4 * chi)
+		+ (7 * e6 / 120 + 81 * e8 / 1120) * np.sin(6 * chi)
+		+ (4279 * e8 / 161280) * np.sin(8 * chi))
+
+def tsfn(phi, e):
+	'''Snyder t function : tan(pi/4 - phi/2) / ((1 - e sin(phi)) / (1 + e sin(phi)))^(e/2)'''
+	esinphi = e * np.sin(phi)
+	return np.tan(math.pi / 4 - phi / 2) / ((1 - esinphi) / (1 + esinphi)) ** (e / 2)
+
+def msfn(phi, e):
+	'''Snyder m function : cos(phi) / sqrt(1 - e^2 sin^2(phi))'''
+	sinphi = np.sin(phi)
+	return np.cos(phi) / np.sqrt(1 - e * e * sinphi * sinphi)
+
+
+class Projection():
+	'''
+	Base class of the built in projections
+	forward() and inverse() convert (N,2) arrays of lon, lat in degrees from and to projected coordinates
+	'''
+
+	def __init__(self, params):
+		if 'datum' in params:
+			if params['datum'] not in DATUMS:
+				raise ValueError('Unsupported datum ' + str(params['datum']))
+			ellps = DATUMS[params['datum']]
+		else:
+			ellps = params.get('ellps', 'WGS84')
+		if ellps not in ELLIPSOIDS:
+			raise ValueError('Unsupported ellipsoid ' + str(ellps))
+		for k in ('a', 'b', 'rf', 'f', 'R', 'es', 'e'):
+			if k in params:
+				raise ValueError('Unsupported ellipsoid parameter ' + k)
+		if any(float(v) != 0 for v in str(params.get('towgs84', '0')).split(',')):
+			raise ValueError('Datum shift is not supported')
+		for k in ('nadgrids', 'geoidgrids', 'axis', 'pm'):
+			if k in params:
+				raise ValueError('Unsupported parameter ' + k)
+		if 'to_meter' in params:
+			self.toMeter = float(params['to_meter'])
+		elif params.get('units', 'm') in UNITS:
+			self.toMeter = UNITS[params.get('units', 'm')]
+		else:
+			raise ValueError('Unsupported units ' + str(params['units']))
+
+		self.a, rf = ELLIPSOIDS[ellps]
+		f = 1 / rf
+		self.e = math.sqrt(f * (2 - f))
+		self.n = f / (2 - f) #third flattening
+		self.lat0 = math.radians(float(params.get('lat_0', 0)))
+		self.lon0 = math.radians(float(params.get('lon_0', 0)))
+		self.k0 = float(params.get('k_0', params.get('k', 1)))
+		self.x0 = float(params.get('x_0', 0))
+		self.y0 = float(params.get('y_0', 0))
+
+	def forward(self, pts):
+		lam = np.radians(pts[:,0]) - self.lon0
+		lam = (lam + math.pi) % (2 * math.pi) - math.pi
+		x, y = self._forward(lam, np.radians(pts[:,1]))
+		out = np.empty(pts.shape)
+		out[:,0] = (self.x0 + x) / self.toMeter
+		out[:,1] = (self.y0 + y) / self.toMeter
+		return out
+
+	def inverse(self, pts):
+		lam, phi = self._inverse(pts[:,0] * self.toMeter - self.x0, pts[:,1] * self.toMeter - self.y0)
+		out = np.empty(pts.shape)
+		out[:,0] = np.degrees((lam + self.lon0 + math.pi) % (2 * math.pi) - math.pi)
+		out[:,1] = np.degrees(phi)
+		return out
+
+	def _forward(self, lam, phi):
+		raise NotImplementedError
+
+	def _inverse(self, x, y):
+		raise NotImplementedError
+
+
+class LongLat(Projection):
+	'''Geographic coordinates of a datum considered equal to WGS84'''
+
+	def forward(self, pts):
+		return pts.copy()
+
+	def inverse(self, pts):
+		return pts.copy()
+
+
+class TransverseMercator(Projection):
+	'''Transverse mercator, Krüger series to order 6 in the third flattening (Karney 2011), accurate to a few mm up to 4000 km from the central meridian'''
+
+	def __init__(self, params):
+		if 'zone' in params:
+			zone = int(params['zone'])
+			if not 1 <= zone <= 60:
+				raise ValueError('UTM zone number out of range')
+			params = dict(params, lat_0=0, lon_0=(zone - 1) * 6 - 180 + 3, k_0=0.9996, x_0=500000,
+				y_0=10000000 if 'south' in params else 0)
+		Projection.__init__(self, params)
+		n = self.n
+		n2, n3, n4, n5, n6 = n**2, n**3, n**4, n**5, n**6
+		#rectifying radius
+		self.A = self.a / (1 + n) * (1 + n2 / 4 + n4 / 64 + n6 / 256)
+		self.alpha = (
+			n / 2 - 2 * n2 / 3 + 5 * n3 / 16 + 41 * n4 / 180 - 127 * n5 / 288 + 7891 * n6 / 37800,
+			13 * n2 / 48 - 3 * n3 / 5 + 557 * n4 / 1440 + 281 * n5 / 630 - 1983433 * n6 / 1935360,
+			61 * n3 / 240 - 103 * n4 / 140 + 15061 * n5 / 26880 + 167603 * n6 / 181440,
+			49561 * n4 / 161280 - 179 * n5 / 168 + 6601661 * n6 / 7257600,
+			34729 * n5 / 80640 - 3418889 * n6 / 1995840,
+			212378941 * n6 / 319334400
+		)
+		self.beta = (
+			n / 2 - 2 * n2 / 3 + 37 * n3 / 96 - n4 / 360 - 81 * n5 / 512 + 96199 * n6 / 604800,
+			n2 / 48 + n3 / 15 - 437 * n4 / 1440 + 46 * n5 / 105 - 1118711 * n6 / 3870720,
+			17 * n3 / 480 - 37 * n4 / 840 - 209 * n5 / 4480 + 5569 * n6 / 90720,
+			4397 * n4 / 161280 - 11 * n5 / 504 - 830251 * n6 / 7257600,
+			4583 * n5 / 161280 - 108847 * n6 / 3991680,
+			20648693 * n6 / 638668800
+		)
+		#northing of the origin latitude on the central meridian
+		xi0, _ = self._xieta(np.array([0.0]), np.array([self.lat0]))
+		self.xi0 = float(xi0[0])
+
+	def _xieta(self, lam, phi):
+		chi = conformalLat(phi, self.e)
+		xi_ = np.arctan2(np.tan(chi), np.cos(lam))
+		eta_ = np.arctanh(np.cos(chi) * np.sin(lam))
+		xi, eta = xi_.copy(), eta_.copy()
+		for j, a in enumerate(self.alpha, 1):
+			xi += a * np.sin(2 * j * xi_) * np.cosh(2 * j * eta_)
+			eta += a * np.cos(2 * j * xi_) * np.sinh(2 * j * eta_)
+		return xi, eta
+
+	def _forward(self, lam, phi):
+		xi, eta = self._xieta(lam, phi)
+		k = self.k0 * self.A
+		return k * eta, k * (xi - self.xi0)
+
+	def _inverse(self, x, y):
+		k = self.k0 * self.A
+		xi = y / k + self.xi0
+		eta = x / k
+		xi_, eta_ = xi.copy(), eta.copy()
+		for j, b in enumerate(self.beta, 1):
+			xi_ -= b * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+			eta_ -= b * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+		chi = np.arcsin(np.sin(xi_) / np.cosh(eta_))
+		lam = np.arctan2(np.sinh(eta_), np.cos(xi_))
+		return lam, geodeticLat(chi, self.e)
+
+
+class LambertConformalConic(Projection):
+	'''Lambert conformal conic with 1 (lat_1 = lat_0 and k_0) or 2 standard parallels (lat_1, lat_2)'''
+
+	def __init__(self, params):
+		Projection.__init__(self, params)
+		e = self.e
+		lat1 = math.radians(float(params.get('lat_1', params.get('lat_0', 0))))
+		lat2 = math.radians(float(params.get('lat_2', params.get('lat_1', params.get('lat_0', 0)))))
+		if abs(lat1 + lat2) < 1e-10:
+			raise ValueError('Standard parallels cannot be opposite')
+		m1, t1 = float(msfn(lat1, e)), float(tsfn(lat1, e))
+		if abs(lat1 - lat2) < 1e-10:
+			self.cn = math.sin(lat1)
+		else:
+			m2, t2 = float(msfn(lat2, e)), float(tsfn(lat2, e))
+			self.cn = (math.log(m1) - math.log(m2)) / (math.log(t1) - math.log(t2))
+		self.aF = self.a * self.k0 * m1 / (self.cn * t1 ** self.cn)
+		self.rho0 = self.aF * float(tsfn(self.lat0, e)) ** self.cn
+
+	def _forward(self, lam, phi):
+		with np.errstate(divide='ignore'):
+			rho = self.aF * tsfn(phi, self.e) ** self.cn
+		theta = self.cn * lam
+		return rho * np.sin(theta), self.rho0 - rho * np.cos(theta)
+
+	def _inverse(self, x, y):
+		s = math.copysign(1, self.cn)
+		y = self.rho0 - y
+		rho = s * np.hypot(x, y)
+		theta = np.arctan2(s * x, s * y)
+		with np.errstate(divide='ignore'):
+			t = (rho / self.aF) ** (1 / self.cn)
+		chi = math.pi / 2 - 2 * np.arctan(t)
+		return theta / self.cn, geodeticLat(chi, self.e)
+
+
+class PolarStereographic(Projection):
+	'''Polar stereographic centered on a pole (lat_0 = 90 or -90), with a scale factor k_0 or a standard parallel lat_ts'''
+
+	def __init__(self, params):
+		Projection.__init__(self, params)
+		if abs(abs(self.lat0) - math.pi / 2) > 1e-10:
+			raise ValueError('Only polar stereographic projections are supported')
+		e = self.e
+		self.south = self.lat0 < 0
+		latts = math.radians(float(params.get('lat_ts', math.degrees(self.lat0))))
+		if self.south:
+			latts = -latts
+		if abs(latts - math.pi / 2) < 1e-10:
+			self.akm1 = 2 * self.a * self.k0 / math.sqrt((1 + e) ** (1 + e) * (1 - e) ** (1 - e))
+		else:
+			#scale factor is defined by the standard parallel
+			self.akm1 = self.a * float(msfn(latts, e)) / float(tsfn(latts, e))
+
+	def _forward(self, lam, phi):
+		if self.south:
+			phi, lam = -phi, -lam
+		rho = self.akm1 * tsfn(phi, self.e)
+		x, y = rho * np.sin(lam), -rho * np.cos(lam)
+		if self.south:
+			x, y = -x, -y
+		return x, y
+
+	def _inverse(self, x, y):
+		if self.south:
+			x, y = -x, -y
+		t = np.hypot(x, y) / self.akm1
+		chi = math.pi / 2 - 2 * np.arctan(t)
+		lam, phi = np.arctan2(x, -y), geodeticLat(chi, self.e)
+		if self.south:
+			lam, phi = -lam, -phi
+		return lam, phi
+
+
+PROJECTIONS = {
+	'longlat': LongLat,
+	'latlong': LongLat,
+	'tmerc': TransverseMercator,
+	'utm': TransverseMercator,
+	'lcc': LambertConformalConic,
+	'stere': PolarStereographic,
+	'ups': PolarStereographic
+}
+
+
+def fromProj4(proj4):
+	'''Build the projection of a proj4 string, raise ValueError if it's not supported by the built in engine'''
+	params = parseProj4(proj4)
+	proj = params.get('proj')
+	if proj not in PROJECTIONS:
+		raise ValueError('Unsupported projection ' + str(proj))
+	if proj == 'ups':
+		params = dict(params, lat_0=-90 if 'south' in params else 90, k_0=0.994, x_0=2000000, y_0=2000000)
+	return PROJECTIONS[proj](params)
+
+
+def getProjection(crs):
+	'''
+	Return the built in projection of a SRS object, None if it is not supported.
+	EPSG definitions are read from the offline EPSG database, proj4 strings are parsed.
+	'''
+	if crs.isEPSG:
+		#only the crs whose datum can be considered equal to WGS84
+		info = epsgDB.get(crs.code)
+		proj4 = epsgDB.getProj4(crs.code) if info is not None and info['wgs84'] else None
+	elif not crs.hasAuth:
+		proj4 = crs.proj4
+	else:
+		proj4 = None
+	if proj4 is None:
+		return None
+	try:
+		return fromProj4(proj4)
+	except ValueError as e:
+		log.debug('Built in engine cannot handle crs {} : {}'.format(crs, e))
+		return None
@@ -0,0 +1,264 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import re
+import math
+import zlib
+import sqlite3
+import threading
+import warnings
+from urllib.request import pathname2url
+
+
+#The bundled database (epsg.sqlite) holds the EPSG projected and geographic 2D crs : code, name, kind, area of use,
+#projection method, proj4 string and ESRI WKT. Proj4 and WKT are zlib compressed with preset dictionaries stored
+#in the meta table, most of them fit in a few dozens of bytes. Names, areas, methods and aliases are indexed with
+#a contentless FTS5 table, searches fall back to LIKE queries if the sqlite library has no FTS5 support.
+#The wgs84 flag marks the crs whose datum shift from WGS84 is less than 10 cm at the center of their area of use,
+#the built in reprojection engine only handles them (see conformal.py).
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE area (
+	id INTEGER PRIMARY KEY,
+	name TEXT NOT NULL,
+	west REAL, south REAL, east REAL, north REAL
+);
+CREATE TABLE crs (
+	code INTEGER PRIMARY KEY,
+	name TEXT NOT NULL,
+	kind TEXT NOT NULL,
+	area_id INTEGER REFERENCES area(id),
+	method TEXT,
+	deprecated INTEGER NOT NULL DEFAULT 0,
+	wgs84 INTEGER NOT NULL DEFAULT 0,
+	proj4 BLOB,
+	wkt BLOB
+);
+CREATE VIRTUAL TABLE crs_fts USING fts5(name, area, method, aliases, content='', tokenize='unicode61 remove_diacritics 2');
+"""
+
+
+class EpsgDB():
+	'''
+	Read only access to the offline EPSG database, a same connection is shared by all threads
+	Every method returns None or an empty list if the database file is not available
+	'''
+
+	PATH = os.path.join(os.path.dirname(__file__), 'epsg.sqlite')
+	FIELDS = ('code', 'name', 'kind', 'area', 'west', 'south', 'east', 'north', 'method', 'deprecated', 'wgs84')
+
+	def __init__(self, path=None):
+		self.path = path or self.PATH
+		self.db = None
+		self.zdicts = {}
+		self.hasFTS = True
+		self.lock = threading.Lock()
+
+	@property
+	def available(self):
+		return self.connect() is not None
+
+	def connect(self):
+		with self.lock:
+			if self.db is None and os.path.exists(self.path):
+				try:
+					db = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(self.path)), uri=True, check_same_thread=False)
+					self.zdicts = dict(db.execute("SELECT key, value FROM meta WHERE key LIKE '%_zdict'").fetchall())
+				except sqlite3.Error as e:
+					log.error('Cannot open EPSG database {} : {}'.format(self.path, e))
+					return None
+				self.db = db
+			return self.db
+
+	def close(self):
+		with self.lock:
+			if self.db is not None:
+				self.db.close()
+				self.db = None
+
+	def query(self, sql, params=()):
+		db = self.connect()
+		if db is None:
+			return []
+		with self.lock:
+			return db.execute(sql, params).fetchall()
+
+	@staticmethod
+	def pack(text, zdict):
+		c = zlib.compressobj(9, zdict=zdict)
+		return c.compress(text.encode('utf8')) + c.flush()
+
+	def unpack(self, data, field):
+		d = zlib.decompressobj(zdict=self.zdicts[field + '_zdict'])
+		return (d.decompress(data) + d.flush()).decode('utf8')
+
+	def get(self, code):
+		'''Return a dict describing the crs of an EPSG code (see FIELDS), None if unknown'''
+		rows = self.query('SELECT crs.code, crs.name, kind, area.name, west, south, east, north, method, deprecated, wgs84 '
+			'FROM crs LEFT JOIN area ON area.id = crs.area_id WHERE code = ?', (int(code),))
+		if not rows:
+			return None
+		return dict(zip(self.FIELDS, rows[0]))
+
+	def _getText(self, code, field):
+		rows = self.query('SELECT {} FROM crs WHERE code = ?'.format(field), (int(code),))
+		if not rows or rows[0][0] is None:
+			return None
+		return self.unpack(rows[0][0], field)
+
+	def getProj4(self, code):
+		'''Return the proj4 string of an EPSG code, None if unknown'''
+		return self._getText(code, 'proj4')
+
+	def getWkt(self, code):
+		'''Return the ESRI WKT of an EPSG code, None if unknown'''
+		return self._getText(code, 'wkt')
+
+	def search(self, query, limit=50):
+		'''
+		Search crs by code, name, area of use, projection method or alias, deprecated crs are listed last
+		Return a list of dict {'code' (string), 'name', 'area', 'kind', 'deprecated'}, like EPSGIO.search()
+		'''
+		query = str(query).strip()
+		fields = 'crs.code, crs.name, area.name, crs.kind, crs.deprecated'
+		m = re.fullmatch(r'(?:EPSG\s*:\s*)?(\d{1,6})', query, re.IGNORECASE)
+		if m:
+			#the code itself then the codes starting with these digits
+			code = int(m.group(1))
+			ranges = [(code * 10**k, (code + 1) * 10**k - 1) for k in range(7 - len(m.group(1)))]
+			where = ' OR '.join(['code BETWEEN ? AND ?'] * len(ranges))
+			rows = self.query('SELECT {} FROM crs LEFT JOIN area ON area.id = crs.area_id WHERE {} '
+				'ORDER BY code != ?, deprecated, code LIMIT ?'.format(fields, where), [v for r in ranges for v in r] + [code, limit])
+		else:
+			words = re.findall(r'\w+', query)
+			if not words:
+				return []
+			rows = None
+			if self.hasFTS:
+				match = ' '.join('"{}"*'.format(w) for w in words)
+				try:
+					rows = self.query('SELECT {} FROM crs_fts JOIN crs ON crs.code = crs_fts.rowid LEFT JOIN area ON area.id = crs.area_id '
+						'WHERE crs_fts MATCH ? ORDER BY crs.deprecated, crs.name != ? COLLATE NOCASE, bm25(crs_fts, 10, 1, 2, 5), crs.code '
+						'LIMIT ?'.format(fields), (match, query, limit))
+				except sqlite3.OperationalError as e:
+					log.warning('EPSG full text search unavailable ({}), using a slower search'.format(e))
+					self.hasFTS = False
+			if not self.hasFTS:
+				where = ' AND '.join(["(crs.name || ' ' || ifnull(area.name, '') || ' ' || ifnull(method, '')) LIKE ?"] * len(words))
+				rows = self.query('SELECT {} FROM crs LEFT JOIN area ON area.id = crs.area_id WHERE {} '
+					'ORDER BY deprecated, code LIMIT ?'.format(fields, where), ['%' + w + '%' for w in words] + [limit])
+		return [{'code': str(code), 'name': name, 'area': area, 'kind': kind, 'deprecated': bool(deprecated)}
+			for code, name, area, kind, deprecated in rows]
+
+	@classmethod
+	def build(cls, path, zdictSize=32768):
+		'''
+		Build the database from the EPSG dataset of PROJ, requires pyproj
+		This is only used to regenerate the bundled database when PROJ is updated
+		'''
+		import pyproj
+		from pyproj.database import query_crs_info
+		from pyproj.datadir import get_data_dir
+		from pyproj.enums import PJType, WktVersion
+
+		projDB = sqlite3.connect(os.path.join(get_data_dir(), 'proj.db'))
+		aliases = {}
+		for code, alias in projDB.execute("SELECT code, alt_name FROM alias_name WHERE auth_name = 'EPSG' "
+			"AND table_name IN ('projected_crs', 'geodetic_crs')"):
+			if str(code).isdigit():
+				aliases.setdefault(int(code), []).append(alias)
+		projDB.close()
+
+		wgs84, shifts = pyproj.CRS.from_epsg(4326), {}
+		def shift(crs, area):
+			'''Distance in metres between the datum of a crs and WGS84 at the center of its area of use'''
+			geod = crs.geodetic_crs
+			key = geod.to_wkt()
+			if key not in shifts:
+				lon = (area.west + area.east) / 2 if area.west <= area.east else ((area.west + area.east + 360) / 2 + 180) % 360 - 180
+				lat = (area.south + area.north) / 2
+				try:
+					lon2, lat2 = pyproj.Transformer.from_crs(geod, wgs84, always_xy=True).transform(lon, lat)
+					shifts[key] = math.hypot((lon2 - lon) * math.cos(math.radians(lat)) * 111320, (lat2 - lat) * 110540)
+				except pyproj.exceptions.ProjError:
+					shifts[key] = math.inf
+			return shifts[key]
+
+		rows, codes, areas = [], set(), {}
+		for kind, pjType in (('geographic', PJType.GEOGRAPHIC_2D_CRS), ('projected', PJType.PROJECTED_CRS)):
+			for info in query_crs_info(auth_name='EPSG', pj_types=[pjType], allow_deprecated=True):
+				code = int(info.code)
+				if code in codes: #PROJ lists some crs twice
+					continue
+				codes.add(code)
+				try:
+					crs = pyproj.CRS.from_epsg(code)
+				except pyproj.exceptions.CRSError:
+					continue
+				try:
+					with warnings.catch_warnings():
+						warnings.simplefilter('ignore') #lossy conversion warning
+						proj4 = crs.to_proj4()
+				except pyproj.exceptions.CRSError:
+					proj4 = None
+				if proj4:
+					proj4 = ' '.join(p for p in proj4.split() if p not in ('+no_defs', '+type=crs'))
+				try:
+					wkt = crs.to_wkt(WktVersion.WKT1_ESRI)
+				except pyproj.exceptions.CRSError:
+					wkt = None
+				area = info.area_of_use
+				areaId, isWgs84 = None, False
+				if area is not None:
+					areaId = areas.setdefault((area.name.rstrip('.'), area.west, area.south, area.east, area.north), len(areas) + 1)
+					isWgs84 = crs.geodetic_crs is not None and shift(crs, area) < 0.1
+				rows.append([code, info.name, kind, areaId, info.projection_method_name, int(info.deprecated), int(isWgs84), proj4, wkt])
+
+		#preset dictionaries made of a sample of the strings, so each short string is compressed efficiently on its own
+		zdicts = {}
+		for field, i in (('proj4', 7), ('wkt', 8)):
+			sample = '\n'.join(row[i] for row in rows[::len(rows) // 200 or 1] if row[i])
+			zdicts[field] = zdict = sample.encode('utf8')[-zdictSize:]
+			for row in rows:
+				row[i] = cls.pack(row[i], zdict) if row[i] else None
+
+		if os.path.exists(path):
+			os.remove(path)
+		db = sqlite3.connect(path)
+		db.executescript(SCHEMA)
+		db.executemany('INSERT INTO meta VALUES (?,?)', [(field + '_zdict', zdict) for field, zdict in zdicts.items()]
+			+ [('source', 'PROJ ' + pyproj.proj_version_str)])
+		db.executemany('INSERT INTO area VALUES (?,?,?,?,?,?)', [(areaId,) + k for k, areaId in areas.items()])
+		db.executemany('INSERT INTO crs VALUES (?,?,?,?,?,?,?,?,?)', rows)
+		areaNames = {areaId: k[0] for k, areaId in areas.items()}
+		db.executemany('INSERT INTO crs_fts (rowid, name, area, method, aliases) VALUES (?,?,?,?,?)',
+			[(row[0], row[1], areaNames.get(row[3]), row[4], ' ; '.join(aliases.get(row[0], []))) for row in rows])
+		db.execute("INSERT INTO crs_fts(crs_fts) VALUES('optimize')")
+		db.commit()
+		db.execute('VACUUM')
+		db.close()
+		log.info('EPSG database {} built with {} crs'.format(path, len(rows)))
+		return len(rows)
+
+
+epsgDB = EpsgDB()
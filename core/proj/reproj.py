@@ -20,11 +20,16 @@
 
 import math
 import logging
+import threading
+from collections import OrderedDict
+import numpy as np
 
 from .srs import SRS
 from .utm import UTM, UTM_EPSG_CODES
+from .conformal import getProjection
 from .ellps import GRS80
 from .srv import EPSGIO
+from . import warp
 
 from ..errors import ReprojError
 from ..utils import BBOX
@@ -40,6 +45,19 @@ if HAS_PYPROJ:
         import pyproj
 
 
+_projVersion = None
+
+def getGdalProjVersion():
+        '''Major version of the PROJ library used by GDAL, checked once'''
+        global _projVersion
+        if _projVersion is None:
+                if hasattr(osr, 'GetPROJVersionMajor'):
+                        _projVersion = osr.GetPROJVersionMajor()
+                else:
+                        _projVersion = 4
+        return _projVersion
+
+
 ######################################
 # Build in functions
 
@@ -57,15 +75,93 @@ def lonLatToWebMerc(lon, lat):
         y = lat * k
         return x, y
 
+def webMercToLonLatArray(pts):
+        '''Vectorized webMercToLonLat(), (N,2) array of x, y to (N,2) array of lon, lat'''
+        k = GRS80.perimeter/360
+        out = np.empty(pts.shape)
+        out[:,0] = pts[:,0] / k
+        out[:,1] = 180 / math.pi * (2 * np.arctan( np.exp( pts[:,1] / k * math.pi / 180.0)) - math.pi / 2.0)
+        return out
+
+def lonLatToWebMercArray(pts):
+        '''Vectorized lonLatToWebMerc(), (N,2) array of lon, lat to (N,2) array of x, y'''
+        k = GRS80.perimeter/360
+        out = np.empty(pts.shape)
+        out[:,0] = pts[:,0] * k
+        out[:,1] = np.log( np.tan((90 + pts[:,1]) * math.pi / 360.0 )) / (math.pi / 180.0) * k
+        return out
+
+def builtinFuncs(crs):
+        '''
+        Return the array functions (toLonLat, fromLonLat) of the built in engine for a SRS object, None if the crs is not supported
+        Functions are None for WGS84 lon/lat
+        '''
+        if crs.isWGS84:
+                return None, None
+        if crs.isWM:
+                return webMercToLonLatArray, lonLatToWebMercArray
+        if crs.isUTM:
+                utm = UTM.init_from_epsg(crs)
+                return utm.utm_to_lonlat_array, utm.lonlat_to_utm_array
+        prj = getProjection(crs)
+        if prj is None:
+                return None
+        return prj.inverse, prj.forward
+
 
 ######################################
-# Raster reproj using GDAL
+# Raster reproj using GDAL or numpy
+
+def _outGeoTrans(crs1, crs2, bbox, img_w, img_h, resx, resy, out_ul=None, out_size=None, out_res=None, sqPx=False):
+        '''Return the geotransform and size of the reprojected raster, see reprojImg()'''
+        xmin, ymin, xmax, ymax = bbox
+
+        if out_ul is not None:
+                xmin, ymax = out_ul
+        else:
+                xmin, ymax = reprojPt(crs1, crs2, xmin, ymax)
+
+        #submit resolution and size
+        if out_res is not None and out_size is not None:
+                resx, resy = out_res, -out_res
+                img_w, img_h = out_size
+
+        #submit resolution and auto compute the best image size
+        if out_res is not None and out_size is None:
+                resx, resy = out_res, -out_res
+                #reprojected image size depend on final bbox and expected resolution
+                xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, bbox)
+                img_w = int( (xmax - xmin) / resx )
+                img_h = int( (ymax - ymin) / -resy )
+
+        #submit image size and ...
+        if out_res is None and out_size is not None:
+                img_w, img_h = out_size
+                #...let's res as source value ? (image will be croped)
+
+        #Keep original image px size and compute resolution to approximately preserve geosize
+        if out_res is None and out_size is None:
+                #find the res that match source diagolal size
+                xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, bbox)
+                '''
+                dst_diag = math.sqrt( (xmax - xmin)**2 + (ymax - ymin)**2)
+                px_diag = math.sqrt(img_w**2 + img_h**2)
+                res = dst_diag / px_diag
+                '''
+                resx = (xmax-xmin) / img_w
+                resy = -(ymax-ymin) / img_h
+                if sqPx:
+                        resx = max(resx, abs(resy))
+                        resy = -resx
+
+        return (xmin, resx, 0, ymax, 0, resy), (img_w, img_h)
+
 
 def reprojImg(crs1, crs2, ds1, out_ul=None, out_size=None, out_res=None, sqPx=False, resamplAlg='BL', path=None, geoTiffOptions={'TFW':'YES', 'TILED':'YES', 'BIGTIFF':'YES', 'COMPRESS':'JPEG', 'JPEG_QUALITY':80, 'PHOTOMETRIC':'YCBCR'}):
         '''
-        Use GDAL Python binding to reproject an image
+        Use GDAL Python binding to reproject an image, or the numpy warp engine (see warp.py) if GDAL is not available
         crs1, crs2 >> epsg code
-        ds1 >> input GDAL dataset object
+        ds1 >> input GDAL dataset object or georeferenced NpImage
         out_ul >> [tuple] output raster top left coords (same as input if None)
         out_size >> |tuple], output raster size (same as input is None)
         out_res >> [number], output raster resolution (same as input if None) (resx = resy)
@@ -73,10 +169,16 @@ def reprojImg(crs1, crs2, ds1, out_ul=None, out_size=None, out_res=None, sqPx=Fa
         path >> a geotiff file path to store the result into (optional)
         geoTiffOptions >> GDAL create option for tiff format (optional)
         return ds2 >> output GDAL dataset object. If path is None, the dataset will be stored in memory however into a geotiff file on disk
+        Without GDAL, the result is returned as a NpImage
         '''
 
-        if not HAS_GDAL:
-                raise NotImplementedError
+        isNpImage = hasattr(ds1, 'data') and hasattr(ds1, 'georef')
+        if isNpImage and HAS_GDAL:
+                ds1 = ds1.toGDAL()
+        elif not HAS_GDAL:
+                if not isNpImage:
+                        raise NotImplementedError
+                return _reprojNpImg(crs1, crs2, ds1, out_ul, out_size, out_res, sqPx, resamplAlg, path)
 
         geoTrans = ds1.GetGeoTransform()
         if geoTrans is not None:
@@ -107,44 +209,7 @@ def reprojImg(crs1, crs2, ds1, out_ul=None, out_size=None, out_res=None, sqPx=Fa
         # ds2 will be a template empty raster to reproject the data into
         # we can directly set its size, res and top left coord as expected
         # reproject funtion will match the template (clip and resampling)
-
-        if out_ul is not None:
-                xmin, ymax = out_ul
-        else:
-                xmin, ymax = reprojPt(crs1, crs2, xmin, ymax)
-
-        #submit resolution and size
-        if out_res is not None and out_size is not None:
-                resx, resy = out_res, -out_res
-                img_w, img_h = out_size
-
-        #submit resolution and auto compute the best image size
-        if out_res is not None and out_size is None:
-                resx, resy = out_res, -out_res
-                #reprojected image size depend on final bbox and expected resolution
-                xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, bbox)
-                img_w = int( (xmax - xmin) / resx )
-                img_h = int( (ymax - ymin) / resy )
-
-        #submit image size and ...
-        if out_res is None and out_size is not None:
-                img_w, img_h = out_size
-                #...let's res as source value ? (image will be croped)
-
-        #Keep original image px size and compute resolution to approximately preserve geosize
-        if out_res is None and out_size is None:
-                #find the res that match source diagolal size
-                xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, bbox)
-                '''
-                dst_diag = math.sqrt( (xmax - xmin)**2 + (ymax - ymin)**2)
-                px_diag = math.sqrt(img_w**2 + img_h**2)
-                res = dst_diag / px_diag
-                '''
-                resx = (xmax-xmin) / img_w
-                resy = -(ymax-ymin) / img_h
-                if sqPx:
-                        resx = max(resx, abs(resy))
-                        resy = -resx
+        geoTrans, (img_w, img_h) = _outGeoTrans(crs1, crs2, bbox, img_w, img_h, resx, resy, out_ul, out_size, out_res, sqPx)
 
         if path is None:
                 ds2 = gdal.GetDriverByName('MEM').Create('', img_w, img_h, nbBands, gdal.GetDataTypeByName(dtype))
@@ -155,7 +220,6 @@ def reprojImg(crs1, crs2, ds1, out_ul=None, out_size=None, out_res=None, sqPx=Fa
                 if geoTiffOptions.get('COMPRESS', None) == 'JPEG':
                         ds2.CreateMaskBand(gdal.GMF_PER_DATASET)
                         ds2.GetRasterBand(1).GetMaskBand().Fill(255) #WARNING, it seems gdal.ReprojectImage does not honor internal mask !
-        geoTrans = (xmin, resx, 0, ymax, 0, resy)
         ds2.SetGeoTransform(geoTrans)
         prj2 = SRS(crs2).getOgrSpatialRef()
         wkt2 = prj2.ExportToWkt()
@@ -186,6 +250,30 @@ def reprojImg(crs1, crs2, ds1, out_ul=None, out_size=None, out_res=None, sqPx=Fa
         return ds2
 
 
+def _reprojNpImg(crs1, crs2, img, out_ul=None, out_size=None, out_res=None, sqPx=False, resamplAlg='BL', path=None):
+        '''reprojImg() implementation using the numpy warp engine, return a NpImage'''
+        from ..georaster import NpImage, GeoRef, GeoTiffWriter
+
+        if not img.isGeoref:
+                raise IOError("Reprojection fails: input raster is not georeferenced")
+        xmin, resx, rotx, ymax, roty, resy = geoTrans1 = img.georef.toGDAL()
+        if rotx != 0 or roty != 0:
+                raise IOError("Raster must be rectified (no rotation parameters)")
+        img_w, img_h = img.size
+        bbox = BBOX(xmin, ymax + img_h * resy, xmin + img_w * resx, ymax)
+
+        geoTrans2, size2 = _outGeoTrans(crs1, crs2, bbox, img_w, img_h, resx, resy, out_ul, out_size, out_res, sqPx)
+        data = warp.warp(np.ma.getdata(img.data), geoTrans1, getReproj(crs2, crs1), geoTrans2, size2, resamplAlg)
+
+        xmin, resx, _, ymax, _, resy = geoTrans2
+        georef = GeoRef(size2, (resx, resy), (xmin, ymax), pxCenter=False, crs=SRS(crs2))
+        img2 = NpImage(data, georef=georef)
+        if path is not None:
+                w, h = size2
+                with GeoTiffWriter(path, w, h, georef, nbBands=4 if img2.hasAlpha else 3) as writer:
+                        writer.paste(data, 0, 0)
+        return img2
+
 
 class Reproj():
 
@@ -199,6 +287,7 @@ class Reproj():
 
                 self._crs1 = crs1
                 self._crs2 = crs2
+                self.lock = threading.Lock() #GDAL transformations and engine fallback are not thread safe
 
                 if crs1 == crs2:
                         self.iproj = 'NO_REPROJ'
@@ -215,7 +304,7 @@ class Reproj():
                                 self.iproj = 'GDAL'
                         elif HAS_PYPROJ:
                                 self.iproj = 'PYPROJ'
-                        elif ((crs1.isWM or crs1.isUTM) and crs2.isWGS84) or (crs1.isWGS84 and (crs2.isWM or crs2.isUTM)):
+                        elif self._builtinFuncs() is not None:
                                 self.iproj = 'BUILTIN'
                         elif EPSGIO.ping():
                                 #this is the slower solution, not suitable for reproject lot of points
@@ -226,7 +315,7 @@ class Reproj():
                         if (self.iproj == 'GDAL' and not HAS_GDAL) or (self.iproj == 'PYPROJ' and not HAS_PYPROJ):
                                 raise ReprojError('Missing reproj engine')
                         if self.iproj == 'BUILTIN':
-                                if not ( ((crs1.isWM or crs1.isUTM) and crs2.isWGS84) or (crs1.isWGS84 and (crs2.isWM or crs2.isUTM)) ):
+                                if self._builtinFuncs() is None:
                                         raise ReprojError('Too limited built in reprojection capabilities')
                         if self.iproj == 'EPSGIO':
                                 if not  EPSGIO.ping():
@@ -234,13 +323,10 @@ class Reproj():
 
 
                 if self.iproj == 'GDAL':
-                        self.crs1 = self._crs1.getOgrSpatialRef()
-                        self.crs2 = self._crs2.getOgrSpatialRef()
-                        self.osrTransfo = osr.CoordinateTransformation(self.crs1, self.crs2)
+                        self._initGdal()
 
                 elif self.iproj == 'PYPROJ':
-                        self.crs1 = self._crs1.getPyProj()
-                        self.crs2 = self._crs2.getPyProj()
+                        self._initPyProj()
 
                 elif self.iproj == 'EPSGIO':
                         if crs1.isEPSG and crs2.isEPSG:
@@ -249,34 +335,53 @@ class Reproj():
                                 raise ReprojError('{} supports only EPSG code'.format(settings.epsgio_url))
 
                 elif self.iproj == 'BUILTIN':
-                        if ((crs1.isWM or crs1.isUTM) and crs2.isWGS84) or (crs1.isWGS84 and (crs2.isWM or crs2.isUTM)):
-                                #just store codes
-                                self.crs1, self.crs2 = crs1.code, crs2.code
-                        else:
-                                raise ReprojError('Not implemented transformation')
-                        #init UTM class
-                        if crs1.isUTM:
-                                self.utm = UTM.init_from_epsg(crs1)
-                        elif crs2.isUTM:
-                                self.utm = UTM.init_from_epsg(crs2)
+                        #just store codes
+                        self.crs1, self.crs2 = crs1.code, crs2.code
+                        #points are converted to WGS84 lon/lat then to the destination crs
+                        self.toLonLat, self.fromLonLat = self._builtinFuncs()
+
+        def _builtinFuncs(self):
+                '''Return the array functions (toLonLat, fromLonLat) of the built in engine for this transformation, None if not supported'''
+                funcs1, funcs2 = builtinFuncs(self._crs1), builtinFuncs(self._crs2)
+                if funcs1 is None or funcs2 is None:
+                        return None
+                return funcs1[0], funcs2[1]
 
 
         def _fallback(self):
+                with self.lock:
+                        if self.iproj != 'EPSGIO': #already switched by another thread
+                                return True
+                        return self._switchEngine()
+
+        def _switchEngine(self):
                 if HAS_GDAL:
-                        self.crs1 = self._crs1.getOgrSpatialRef()
-                        self.crs2 = self._crs2.getOgrSpatialRef()
-                        self.osrTransfo = osr.CoordinateTransformation(self.crs1, self.crs2)
+                        self._initGdal()
                         self.iproj = 'GDAL'
                         return True
                 elif HAS_PYPROJ:
-                        self.crs1 = self._crs1.getPyProj()
-                        self.crs2 = self._crs2.getPyProj()
+                        self._initPyProj()
                         self.iproj = 'PYPROJ'
                         return True
                 return False
 
+        def _initGdal(self):
+                self.crs1 = self._crs1.getOgrSpatialRef()
+                self.crs2 = self._crs2.getOgrSpatialRef()
+                self.osrTransfo = osr.CoordinateTransformation(self.crs1, self.crs2)
+                #Since PROJ 6, the order of coordinates for geographic crs is latitude first, longitude second.
+                self.swapIn = getGdalProjVersion() >= 6 and bool(self.crs1.IsGeographic())
+                self.swapOut = bool(self.crs2.IsGeographic())
+
+        def _initPyProj(self):
+                self.crs1 = self._crs1.getPyProj()
+                self.crs2 = self._crs2.getPyProj()
+                #building a transformer is slow, it is done once. always_xy keeps longitude first for geographic crs
+                self.transformer = pyproj.Transformer.from_crs(self.crs1.crs, self.crs2.crs, always_xy=True)
+
 
         def pts(self, pts):
+                '''Reproject a list of points [(x,y)], return a list of tuples [(x,y)], see ptsArray()'''
                 if len(pts) == 0:
                         return []
 
@@ -286,57 +391,55 @@ class Reproj():
                 if self.iproj == 'NO_REPROJ':
                         return pts
 
+                out = self.ptsArray(np.asarray(pts, dtype=np.float64))
+                return list(zip(out[:,0].tolist(), out[:,1].tolist()))
+
+        def ptsArray(self, pts):
+                '''
+                Reproject a (N,2) array of x, y coordinates, return a new (N,2) float64 array
+                This is the fast path for large sets of points, no python object is created per point
+                '''
+                pts = np.asarray(pts, dtype=np.float64)
+                if pts.ndim != 2 or pts.shape[1] != 2:
+                        raise ReprojError('Points must be a (N,2) array')
+
+                if self.iproj == 'NO_REPROJ' or len(pts) == 0:
+                        return pts.copy()
+
                 if self.iproj == 'GDAL':
-                        #Since PROJ 6, the order of coordinates for geographic crs is latitude first, longitude second.
-                        if hasattr(osr, 'GetPROJVersionMajor'):
-                                projVersion = osr.GetPROJVersionMajor()
-                        else:
-                                projVersion = 4
-                        if projVersion >= 6 and self.crs1.IsGeographic():
-                                pts = [ (pt[1], pt[0]) for pt in pts]
-                        if self.crs2.IsGeographic():
-                                ys, xs, _zs = zip(*self.osrTransfo.TransformPoints(pts))
-                        else:
-                                xs, ys, _zs = zip(*self.osrTransfo.TransformPoints(pts))
-                        return list(zip(xs, ys))
+                        if self.swapIn:
+                                pts = pts[:,::-1]
+                        with self.lock:
+                                out = np.asarray(self.osrTransfo.TransformPoints(np.ascontiguousarray(pts)), dtype=np.float64)[:,:2]
+                        if self.swapOut:
+                                out = out[:,::-1]
+                        return np.ascontiguousarray(out)
 
                 elif self.iproj == 'PYPROJ':
-                        if self.crs1.crs.is_geographic:
-                                ys, xs = zip(*pts)
-                        else:
-                                xs, ys = zip(*pts)
-                        transformer = pyproj.Transformer.from_proj(self.crs1, self.crs2)
-                        if self.crs2.crs.is_geographic:
-                                ys, xs = transformer.transform(xs, ys)
-                        else:
-                                xs, ys = transformer.transform(xs, ys)
-                        return list(zip(xs, ys))
+                        xs, ys = self.transformer.transform(pts[:,0], pts[:,1])
+                        return np.column_stack((xs, ys))
 
                 elif self.iproj == 'EPSGIO':
                         if len(pts) > EPSGIO.MAX_POINTS and self._fallback():
                                 log.warning('Switching from %s to local engine due to feature limit', settings.epsgio_url)
-                                return self.pts(pts)
+                                return self.ptsArray(pts)
                         try:
-                                return EPSGIO.reprojPts(self.crs1, self.crs2, pts)
+                                return np.array(EPSGIO.reprojPts(self.crs1, self.crs2, pts.tolist()), dtype=np.float64)
                         except Exception as e:
                                 log.warning('%s reprojection failed: %s', settings.epsgio_url, e)
                                 if self._fallback():
-                                        return self.pts(pts)
+                                        return self.ptsArray(pts)
                                 if isinstance(e, ReprojError):
                                         raise
                                 raise ReprojError(str(e))
 
                 elif self.iproj == 'BUILTIN':
-                        #Web Mercator
-                        if self.crs1 == 4326 and self.crs2 == 3857:
-                                return [lonLatToWebMerc(*pt) for pt in pts]
-                        elif self.crs1 == 3857 and self.crs2 == 4326:
-                                return [webMercToLonLat(*pt) for pt in pts]
-                        #UTM
-                        if self.crs1 == 4326 and self.crs2 in UTM_EPSG_CODES:
-                                return [self.utm.lonlat_to_utm(*pt) for pt in pts]
-                        elif self.crs1 in UTM_EPSG_CODES and self.crs2 == 4326:
-                                return [self.utm.utm_to_lonlat(*pt) for pt in pts]
+                        out = pts
+                        if self.toLonLat is not None:
+                                out = self.toLonLat(out)
+                        if self.fromLonLat is not None:
+                                out = self.fromLonLat(out)
+                        return out.copy() if out is pts else out
 
         def pt(self, x, y):
                 if x is None or y is None:
@@ -360,14 +463,76 @@ class Reproj():
 
 
 
+class ReprojRegistry():
+        '''
+        Thread safe and bounded registry of the Reproj objects already built, least recently used ones are dropped first
+        Objects are keyed by the normalized crs pair and the proj engine, the registry is emptied when
+        settings.proj_engine changes. Building a Reproj parses both crs, creates the engine objects
+        and can even ping the EPSGIO service, so it should be done once per crs pair.
+        '''
+
+        MAX_SIZE = 64
+
+        def __init__(self, maxSize=None):
+                self.maxSize = maxSize or self.MAX_SIZE
+                self.reprojs = OrderedDict() #{(crs1, crs2, engine) : Reproj}
+                self.engine = settings.proj_engine
+                self.lock = threading.Lock()
+
+        def __len__(self):
+                return len(self.reprojs)
+
+        @staticmethod
+        def normalize(crs):
+                '''Return the string identifying a crs input, EPSG code or SRID are expressed as AUTH:CODE'''
+                try:
+                        crs = SRS(crs)
+                except Exception as e:
+                        raise ReprojError(str(e))
+                if crs.isSRID:
+                        return crs.SRID
+                return ' '.join(crs.proj4.split())
+
+        def get(self, crs1, crs2):
+                '''Return the Reproj object from crs1 to crs2, it is built on first request'''
+                engine = settings.proj_engine
+                key = (self.normalize(crs1), self.normalize(crs2), engine)
+                with self.lock:
+                        if engine != self.engine:
+                                self.reprojs.clear()
+                                self.engine = engine
+                        rprj = self.reprojs.get(key)
+                        if rprj is not None:
+                                self.reprojs.move_to_end(key)
+                                return rprj
+                #build outside the lock, if 2 threads race for a same pair the first registered object is kept
+                rprj = Reproj(key[0], key[1])
+                with self.lock:
+                        if engine != self.engine:
+                                return rprj
+                        rprj = self.reprojs.setdefault(key, rprj)
+                        self.reprojs.move_to_end(key)
+                        while len(self.reprojs) > self.maxSize:
+                                self.reprojs.popitem(last=False)
+                return rprj
+
+        def clear(self):
+                with self.lock:
+                        self.reprojs.clear()
+
+reprojRegistry = ReprojRegistry()
+
+def getReproj(crs1, crs2):
+        '''Return a ready to use Reproj object from crs1 to crs2, shared by all the callers (see ReprojRegistry)'''
+        return reprojRegistry.get(crs1, crs2)
+
+
 def reprojPt(crs1, crs2, x, y):
         """
         Reproject x1,y1 coords from crs1 to crs2
         crs can be an EPSG code (interger or string) or a proj4 string
-        WARN : do not use this function in a loop because Reproj() init is slow
         """
-        rprj = Reproj(crs1, crs2)
-        return rprj.pt(x, y)
+        return getReproj(crs1, crs2).pt(x, y)
 
 
 def reprojPts(crs1, crs2, pts):
@@ -375,11 +540,8 @@ def reprojPts(crs1, crs2, pts):
         Reproject [pts] from crs1 to crs2
         crs can be an EPSG code (integer or srid string) or a proj4 string
         pts must be [(x,y)]
-        WARN : do not use this function in a loop because Reproj() init is slow
         """
-        rprj = Reproj(crs1, crs2)
-        return rprj.pts(pts)
+        return getReproj(crs1, crs2).pts(pts)
 
 def reprojBbox(crs1, crs2, bbox):
-        rprj = Reproj(crs1, crs2)
-        return rprj.bbox(bbox)
+        return getReproj(crs1, crs2).bbox(bbox)
@@ -21,6 +21,7 @@ log = logging.getLogger(__name__)
 
 from .utm import UTM, UTM_EPSG_CODES
 from .srv import EPSGIO
+from .epsgdb import epsgDB
 
 from ..checkdeps import HAS_GDAL, HAS_PYPROJ
 
@@ -174,11 +175,14 @@ class SRS():
 
 
 	def loadProj4(self):
-		'''Return a Python dict of proj4 parameters'''
+		'''Return a Python dict of proj4 parameters, the ones of EPSG codes are read from the offline EPSG database'''
 		dc = {}
-		if self.proj4 is None:
+		proj4 = self.proj4
+		if self.isEPSG:
+			proj4 = epsgDB.getProj4(self.code) or proj4
+		if proj4 is None:
 			return dc
-		for param in self.proj4.split(' '):
+		for param in proj4.split(' '):
 			if param.count('=') == 1:
 				k, v = param.split('=')
 				try:
@@ -190,10 +194,22 @@ class SRS():
 				pass
 		return dc
 
+	@property
+	def name(self):
+		'''Name of the crs in the EPSG registry, None if unknown'''
+		if self.isEPSG:
+			crs = epsgDB.get(self.code)
+			if crs is not None:
+				return crs['name']
+		return None
+
 	@property
 	def isGeo(self):
 		if self.code == 4326:
 			return True
+		crs = epsgDB.get(self.code) if self.isEPSG else None
+		if crs is not None:
+			return crs['kind'] == 'geographic'
 		elif HAS_GDAL:
 			prj = self.getOgrSpatialRef()
 			isGeo = prj.IsGeographic()
@@ -209,6 +225,7 @@ class SRS():
 			prj = self.getOgrSpatialRef()
 			return prj.ExportToWkt()
 		elif self.isEPSG:
-			return EPSGIO.getEsriWkt(self.code)
+			#offline EPSG database, then web service
+			return epsgDB.getWkt(self.code) or EPSGIO.getEsriWkt(self.code)
 		else:
 			raise NotImplementedError
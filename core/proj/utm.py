@@ -9,6 +9,7 @@
 # formulas : https://en.wikipedia.org/wiki/Universal_Transverse_Mercator_coordinate_system
 
 import math
+import numpy as np
 
 
 K0 = 0.9996
@@ -126,38 +127,49 @@ class UTM():
 
 
 	def utm_to_lonlat(self, easting, northing):
+		lon, lat = self.utm_to_lonlat_array(np.array([[easting, northing]], dtype=float))[0]
+		return float(lon), float(lat)
 
-		if not 100000 <= easting < 1000000:
+	def lonlat_to_utm(self, longitude, latitude):
+		easting, northing = self.lonlat_to_utm_array(np.array([[longitude, latitude]], dtype=float))[0]
+		return float(easting), float(northing)
+
+
+	def utm_to_lonlat_array(self, pts):
+		'''Convert a (N,2) array of easting, northing to a (N,2) array of longitude, latitude'''
+		easting, northing = pts[:, 0], pts[:, 1]
+
+		if not np.all((easting >= 100000) & (easting < 1000000)):
 			raise OutOfRangeError('easting out of range (must be between 100.000 m and 999.999 m)')
-		if not 0 <= northing <= 10000000:
+		if not np.all((northing >= 0) & (northing <= 10000000)):
 			raise OutOfRangeError('northing out of range (must be between 0 m and 10.000.000 m)')
 
 		x = easting - 500000
 		y = northing
 
 		if not self.northern:
-			y -= 10000000
+			y = y - 10000000
 
 		m = y / K0
 		mu = m / (R * M1)
 
 		p_rad = (mu +
-				 P2 * math.sin(2 * mu) +
-				 P3 * math.sin(4 * mu) +
-				 P4 * math.sin(6 * mu) +
-				 P5 * math.sin(8 * mu))
+				 P2 * np.sin(2 * mu) +
+				 P3 * np.sin(4 * mu) +
+				 P4 * np.sin(6 * mu) +
+				 P5 * np.sin(8 * mu))
 
-		p_sin = math.sin(p_rad)
+		p_sin = np.sin(p_rad)
 		p_sin2 = p_sin * p_sin
 
-		p_cos = math.cos(p_rad)
+		p_cos = np.cos(p_rad)
 
 		p_tan = p_sin / p_cos
 		p_tan2 = p_tan * p_tan
 		p_tan4 = p_tan2 * p_tan2
 
 		ep_sin = 1 - E * p_sin2
-		ep_sin_sqrt = math.sqrt(1 - E * p_sin2)
+		ep_sin_sqrt = np.sqrt(ep_sin)
 
 		n = R / ep_sin_sqrt
 		r = (1 - E) / ep_sin
@@ -181,29 +193,34 @@ class UTM():
 					 d3 / 6 * (1 + 2 * p_tan2 + c) +
 					 d5 / 120 * (5 - 2 * c + 28 * p_tan2 - 3 * c2 + 8 * E_P2 + 24 * p_tan4)) / p_cos
 
-		return (math.degrees(longitude) + zone_number_to_central_longitude(self.zone_number),
-				math.degrees(latitude))
+		out = np.empty((len(pts), 2))
+		out[:, 0] = np.degrees(longitude) + zone_number_to_central_longitude(self.zone_number)
+		out[:, 1] = np.degrees(latitude)
+		return out
 
 
-	def lonlat_to_utm(self, longitude, latitude):
-		if not -80.0 <= latitude <= 84.0:
+	def lonlat_to_utm_array(self, pts):
+		'''Convert a (N,2) array of longitude, latitude to a (N,2) array of easting, northing'''
+		longitude, latitude = pts[:, 0], pts[:, 1]
+
+		if not np.all((latitude >= -80.0) & (latitude <= 84.0)):
 			raise OutOfRangeError('latitude out of range (must be between 80 deg S and 84 deg N)')
-		if not -180.0 <= longitude <= 180.0:
+		if not np.all((longitude >= -180.0) & (longitude <= 180.0)):
 			raise OutOfRangeError('longitude out of range (must be between 180 deg W and 180 deg E)')
 
-		lat_rad = math.radians(latitude)
-		lat_sin = math.sin(lat_rad)
-		lat_cos = math.cos(lat_rad)
+		lat_rad = np.radians(latitude)
+		lat_sin = np.sin(lat_rad)
+		lat_cos = np.cos(lat_rad)
 
 		lat_tan = lat_sin / lat_cos
 		lat_tan2 = lat_tan * lat_tan
 		lat_tan4 = lat_tan2 * lat_tan2
 
-		lon_rad = math.radians(longitude)
+		lon_rad = np.radians(longitude)
 		central_lon = zone_number_to_central_longitude(self.zone_number)
 		central_lon_rad = math.radians(central_lon)
 
-		n = R / math.sqrt(1 - E * lat_sin**2)
+		n = R / np.sqrt(1 - E * lat_sin**2)
 		c = E_P2 * lat_cos**2
 
 		a = lat_cos * (lon_rad - central_lon_rad)
@@ -214,9 +231,9 @@ class UTM():
 		a6 = a5 * a
 
 		m = R * (M1 * lat_rad -
-				 M2 * math.sin(2 * lat_rad) +
-				 M3 * math.sin(4 * lat_rad) -
-				 M4 * math.sin(6 * lat_rad))
+				 M2 * np.sin(2 * lat_rad) +
+				 M3 * np.sin(4 * lat_rad) -
+				 M4 * np.sin(6 * lat_rad))
 
 		easting = K0 * n * (a +
 							a3 / 6 * (1 - lat_tan2 + c) +
@@ -227,10 +244,9 @@ class UTM():
 											a6 / 720 * (61 - 58 * lat_tan2 + lat_tan4 + 600 * c - 330 * E_P2)))
 
 		if not self.northern:
-			northing += 10000000
-
-		return easting, northing
-
-
-
+			northing = northing + 10000000
 
+		out = np.empty((len(pts), 2))
+		out[:, 0] = easting
+		out[:, 1] = northing
+		return out
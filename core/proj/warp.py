@@ -0,0 +1,186 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+'''
+Raster reprojection with numpy only, used by reprojImg() when GDAL is not available
+
+The inverse transformation (destination to source coordinates) is computed exactly on a coarse
+control grid of the output raster then bilinearly interpolated for every pixel, like GDAL does
+with its approximate transformer. Pixel values are then sampled from the source array.
+'''
+
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
+
+from ..errors import ReprojError
+
+
+# Spacing in pixels between two nodes of the control grid
+GRID_STEP = 16
+
+# Resampling kernels available, others GDAL algorithms fall back to cubic
+RESAMP_ALGS = ('NN', 'BL', 'CB')
+
+
+def _gridNodes(size, step):
+        '''Pixel indices of the control grid nodes along one axis, first and last pixels included'''
+        nodes = np.arange(0, size, step)
+        if nodes[-1] != size - 1:
+                nodes = np.append(nodes, size - 1)
+        return nodes
+
+def _interpWeights(size, nodes):
+        '''For each pixel index of an axis, return the index of the previous node and the interpolation weight'''
+        idx = np.arange(size)
+        k = np.clip(np.searchsorted(nodes, idx, side='right') - 1, 0, max(len(nodes) - 2, 0))
+        if len(nodes) == 1:
+                return k, np.zeros(size)
+        t = (idx - nodes[k]) / (nodes[k+1] - nodes[k])
+        return k, t
+
+def _interpGrid(values, nodesY, nodesX, h, w):
+        '''Bilinear interpolation of values known at control grid nodes over the full (h, w) raster'''
+        ky, ty = _interpWeights(h, nodesY)
+        kx, tx = _interpWeights(w, nodesX)
+        if values.shape[1] > 1:
+                rows = values[:, kx] * (1 - tx) + values[:, kx+1] * tx
+        else:
+                rows = np.repeat(values, w, axis=1)
+        if values.shape[0] > 1:
+                return rows[ky] * (1 - ty)[:, None] + rows[ky+1] * ty[:, None]
+        return np.repeat(rows, h, axis=0)
+
+
+def srcPxCoords(rprj, geoTrans1, geoTrans2, size2, step=GRID_STEP):
+        '''
+        Return 2 float arrays (h, w) holding the source pixel coordinates (column, row) of the center of each destination pixel
+        rprj : a Reproj object from destination crs to source crs
+        geoTrans1, geoTrans2 : source and destination GDAL like geotransforms (xmin, resx, 0, ymax, 0, resy)
+        size2 : destination raster size (w, h)
+        NaN means the destination pixel cannot be reprojected
+        '''
+        w, h = size2
+        xmin2, resx2, _, ymax2, _, resy2 = geoTrans2
+        xmin1, resx1, rotx1, ymax1, roty1, resy1 = geoTrans1
+        if rotx1 != 0 or roty1 != 0:
+                raise ReprojError('Raster must be rectified (no rotation parameters)')
+
+        nodesX, nodesY = _gridNodes(w, step), _gridNodes(h, step)
+        xs = xmin2 + (nodesX + 0.5) * resx2
+        ys = ymax2 + (nodesY + 0.5) * resy2
+        gx, gy = np.meshgrid(xs, ys)
+        pts = np.column_stack((gx.ravel(), gy.ravel()))
+        try:
+                pts = rprj.ptsArray(pts)
+        except Exception as e:
+                #some nodes can fall outside the domain of validity of the projection
+                log.debug('Warp control grid reprojection fails, switching to a point by point reprojection : {}'.format(e))
+                pts = np.array([_safePt(rprj, pt) for pt in pts.tolist()], dtype=float)
+        pts[~np.isfinite(pts)] = np.nan
+
+        #convert to source pixel space (pixel centers at integer coords)
+        px = (pts[:,0] - xmin1) / resx1 - 0.5
+        py = (pts[:,1] - ymax1) / resy1 - 0.5
+        shape = (len(nodesY), len(nodesX))
+        px = _interpGrid(px.reshape(shape), nodesY, nodesX, h, w)
+        py = _interpGrid(py.reshape(shape), nodesY, nodesX, h, w)
+        return px, py
+
+def _safePt(rprj, pt):
+        try:
+                return rprj.pt(*pt)
+        except Exception:
+                return (np.nan, np.nan)
+
+
+def _cubicWeights(t):
+        '''Keys cubic convolution kernel weights (a = -0.5) for the 4 taps around each sample'''
+        t2, t3 = t*t, t*t*t
+        return (
+                -0.5*t3 + t2 - 0.5*t,
+                1.5*t3 - 2.5*t2 + 1,
+                -1.5*t3 + 2*t2 + 0.5*t,
+                0.5*t3 - 0.5*t2
+        )
+
+def resample(data, px, py, resamplAlg='BL', fill=0):
+        '''
+        Sample a source array (h, w) or (h, w, bands) at the given float pixel coordinates
+        resamplAlg : NN (nearest), BL (bilinear), CB (cubic)
+        Samples outside the source raster are set to the fill value
+        '''
+        if resamplAlg not in RESAMP_ALGS:
+                resamplAlg = 'CB'
+        h1, w1 = data.shape[:2]
+        oneBand = data.ndim == 2
+        if oneBand:
+                data = data[:, :, None]
+
+        valid = (px >= -0.5) & (px <= w1 - 0.5) & (py >= -0.5) & (py <= h1 - 0.5) #NaN comparisons are False
+        px = np.where(valid, px, 0)
+        py = np.where(valid, py, 0)
+
+        if resamplAlg == 'NN':
+                ix = np.clip(np.floor(px + 0.5).astype(np.intp), 0, w1 - 1)
+                iy = np.clip(np.floor(py + 0.5).astype(np.intp), 0, h1 - 1)
+                out = data[iy, ix]
+        else:
+                x0, y0 = np.floor(px), np.floor(py)
+                tx, ty = (px - x0)[..., None], (py - y0)[..., None]
+                x0, y0 = x0.astype(np.intp), y0.astype(np.intp)
+                if resamplAlg == 'BL':
+                        offsets = (0, 1)
+                        wx = (1 - tx, tx)
+                        wy = (1 - ty, ty)
+                else:
+                        offsets = (-1, 0, 1, 2)
+                        wx = _cubicWeights(tx)
+                        wy = _cubicWeights(ty)
+                out = np.zeros(px.shape + (data.shape[2],), dtype=np.float32)
+                for j, dy in enumerate(offsets):
+                        iy = np.clip(y0 + dy, 0, h1 - 1)
+                        row = np.zeros_like(out)
+                        for i, dx in enumerate(offsets):
+                                ix = np.clip(x0 + dx, 0, w1 - 1)
+                                row += data[iy, ix] * wx[i]
+                        out += row * wy[j]
+                if np.issubdtype(data.dtype, np.integer):
+                        info = np.iinfo(data.dtype)
+                        out = np.clip(np.rint(out), info.min, info.max)
+                out = out.astype(data.dtype)
+
+        out[~valid] = fill
+        if oneBand:
+                out = out[:, :, 0]
+        return out
+
+
+def warp(data, geoTrans1, rprj, geoTrans2, size2, resamplAlg='BL', fill=0, step=GRID_STEP):
+        '''
+        Reproject a numpy array
+        data : source array (h, w) or (h, w, bands)
+        geoTrans1 : GDAL like geotransform of the source array
+        rprj : a Reproj object from destination crs to source crs (inverse transformation)
+        geoTrans2, size2 : geotransform and (w, h) size of the output array
+        return a new array with the same dtype and number of bands
+        '''
+        px, py = srcPxCoords(rprj, geoTrans1, geoTrans2, size2, step)
+        return resample(data, px, py, resamplAlg, fill)
@@ -81,6 +81,12 @@ class BaseMap(GeoScene):
 		#Get resampling algo preference and set the constant
 		MapService.RESAMP_ALG = prefs.resamplAlg
 
+		#Cache databases size quota
+		MapService.CACHE_MAX_SIZE = prefs.cacheMaxSize * 1024**2 or None
+
+		#Layers cached as decoded tiles
+		MapService.RAW_LAYERS = set(key.strip().upper() for key in prefs.rawLayers.split(',') if key.strip())
+
 		#Init MapService class
 		self.srv = MapService(srckey, cacheFolder)
 		self.name = srckey + '_' + laykey + '_' + grdkey
@@ -129,6 +135,8 @@ class BaseMap(GeoScene):
 
 		#Thread attributes
 		self.thread = None
+		self.view = None #next view to request (bbox, center, zoom), see get()
+		self.lock = threading.Lock()
 		#Background image attributes
 		self.img = None #bpy image
 		self.bkg = None #empty image obj
@@ -138,35 +146,62 @@ class BaseMap(GeoScene):
 
 
 	def get(self):
-		'''Launch run() function in a new thread'''
-		self.stop()
-		self.srv.start()
-		self.thread = threading.Thread(target=self.run)
-		self.thread.start()
+		'''
+		Request the map of the current view, run() is launched in a new thread if no request is running.
+		Otherwise the running request is preempted : its queued tiles are switched to the new view, the tiles
+		already downloading are kept, and the thread processes the new view as soon as the request ends
+		'''
+		view = self.getView()
+		with self.lock:
+			self.view = view
+			if self.thread is not None:
+				bbox, center, zoom = view
+				self.srv.preempt(self.laykey, bbox, zoom, toDstGrid=self.toDstGrid, center=center)
+				return
+			self.srv.start()
+			self.thread = threading.Thread(target=self.run)
+			self.thread.start()
 
 	def stop(self):
 		'''Stop actual thread'''
-		if self.srv.running:
+		with self.lock:
+			self.view = None
 			self.srv.stop()
-			self.thread.join()
+			thread = self.thread
+		if thread is not None:
+			thread.join()
 
 	def run(self):
-		"""thread method"""
-		self.mosaic = self.request()
-		if self.srv.running and self.mosaic is not None:
-			#save image
-			self.mosaic.save(self.imgPath)
-		if self.srv.running:
-			#Place background image
-			self.place()
-		self.srv.stop()
+		"""thread method, process the requested views until there is no new one"""
+		while True:
+			with self.lock:
+				view, self.view = self.view, None
+				if view is None or not self.srv.running:
+					self.srv.stop()
+					self.thread = None
+					return
+			self.mosaic = self.request(*view)
+			with self.lock:
+				if self.view is not None:
+					#outdated, its tiles have been reused by the request of the new view
+					continue
+			if self.srv.running and self.mosaic is not None:
+				#save image
+				self.mosaic.save(self.imgPath)
+			if self.srv.running:
+				#Place background image
+				self.place()
 
 	def moveOrigin(self, dx, dy, useScale=True, updObjLoc=True):
 		'''Move scene origin and update props'''
 		self.moveOriginPrj(dx, dy, useScale, updObjLoc, self.synchOrj) #geoscene function
 
-	def request(self):
-		'''Request map service to build a mosaic of required tiles to cover view3d area'''
+	@property
+	def toDstGrid(self):
+		return self.srv.srcGridKey != self.grdkey
+
+	def getView(self):
+		'''Return the (bbox, center, zoom) request that cover view3d area, in destination tile matrix crs'''
 		#Get area dimension
 		w, h = self.area.width, self.area.height
 		#w, h = self.area3d.width, self.area3d.height #WARN return [1,1] !!!!????
@@ -186,9 +221,11 @@ class BaseMap(GeoScene):
 		xmax = ox + w/2 * res * self.scale
 		ymin = oy - h/2 * res * self.scale
 		bbox = (xmin, ymin, xmax, ymax)
+		center = (ox, oy)
 		#reproj bbox to destination grid crs if scene crs is different
 		if self.crs != self.tm.CRS:
 			bbox = reprojBbox(self.crs, self.tm.CRS, bbox)
+			center = reprojPt(self.crs, self.tm.CRS, ox, oy)
 
 		'''
 		#Method 2
@@ -198,17 +235,14 @@ class BaseMap(GeoScene):
 			bbox = reprojBbox(self.crs, self.tm.CRS, bbox)
 		'''
 
-		log.debug('Bounding box request : {}'.format(bbox))
-
-		#Stop thread if the request is same as previous
-		#TODO
+		return bbox, center, self.zoom
 
-		if self.srv.srcGridKey == self.grdkey:
-			toDstGrid = False
-		else:
-			toDstGrid = True
+	def request(self, bbox, center, zoom):
+		'''Request map service to build a mosaic of required tiles to cover view3d area'''
+		log.debug('Bounding box request : {}'.format(bbox))
 
-		mosaic = self.srv.getImage(self.laykey, bbox, self.zoom, toDstGrid=toDstGrid, outCRS=self.crs)
+		#tiles at the center of the view are downloaded first
+		mosaic = self.srv.getImage(self.laykey, bbox, zoom, toDstGrid=self.toDstGrid, outCRS=self.crs, center=center)
 
 		return mosaic
 
@@ -970,6 +1004,7 @@ class VIEW3D_OT_map_viewer(Operator):
 				context.window.cursor_set('DEFAULT')
 			else:
 				self.map.stop()
+				self.map.srv.close()
 				bpy.types.SpaceView3D.draw_handler_remove(self._drawTextHandler, 'WINDOW')
 				bpy.types.SpaceView3D.draw_handler_remove(self._drawZoomBoxHandler, 'WINDOW')
 				context.area.header_text_set(None)
@@ -11,6 +11,7 @@ import addon_utils
 from . import bl_info
 from .core.proj.reproj import EPSGIO
 from .core.proj.srs import SRS
+from .core.proj.epsgdb import epsgDB
 from .core import checkdeps, settings
 
 PKG = __package__
@@ -241,6 +242,19 @@ class BGIS_PREFS(AddonPreferences):
                 update = updateCacheFolder
                 )
 
+        cacheMaxSize: IntProperty(
+                name = "Cache size limit (MB)",
+                description = "Maximum size of each basemap cache database, least recently used tiles are deleted above this limit (0 for no limit)",
+                default = 0,
+                min = 0
+                )
+
+        rawLayers: StringProperty(
+                name = "Raw cache layers",
+                description = "Comma separated list of layers (as SOURCE_LAYER, ie GOOGLE_SAT) cached as decoded tiles. Faster to display but about 256 KB per tile on disk",
+                default = ""
+                )
+
         synchOrj: BoolProperty(
                 name="Synch. lat/long",
                 description='Keep geo origin synchronized with crs origin. Can be slow with remote reprojection services',
@@ -347,6 +361,8 @@ class BGIS_PREFS(AddonPreferences):
                 box = layout.box()
                 box.label(text='Basemaps')
                 box.prop(self, "cacheFolder")
+                box.prop(self, "cacheMaxSize")
+                box.prop(self, "rawLayers")
                 row = box.row()
                 row.prop(self, "zoomToMouse")
                 row.prop(self, "lockObj")
@@ -454,14 +470,17 @@ class BGIS_OT_add_predef_crs(Operator):
 		return True
 
 	def search(self, context):
-		if not EPSGIO.ping():
-			self.report({'ERROR'}, f"Cannot request {settings.epsgio_url} website")
-		else:
+		#offline EPSG database first, the web service is only used if it has no result
+		results = epsgDB.search(self.query)
+		if not results:
+			if not EPSGIO.ping():
+				self.report({'ERROR'}, f"Cannot request {settings.epsgio_url} website")
+				return
 			results = EPSGIO.search(self.query)
-			self.results = json.dumps(results)
-			if results:
-				self.crs = 'EPSG:' + results[0]['code']
-				self.name = results[0]['name']
+		self.results = json.dumps(results)
+		if results:
+			self.crs = 'EPSG:' + results[0]['code']
+			self.name = results[0]['name']
 
 	def updEnum(self, context):
 		crsItems = []
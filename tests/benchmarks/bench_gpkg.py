@@ -0,0 +1,64 @@
+"""
+Per tile lookup latency of the GeoPackage cache, with a new connection per call versus pooled connections
+
+Run from the repository root:
+    python tests/benchmarks/bench_gpkg.py [nbLookups] [nbThread]
+
+The cache is filled with small fake tiles, lookups pick random tiles so both hits and misses are measured.
+"""
+import sys
+import time
+import random
+import sqlite3
+import datetime
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parents[1]))
+
+from core.basemaps import GRIDS, TileMatrix, GeoPackage
+
+
+def legacy_getTile(gpkg, x, y, z):
+    """One connection per call with timestamp parsing, as it was done before"""
+    db = sqlite3.connect(gpkg.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
+    query = 'SELECT tile_data, last_modified FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+    result = db.execute(query, (z, x, y)).fetchone()
+    db.close()
+    if result is None:
+        return None
+    if (datetime.datetime.now() - result[1]).days > gpkg.MAX_DAYS:
+        return None
+    return result[0]
+
+
+def run(getTile, tiles, nbThread):
+    t0 = time.perf_counter()
+    if nbThread > 1:
+        with ThreadPoolExecutor(nbThread) as pool:
+            list(pool.map(lambda t: getTile(*t), tiles))
+    else:
+        for t in tiles:
+            getTile(*t)
+    return time.perf_counter() - t0
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    nbThread = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    z = 12
+    with tempfile.TemporaryDirectory() as folder:
+        gpkg = GeoPackage(folder + "/bench.gpkg", TileMatrix(GRIDS["WM"]))
+        gpkg.putTiles([(x, y, z, bytes(2000)) for x in range(100) for y in range(100)])
+        rng = random.Random(0)
+        tiles = [(rng.randrange(120), rng.randrange(100), z) for i in range(n)]
+        for name, getTile in (("connect per call", lambda *t: legacy_getTile(gpkg, *t)), ("pooled connections", gpkg.getTile)):
+            dt = run(getTile, tiles, nbThread)
+            print("{:<20} {:>7} lookups {:>2} threads {:8.1f} us/tile".format(name, n, nbThread, dt / n * 1e6))
+        gpkg.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Mosaic assembly time of MapService.getImage from a pre-seeded cache
+
+Run from the repository root (requires Pillow):
+    python tests/benchmarks/bench_mosaic.py [nbTilesPerSide] [format]
+
+The cache is filled with noisy 256px tiles so decoding cost is realistic, no network is involved.
+"""
+import io
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parents[1]))
+
+from core.basemaps import mapservice, servicesDefs
+from core.georaster import NpImage
+
+
+def make_tiles(n, z, x0, y0, fmt):
+    rng = np.random.default_rng(0)
+    tiles = []
+    for x in range(x0, x0 + n):
+        for y in range(y0, y0 + n):
+            arr = rng.integers(0, 255, (256, 256, 3), dtype=np.uint8)
+            arr[::2, ::2] = (x % 255, y % 255, 0) #add some structure
+            b = io.BytesIO()
+            Image.fromarray(arr).save(b, format=fmt)
+            tiles.append((x, y, z, b.getvalue()))
+    return tiles
+
+
+def legacy(ms, rq, cache):
+    """Serial decode and paste loop, as it was done before"""
+    tileSize = rq.tileSize
+    mosaic = NpImage.new(rq.nbTilesX * tileSize, rq.nbTilesY * tileSize)
+    for col, row, z, data in cache.getTiles(rq.tiles):
+        img = NpImage(data)
+        mosaic.paste(img, (col - rq.firstCol) * tileSize, abs(row - rq.firstRow) * tileSize)
+    return mosaic
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    fmt = sys.argv[2] if len(sys.argv) > 2 else "JPEG"
+    z, x0, y0 = 12, 2000, 1400
+    servicesDefs.SOURCES["BENCH"] = {
+        "name": "bench", "description": "", "service": "TMS", "grid": "WM", "quadTree": False,
+        "layers": {"BASIC": {"urlKey": "", "name": "", "description": "", "format": "png", "zmin": 0, "zmax": 20}},
+        "urlTemplate": "http://127.0.0.1:9/{Z}/{X}/{Y}.png", "referer": "",
+    }
+    with tempfile.TemporaryDirectory() as cacheFolder:
+        ms = mapservice.MapService("BENCH", cacheFolder)
+        cache = ms.getCache("BASIC", False)
+        cache.putTiles(make_tiles(n, z, x0, y0, fmt))
+        tm = ms.srcTms
+        xmin, _, _, ymax = tm.getTileBbox(x0, y0, z)
+        _, ymin, xmax, _ = tm.getTileBbox(x0 + n - 1, y0 + n - 1, z)
+        bbox = (xmin + 1, ymin + 1, xmax - 1, ymax - 1)
+        rq = tm.bboxRequest(bbox, z)
+        print("{}x{} {} tiles, {:.0f} megapixels".format(n, n, fmt, (n * 256) ** 2 / 1e6))
+
+        t0 = time.perf_counter()
+        legacy(ms, rq, cache)
+        print("{:<28} {:6.2f}s".format("legacy serial loop", time.perf_counter() - t0))
+
+        ms.start()
+        for threads in sorted({1, 2, 4, os.cpu_count() or 1}):
+            ms.tileCache.clear() #measure decoding, not the memory cache
+            t0 = time.perf_counter()
+            ms.getImage("BASIC", bbox, z, toDstGrid=False, decodeThreads=threads)
+            print("{:<28} {:6.2f}s".format("getImage decodeThreads={}".format(threads), time.perf_counter() - t0))
+        t0 = time.perf_counter()
+        ms.getImage("BASIC", bbox, z, toDstGrid=False)
+        print("{:<28} {:6.2f}s".format("getImage decoded in memory", time.perf_counter() - t0))
+        ms.stop()
+
+
+if __name__ == "__main__":
+    main()
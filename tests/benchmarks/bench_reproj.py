@@ -0,0 +1,43 @@
+"""
+Reprojection throughput of the built-in engine, list API (Reproj.pts) vs array API (Reproj.ptsArray)
+
+Run from the repository root:
+    python tests/benchmarks/bench_reproj.py [nbPoints]
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parents[1]))
+
+from core.proj.reproj import Reproj
+
+
+def bench(f, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f(*args)
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = np.random.default_rng(0)
+    for crs1, crs2, lonRange in [(4326, 3857, (-180, 180)), (4326, 32631, (0, 6))]:
+        arr = np.column_stack((rng.uniform(*lonRange, n), rng.uniform(0, 80, n)))
+        pts = list(map(tuple, arr.tolist()))
+        rprj = Reproj(crs1, crs2)
+        tList = bench(rprj.pts, pts)
+        tArray = bench(rprj.ptsArray, arr)
+        print('EPSG:{} -> EPSG:{} {} points : list {:.3f}s, array {:.3f}s ({:.1f} Mpts/s)'.format(
+            crs1, crs2, n, tList, tArray, n / tArray / 1e6))
+
+
+if __name__ == '__main__':
+    main()
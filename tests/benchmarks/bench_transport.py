@@ -0,0 +1,52 @@
+"""
+Tile download throughput with and without connection pooling
+
+Run from the repository root:
+    python tests/benchmarks/bench_transport.py [nbTiles] [nbThread]
+
+Tiles are served by a local http.server stand-in, so the numbers mostly reflect
+the cost of opening connections and not the remote server speed.
+"""
+import sys
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parents[1]))
+sys.path.insert(0, str(HERE.parent))
+
+from core.basemaps import mapservice, servicesDefs
+from core.basemaps.transport import PooledTransport, UrllibTransport
+from tileserver import TileServer
+
+
+def run(transport, srv, nbTiles, nbThread):
+    servicesDefs.SOURCES["BENCH"] = srv.source()
+    with tempfile.TemporaryDirectory() as cacheFolder:
+        ms = mapservice.MapService("BENCH", cacheFolder, transport=transport)
+        z = 12
+        tiles = [(x, y, z) for x in range(100) for y in range(nbTiles // 100 + 1)][:nbTiles]
+        c0 = srv.connections
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(nbThread) as pool:
+            results = list(pool.map(lambda t: ms.downloadTile("BASIC", *t), tiles))
+        dt = time.perf_counter() - t0
+        transport.close()
+    assert all(r is not None for r in results)
+    return dt, srv.connections - c0
+
+
+def main():
+    nbTiles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    nbThread = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with TileServer() as srv:
+        for name, transport in (("urllib (no pooling)", UrllibTransport()), ("pooled keep-alive", PooledTransport())):
+            dt, nbConn = run(transport, srv, nbTiles, nbThread)
+            print("{:<22} {:>6} tiles in {:6.2f}s  {:>8.0f} tiles/s  {:>5} connections".format(
+                name, nbTiles, dt, nbTiles / dt, nbConn))
+
+
+if __name__ == "__main__":
+    main()
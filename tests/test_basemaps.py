@@ -57,3 +57,663 @@ def test_tile_retrieval(tmp_path, monkeypatch):
     col, row, z, data = ms.getTile("BASIC", 0, 0, 0, toDstGrid=False)
     assert (col, row, z) == (0, 0, 0)
     assert data == PNG_DATA
+
+
+def test_pooled_transport_reuses_connections():
+    from core.basemaps.transport import PooledTransport, UrllibTransport
+    from tileserver import TileServer
+
+    with TileServer() as srv:
+        with PooledTransport(poolSize=2, maxPerHost=2) as transport:
+            for x in range(5):
+                r = transport.request(srv.url + "/3/{}/1.png".format(x), timeout=4)
+                assert r.status == 200
+                assert r.data == srv.tile(x, 1, 3)
+        assert srv.connections == 1
+
+        r = UrllibTransport().request(srv.url + "/3/0/0.png", timeout=4)
+        assert r.status == 200
+        srv.missing.add((0, 0, 3))
+        with PooledTransport() as transport:
+            assert transport.request(srv.url + "/3/0/0.png", timeout=4).status == 404
+
+
+@pytest.mark.parametrize("engine", ["THREAD", "ASYNC"])
+def test_seed_engines(tmp_path, monkeypatch, engine):
+    from core.basemaps import mapservice, servicesDefs
+    from tileserver import TileServer
+
+    with TileServer(missing={(1, 1, 2)}) as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        tiles = [(x, y, 2) for x in range(4) for y in range(4)]
+        ms.start()
+        ms.seedTiles("BASIC", tiles, toDstGrid=False, nbThread=4, buffSize=3, engine=engine)
+        ms.stop()
+        cache = ms.getCache("BASIC", False)
+        assert cache.listMissingTiles(tiles) == {(1, 1, 2)}
+        assert ms.status == 0
+
+        #a stopped service does not download anything
+        tiles = [(x, y, 3) for x in range(4) for y in range(4)]
+        ms.seedTiles("BASIC", tiles, toDstGrid=False, engine=engine)
+        assert len(cache.listMissingTiles(tiles)) == len(tiles)
+
+
+def test_get_image_mosaic(tmp_path, monkeypatch):
+    pytest.importorskip("PIL")
+    from core.basemaps import mapservice, servicesDefs
+    from tileserver import TileServer, tile_color
+
+    with TileServer(missing={(9, 10, 5)}) as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        tm = ms.srcTms
+        xmin, _, _, ymax = tm.getTileBbox(8, 10, 5)
+        _, ymin, xmax, _ = tm.getTileBbox(10, 11, 5)
+        ms.start()
+        mosaic = ms.getImage("BASIC", (xmin + 1, ymin + 1, xmax - 1, ymax - 1), 5, toDstGrid=False, decodeThreads=3)
+        ms.stop()
+
+    assert tuple(mosaic.size) == (3 * 256, 2 * 256)
+    for i, col in enumerate(range(8, 11)):
+        for j, row in enumerate(range(10, 12)):
+            px = tuple(mosaic.data[j * 256 + 128, i * 256 + 128])
+            if (col, row) == (9, 10):
+                assert px == mapservice.MOSAIC_BKG_COLOR
+            else:
+                assert px == tile_color(col, row, 5)
+
+
+def test_get_image_geotiff_without_gdal(tmp_path, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    import numpy as np
+    from core.basemaps import mapservice, servicesDefs
+    from tileserver import TileServer, tile_color
+
+    monkeypatch.setattr(mapservice, "HAS_GDAL", False)
+    path = str(tmp_path / "mosaic.tif")
+    with TileServer() as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        tm = ms.srcTms
+        xmin, _, _, ymax = tm.getTileBbox(8, 10, 5)
+        _, ymin, xmax, _ = tm.getTileBbox(10, 12, 5)
+        ms.start()
+        assert ms.getImage("BASIC", (xmin + 1, ymin + 1, xmax - 1, ymax - 1), 5, path=path, bigTiff=True, toDstGrid=False) is None
+        ms.stop()
+
+    data = np.asarray(Image.open(path))
+    assert data.shape == (3 * 256, 3 * 256, 4)
+    for i, col in enumerate(range(8, 11)):
+        for j, row in enumerate(range(10, 13)):
+            assert tuple(data[j * 256 + 128, i * 256 + 128]) == tile_color(col, row, 5)
+
+
+def test_seed_dst_tiles_by_batch(tmp_path, monkeypatch):
+    from core.basemaps import mapservice, servicesDefs
+    from tileserver import TileServer
+
+    with TileServer() as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path), dstGridKey="WM_SW")
+        tiles = [(col, row, 6) for col in range(6, 18) for row in range(3, 7)]
+        batches = ms.dstTilesBatches(tiles, batchSize=8)
+        assert sorted(len(b) for b in batches) == [8, 8, 32]
+        assert sorted(t for b in batches for t in b) == sorted(tiles)
+
+        calls = []
+        def buildDstTiles(laykey, batch, nbThread=4):
+            calls.append(batch)
+            return [(col, row, zoom, srv.tile(col, row, zoom)) for col, row, zoom in batch]
+        monkeypatch.setattr(ms, "buildDstTiles", buildDstTiles)
+        ms.start()
+        ms.seedTiles("BASIC", tiles, toDstGrid=True)
+        ms.stop()
+
+    assert len(calls) == 3
+    assert ms.getCache("BASIC", True).listMissingTiles(tiles) == set()
+
+
+def test_build_dst_tiles_without_gdal(tmp_path, monkeypatch):
+    from core.basemaps import mapservice, servicesDefs
+    from core.georaster import NpImage
+    from tileserver import TileServer, tile_color
+
+    with TileServer() as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path), dstGridKey="WM_SW")
+        tiles = [(col, row, 5) for col in range(8, 11) for row in range(20, 22)]
+        ms.start()
+        built = ms.buildDstTiles("BASIC", tiles)
+        ms.stop()
+        requested = [path for path, headers in srv.requests]
+
+    assert [tile[:3] for tile in built] == tiles
+    assert len(set(requested)) == len(requested)  # each source tile is fetched once for the whole batch
+    for col, row, zoom, data in built:
+        img = NpImage(data)
+        # same crs and resolutions, the south west origin only flips rows
+        assert tuple(img.data[128, 128]) == tile_color(col, 2**zoom - 1 - row, zoom)
+
+
+def test_build_dst_tiles_pads_and_skips_bad_tiles(tmp_path, monkeypatch):
+    from core.basemaps import mapservice, servicesDefs
+    from core.georaster import NpImage
+    from tileserver import TileServer
+
+    #rounding of the warped extent leaves the image a few pixels short
+    reprojImg = mapservice.reprojImg
+    monkeypatch.setattr(mapservice, "reprojImg", lambda *args, **kwargs: NpImage(reprojImg(*args, **kwargs)).data[:-3, :-2])
+    cutTile = mapservice.MapService._cutTile
+    def failing(data, posx, posy, tileSize):
+        if (posx, posy) == (0, 0):
+            raise ValueError("bad tile")
+        return cutTile(data, posx, posy, tileSize)
+    monkeypatch.setattr(mapservice.MapService, "_cutTile", staticmethod(failing))
+
+    with TileServer() as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path), dstGridKey="WM_SW")
+        tiles = [(col, row, 5) for col in range(8, 10) for row in range(20, 22)]
+        ms.start()
+        built = dict(((col, row, zoom), data) for col, row, zoom, data in ms.buildDstTiles("BASIC", tiles))
+        ms.stop()
+
+    assert sum(data is None for data in built.values()) == 1
+    for data in built.values():
+        if data is not None:
+            img = NpImage(data)
+            assert img.data.shape[:2] == (256, 256)
+    #the bottom right tile is padded with the background color
+    assert tuple(NpImage(built[(9, 20, 5)]).data[255, 255]) == mapservice.MOSAIC_BKG_COLOR
+
+
+def test_tile_scheduler_priority_and_cancel():
+    from core.basemaps import GRIDS, TileMatrix, TileScheduler
+
+    tm = TileMatrix(GRIDS["WM"])
+    tiles = [(col, row, 6) for col in range(10, 15) for row in range(20, 25)] + [(6, 11, 5)]
+    scheduler = TileScheduler(tm, tiles)
+    assert len(scheduler) == len(tiles)
+    # coarser zoom first, then the tile at the center of the request
+    assert scheduler.get() == (6, 11, 5)
+    center = scheduler.get()
+    assert center == (12, 22, 6)
+    ring = [scheduler.get() for i in range(4)]
+    assert sorted(ring) == [(11, 22, 6), (12, 21, 6), (12, 23, 6), (13, 22, 6)]
+
+    # the view moves to the right : stale tiles are dropped, in flight ones are kept
+    view = [(col, row, 6) for col in range(13, 18) for row in range(20, 25)]
+    scheduler.preempt(view)
+    assert center in scheduler.inFlight
+    assert scheduler.get() == (15, 22, 6)
+    remaining = []
+    while True:
+        tile = scheduler.get()
+        if tile is None:
+            break
+        remaining.append(tile)
+    assert set(remaining) | {(15, 22, 6), (13, 22, 6)} == set(view)
+
+    scheduler.put(tiles)
+    assert scheduler.cancel() > 0
+    assert scheduler.get() is None
+
+
+def test_seed_from_center(tmp_path, monkeypatch):
+    from core.basemaps import mapservice, servicesDefs
+    from tileserver import TileServer
+
+    with TileServer() as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        tiles = [(col, row, 6) for col in range(10, 15) for row in range(20, 25)]
+        ms.start()
+        ms.seedTiles("BASIC", tiles, toDstGrid=False, nbThread=1)
+        ms.stop()
+        first = srv.requests[0][0]
+
+    assert first == "/6/12/22.png"
+
+
+def test_seed_cache_pyramid(tmp_path, monkeypatch):
+    pytest.importorskip("PIL")
+    from core.basemaps import mapservice, servicesDefs
+    from core.georaster import NpImage
+    from tileserver import TileServer, tile_color
+
+    with TileServer() as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        tm = ms.srcTms
+        xmin, ymin, xmax, ymax = tm.getTileBbox(5, 6, 4)
+        ms.start()
+        ms.seedCache("BASIC", (xmin + 1, ymin + 1, xmax - 1, ymax - 1), [4, 5, 6], toDstGrid=False, pyramid=True)
+        ms.stop()
+        requested = [path for path, headers in srv.requests]
+
+    assert len(requested) == 16
+    assert all(path.startswith("/6/") for path in requested)
+
+    cache = ms.getCache("BASIC", False)
+    tile = NpImage(cache.getTile(10, 12, 5)).data
+    # each quarter of a level 5 tile is one of its children
+    assert tuple(tile[64, 64]) == tile_color(20, 24, 6)
+    assert tuple(tile[64, 192]) == tile_color(21, 24, 6)
+    assert tuple(tile[192, 64]) == tile_color(20, 25, 6)
+    assert tuple(tile[192, 192]) == tile_color(21, 25, 6)
+    # and the level 4 tile is built from level 5
+    tile = NpImage(cache.getTile(5, 6, 4)).data
+    assert tuple(tile[32, 32]) == tile_color(20, 24, 6)
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+def test_derive_tile_resampling(tmp_path, categorical):
+    pytest.importorskip("PIL")
+    import numpy as np
+    from core.basemaps import mapservice
+    from core.georaster import NpImage
+
+    checker = np.zeros((4, 4, 4), dtype=np.uint8)
+    checker[..., 3] = 255
+    checker[::2, ::2, :3] = 200  # one pixel out of 4 in each 2x2 block
+    blob = NpImage(checker).toBLOB()
+    ms = mapservice.MapService("OSM", cacheFolder=str(tmp_path))
+    tile = NpImage(ms._deriveTile([blob] * 4, 4, categorical)).data
+    assert tile.shape == (4, 4, 4)
+    assert tuple(tile[0, 0]) == ((200, 200, 200, 255) if categorical else (50, 50, 50, 255))
+
+
+def test_negative_cache_and_revalidation(tmp_path, monkeypatch):
+    import sqlite3
+    from core.basemaps import mapservice, servicesDefs
+    from tileserver import TileServer
+
+    tiles = [(col, row, 6) for col in range(10, 13) for row in range(20, 22)]
+    with TileServer(missing={(10, 20, 6)}) as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        cache = ms.getCache("BASIC", False)
+
+        def seed():
+            del srv.requests[:]
+            ms.start()
+            ms.seedTiles("BASIC", tiles, toDstGrid=False, nbThread=2)
+            ms.stop()
+            return srv.requests
+
+        assert len(seed()) == 6
+        # the 404 tile is remembered, nothing is requested again
+        assert seed() == []
+
+        # expire everything : tiles are revalidated, the negative entry is retried
+        db = sqlite3.connect(cache.dbPath)
+        with db:
+            db.execute("UPDATE gpkg_tiles SET last_modified = datetime('now', '-1000 days')")
+            db.execute("UPDATE missing_tiles SET last_modified = datetime('now', '-1000 days')")
+        requests = seed()
+        assert len(requests) == 6
+        conditional = [headers for path, headers in requests if "If-None-Match" in headers]
+        assert len(conditional) == 5
+        assert all("If-Modified-Since" in headers for headers in conditional)
+        fresh = db.execute("SELECT count(*) FROM gpkg_tiles WHERE julianday('now','localtime') - julianday(last_modified) < 1").fetchone()[0]
+        assert fresh == 5
+        assert seed() == []
+
+        # new content on the server : the tile is replaced along with its validators
+        srv.version = 2
+        db.execute("UPDATE gpkg_tiles SET last_modified = datetime('now', '-1000 days') WHERE tile_column = 11 AND tile_row = 20")
+        db.commit()
+        assert len(seed()) == 1
+        etag = db.execute("SELECT etag FROM gpkg_tiles WHERE tile_column = 11 AND tile_row = 20").fetchone()[0]
+        assert etag == '"11-20-6-v2"'
+        db.close()
+
+
+def test_tiered_cache_reuses_decoded_tiles(tmp_path, monkeypatch):
+    pytest.importorskip("PIL")
+    import sqlite3
+    from core.basemaps import mapservice, servicesDefs
+    from core.georaster import NpImage
+    from tileserver import TileServer, tile_color
+
+    decoded = []
+    decodeBLOB = NpImage.decodeBLOB
+    monkeypatch.setattr(NpImage, "decodeBLOB", lambda self, data: decoded.append(1) or decodeBLOB(self, data))
+
+    with TileServer() as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        tm = ms.srcTms
+        xmin, _, _, ymax = tm.getTileBbox(8, 10, 5)
+        _, ymin, xmax, _ = tm.getTileBbox(10, 11, 5)
+        bbox = (xmin + 1, ymin + 1, xmax - 1, ymax - 1)
+        ms.start()
+        ms.getImage("BASIC", bbox, 5, toDstGrid=False)
+        assert len(srv.requests) == 6 and len(decoded) == 6
+        #same view again : no request, no cache database lookup and no decoding
+        mosaic = ms.getImage("BASIC", bbox, 5, toDstGrid=False)
+        assert len(srv.requests) == 6 and len(decoded) == 6
+        stats = ms.tileCache.stats()
+
+        #expired tiles downloaded again are dropped from memory, so the new data is decoded
+        db = sqlite3.connect(ms.getCache("BASIC", False).dbPath)
+        with db:
+            db.execute("UPDATE gpkg_tiles SET last_modified = datetime('now', '-1000 days') WHERE tile_column = 9")
+        db.close()
+        ms.seedTiles("BASIC", [(9, 10, 5), (9, 11, 5), (10, 10, 5)], toDstGrid=False)
+        assert len(srv.requests) == 8 and len(ms.tileCache) == 4
+        ms.getImage("BASIC", bbox, 5, toDstGrid=False)
+        ms.stop()
+        assert len(decoded) == 8 and len(ms.tileCache) == 6
+
+    assert tuple(mosaic.data[128, 256 + 128]) == tile_color(9, 10, 5)
+    assert not (tmp_path / "tiles").exists()
+    assert (stats["memory"]["hits"], stats["memory"]["misses"]) == (6, 6)
+    assert (stats["gpkg"]["hits"], stats["gpkg"]["misses"]) == (0, 6)
+    assert (stats["network"]["hits"], stats["network"]["misses"]) == (6, 0)
+    assert stats["memory"]["tiles"] == 6
+
+
+def test_tile_cache_memory_budget():
+    import numpy as np
+    from core.basemaps import TileCache
+
+    cache = TileCache(maxBytes=3 * 1024)
+    for x in range(3):
+        cache.putDecoded("lay", (x, 0, 1), np.full((16, 16, 4), x, dtype=np.uint8))
+    assert set(cache.getDecoded("lay", [(0, 0, 1)])) == {(0, 0, 1)} #tile 0 is now the most recently used
+    cache.putDecoded("lay", (3, 0, 1), np.zeros((16, 16, 4), dtype=np.uint8))
+    assert len(cache) == 3 and cache.nbBytes == 3 * 1024
+    assert set(cache.getDecoded("lay", [(x, 0, 1) for x in range(4)])) == {(0, 0, 1), (2, 0, 1), (3, 0, 1)}
+    assert cache.getDecoded("other", [(0, 0, 1)]) == {}
+    cache.clear("lay")
+    assert len(cache) == 0 and cache.nbBytes == 0
+
+
+def test_tile_cache_expiry_and_discard():
+    import numpy as np
+    from core.basemaps import TileCache
+
+    cache = TileCache(maxBytes=10 * 1024)
+    for x in range(3):
+        cache.putDecoded("lay", (x, 0, 1), np.full((16, 16, 4), x, dtype=np.uint8))
+    #loaded 2 days ago
+    cache.loaded[("lay", 0, 0, 1)] -= 2 * 86400
+    assert set(cache.getDecoded("lay", [(0, 0, 1), (1, 0, 1)])) == {(0, 0, 1), (1, 0, 1)}
+    assert set(cache.getDecoded("lay", [(0, 0, 1), (1, 0, 1)], maxDays=1)) == {(1, 0, 1)}
+    assert len(cache) == 2 and cache.nbBytes == 2 * 1024
+    cache.discard("lay", [(1, 0, 1), (5, 0, 1)])
+    assert set(cache.getDecoded("lay", [(x, 0, 1) for x in range(3)])) == {(2, 0, 1)}
+    assert len(cache.loaded) == 1 and cache.nbBytes == 1024
+
+
+def test_cache_quota_and_stats(tmp_path, monkeypatch):
+    from core.basemaps import mapservice, servicesDefs
+    from tileserver import TileServer
+
+    with TileServer(missing={(0, 0, 6)}) as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        monkeypatch.setattr(mapservice.MapService, "CACHE_MAX_SIZE", 10**9)
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        tiles = [(x, y, 6) for x in range(8) for y in range(8)]
+        ms.start()
+        ms.seedTiles("BASIC", tiles, toDstGrid=False, nbThread=4)
+        ms.seedTiles("BASIC", tiles, toDstGrid=False, nbThread=4)
+        ms.stop()
+
+    stats = ms.cacheStats()
+    assert stats["tiles"] == 63
+    assert stats["bytes"] == stats["caches"]["LOCAL_BASIC_WM"]["bytes"] > 0
+    assert stats["caches"]["LOCAL_BASIC_WM"]["missing"] == 1
+    assert stats["ages"][1] == 63
+    assert stats["hitRatio"]["gpkg"] == 64 / 128
+    assert stats["hitRatio"]["network"] == 63 / 64
+
+    #quota exceeded, least recently used tiles are evicted down to the low water mark
+    cache = ms.getCache("BASIC", False)
+    used = cache.usedSize()
+    cache.MAX_SIZE = used - 1
+    cache.LOW_WATER = (used - stats["bytes"] / 2) / cache.MAX_SIZE #free half of the tiles data
+    ms.compactCache(cache, background=False)
+    assert 0 < ms.cacheStats()["tiles"] < 63
+
+
+def test_seed_cli_resumes_from_journal(tmp_path, monkeypatch, capsys):
+    import json
+    from core.basemaps import servicesDefs, seed
+    from tileserver import TileServer
+
+    #40 tiles over zoom 3 and 4, by chunks of 2x2 tiles
+    args = ["LOCAL", "BASIC", "--cache", str(tmp_path), "--crs", "EPSG:3857", "--zoom", "3-4",
+            "--bbox", "-10000000", "100000", "10000000", "10000000", "--chunk", "4", "--threads", "4"]
+    with TileServer(errors={(5, 6, 4)}) as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        #a tile failed, its chunk is left for the next run
+        assert seed.main(args) == 1
+        journal = (tmp_path / "LOCAL_BASIC_WM.journal").read_text().splitlines()
+        assert json.loads(journal[0])["zooms"] == [3, 4]
+        assert len(journal) == 1 + 9
+        assert len(srv.requests) == 40
+
+        srv.errors.clear()
+        srv.requests.clear()
+        assert seed.main(args) == 0
+        assert [path for path, headers in srv.requests] == ["/4/5/6.png"]
+
+        srv.requests.clear()
+        assert seed.main(args) == 0
+        assert srv.requests == []
+        assert seed.main(args + ["--report"]) == 0
+        assert srv.requests == []
+    out = capsys.readouterr()
+    assert "8/8 (100.0%) of the extent" in out.out and "32/32 (100.0%) of the extent" in out.out
+    err = out.err
+    assert "10 chunks, 10 already done" in err
+    assert "40/40 tiles (100.0%)" in err and "tiles/s - ETA" in err
+
+
+def test_tile_cache_shares_identical_tiles():
+    import numpy as np
+    from core.basemaps import TileCache
+
+    class Store:
+        def getTiles(self, tiles):
+            return [t + (b"sea" if t[0] else b"land",) for t in tiles]
+
+    decoded = []
+
+    def decode(data):
+        decoded.append(data)
+        return np.zeros((4, 4, 4), dtype=np.uint8) + len(data)
+
+    cache = TileCache(1024)
+    tiles = cache.getTiles("key", Store(), [(x, 0, 3) for x in range(5)], decode)
+    assert sorted(decoded) == [b"land", b"sea"]
+    assert tiles[1][3] is tiles[4][3] and not tiles[1][3].flags.writeable
+    stats = cache.stats()["memory"]
+    assert stats["tiles"] == 5 and stats["arrays"] == 2 and stats["bytes"] == 2 * 64
+    #still in use, not decoded again
+    cache.getTiles("key", Store(), [(x, 1, 3) for x in range(3)], decode)
+    assert len(decoded) == 2
+    cache.clear("key")
+    assert cache.stats()["memory"]["bytes"] == 0
+
+
+def test_raw_layer_mosaic_without_decoding(tmp_path, monkeypatch):
+    pytest.importorskip("PIL")
+    from core.basemaps import mapservice, servicesDefs, RawTileStore
+    from core.georaster import NpImage
+    from tileserver import TileServer, tile_color
+
+    decoded = []
+    decodeBLOB = NpImage.decodeBLOB
+    monkeypatch.setattr(NpImage, "decodeBLOB", lambda self, data: decoded.append(1) or decodeBLOB(self, data))
+
+    with TileServer() as srv:
+        source = srv.source()
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", source)
+        monkeypatch.setattr(mapservice.MapService, "RAW_LAYERS", {"LOCAL_BASIC"})
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        assert ms.layerStorage("BASIC") == "RAW"
+        tm = ms.srcTms
+        xmin, _, _, ymax = tm.getTileBbox(8, 10, 5)
+        _, ymin, xmax, _ = tm.getTileBbox(10, 11, 5)
+        bbox = (xmin + 1, ymin + 1, xmax - 1, ymax - 1)
+        ms.start()
+        ms.getImage("BASIC", bbox, 5, toDstGrid=False)
+        mosaic = ms.getImage("BASIC", bbox, 5, toDstGrid=False)
+        ms.stop()
+        assert len(srv.requests) == 6
+
+    #tiles were decoded once when they were stored, never when building the mosaics
+    assert decoded == []
+    assert isinstance(ms.getCache("BASIC", False), RawTileStore)
+    assert (tmp_path / "LOCAL_BASIC_WM.raw").exists() and not (tmp_path / "LOCAL_BASIC_WM.gpkg").exists()
+    assert tuple(mosaic.data[128, 256 + 128]) == tile_color(9, 10, 5)
+    assert tuple(mosaic.data[256 + 128, 2 * 256 + 128]) == tile_color(10, 11, 5)
+    assert ms.cacheStats()["tiles"] == 6
+
+
+def test_shared_cache_downloads_tiles_once(tmp_path, monkeypatch):
+    import threading
+    import time
+    from core.basemaps import mapservice, servicesDefs, GeoPackage
+    from tileserver import TileServer
+
+    monkeypatch.setattr(GeoPackage, "CLAIM_POLL", 0.05)
+    tiles = [(x, y, 5) for x in range(8, 12) for y in range(8, 12)]
+    with TileServer(latency=0.05) as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        #two services sharing a cache folder stand for two processes
+        ms1 = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        ms2 = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        ms1.start()
+        ms2.start()
+        t = threading.Thread(target=ms1.seedTiles, args=("BASIC", tiles), kwargs={"toDstGrid": False, "nbThread": 2})
+        t.start()
+        cache1 = ms1.getCache("BASIC", False)
+        deadline = time.monotonic() + 5
+        while not cache1.claimed and time.monotonic() < deadline:
+            time.sleep(0.01)
+        ms2.seedTiles("BASIC", tiles, toDstGrid=False, nbThread=2)
+        t.join()
+        ms1.stop()
+        ms2.stop()
+        assert len(srv.requests) == len(tiles)
+    assert ms2.getCache("BASIC", False).listTilesToFetch(tiles) == set()
+
+
+def test_async_seeder_stops_on_writer_error():
+    import threading
+    from core.basemaps import GRIDS, TileMatrix, TileScheduler
+    from core.basemaps.asyncseeder import AsyncSeeder
+
+    class Service:
+        running = True
+        cptTiles = 0
+        def tileRecord(self, laykey, col, row, zoom, toDstGrid, validator):
+            return (col, row, zoom, b"data")
+
+    class Writer:
+        def putTiles(self, tiles):
+            raise IOError("disk full")
+
+    seeder = AsyncSeeder(Service(), "BASIC", Writer(), concurrency=4, buffSize=2, batchSize=1)
+    errors = []
+    def run():
+        try:
+            seeder.run(TileScheduler(TileMatrix(GRIDS["WM"]), [(x, y, 5) for x in range(20) for y in range(20)]))
+        except IOError as e:
+            errors.append(e)
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    t.join(10)
+    assert not t.is_alive()
+    assert len(errors) == 1
+
+
+def test_thread_seeder_stops_on_writer_error(tmp_path, monkeypatch):
+    import threading
+    from core.basemaps import mapservice, servicesDefs
+    from core.basemaps.tilestore import TileWriter
+    from tileserver import TileServer
+
+    def fail(self):
+        raise IOError("disk full")
+    monkeypatch.setattr(TileWriter, "_write", fail)
+    tiles = [(x, y, 5) for x in range(20) for y in range(20)]
+    errors = []
+    with TileServer() as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        ms.start()
+        def run():
+            try:
+                ms.seedTiles("BASIC", tiles, toDstGrid=False, nbThread=4, buffSize=3, engine="THREAD")
+            except IOError as e:
+                errors.append(e)
+        t = threading.Thread(target=run, daemon=True)
+        t.start()
+        t.join(10)
+        ms.stop()
+        assert not t.is_alive()
+        assert len(errors) == 1
+        assert len(srv.requests) < len(tiles)
+
+
+def test_seed_failure_releases_claims(tmp_path, monkeypatch):
+    from core.basemaps import mapservice, servicesDefs
+    from core.basemaps.asyncseeder import AsyncSeeder
+    from tileserver import TileServer
+
+    def fail(self, scheduler):
+        raise IOError("disk full")
+    monkeypatch.setattr(AsyncSeeder, "run", fail)
+    tiles = [(x, y, 3) for x in range(4) for y in range(4)]
+    with TileServer() as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        ms.start()
+        with pytest.raises(IOError):
+            ms.seedTiles("BASIC", tiles, toDstGrid=False, engine="ASYNC")
+        ms.stop()
+    cache = ms.getCache("BASIC", False)
+    assert not ms.schedulers and not cache.claimed
+    #another process can claim the tiles right away
+    other = type(cache)(cache.dbPath, cache.tm)
+    assert other.claimTiles(tiles) == (set(tiles), set())
+
+
+@pytest.mark.parametrize("engine", ["THREAD", "ASYNC"])
+def test_preempt_running_seed(tmp_path, monkeypatch, engine):
+    import threading
+    import time
+    from core.basemaps import mapservice, servicesDefs, BBoxRequest
+    from tileserver import TileServer
+
+    with TileServer(latency=0.05) as srv:
+        monkeypatch.setitem(servicesDefs.SOURCES, "LOCAL", srv.source())
+        ms = mapservice.MapService("LOCAL", cacheFolder=str(tmp_path))
+        tm = ms.getTM(False)
+        old = [(x, y, 6) for x in range(8) for y in range(8)]
+        ms.start()
+        t = threading.Thread(target=ms.seedTiles, args=("BASIC", old), kwargs={"toDstGrid": False, "nbThread": 2, "engine": engine})
+        t.start()
+        deadline = time.monotonic() + 5
+        while not srv.requests and time.monotonic() < deadline:
+            time.sleep(0.01)
+        #the view moves away : the running seeding switches to the new tiles
+        xmin, ymin = tm.getTileBbox(40, 41, 6)[:2]
+        xmax, ymax = tm.getTileBbox(41, 40, 6)[2:]
+        bbox = (xmin + 1, ymin + 1, xmax - 1, ymax - 1)
+        ms.preempt("BASIC", bbox, 6, toDstGrid=False)
+        t.join()
+        ms.stop()
+    cache = ms.getCache("BASIC", False)
+    new = BBoxRequest(tm, bbox, 6).tiles
+    assert len(new) == 4
+    assert cache.listTilesToFetch(new) == set()
+    assert len(cache.listTilesToFetch(old)) > len(old) / 2
+    assert not ms.schedulers
@@ -0,0 +1,78 @@
+import sys
+import types
+from pathlib import Path
+import pytest
+
+# Stub bpy to satisfy addon initialization
+bpy_stub = types.SimpleNamespace(
+    app=types.SimpleNamespace(version=(2, 83, 0), background=True, tempdir="/tmp"),
+    types=types.SimpleNamespace(Operator=object, Menu=object, AddonPreferences=object, Panel=object),
+    utils=types.SimpleNamespace(register_class=lambda cls: None, unregister_class=lambda cls: None,
+                                previews=types.SimpleNamespace(new=lambda: types.SimpleNamespace(icon_id=0))),
+    ops=types.SimpleNamespace(),
+    context=types.SimpleNamespace(window_manager=types.SimpleNamespace(), area=types.SimpleNamespace(),
+                                  preferences=types.SimpleNamespace(addons={__package__: types.SimpleNamespace(preferences=None)})),
+    data=types.SimpleNamespace(texts={}),
+)
+sys.modules.setdefault("bpy", bpy_stub)
+
+pytest.importorskip("numpy")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+
+@pytest.mark.parametrize("bigtiff", [False, True])
+def test_geotiff_writer(tmp_path, bigtiff):
+    import numpy as np
+    from core.georaster import GeoTiffWriter, GeoRef
+    from core.proj import SRS
+    from core.lib import Tyf
+
+    w, h = 600, 500
+    georef = GeoRef((w, h), (10, -10), (1000, 5000), pxCenter=False, crs=SRS(3857))
+    img = np.random.default_rng(0).integers(0, 255, (h, w, 4), dtype=np.uint8)
+    path = str(tmp_path / "out.tif")
+    with GeoTiffWriter(path, w, h, georef, tileSize=256, bigTiff=bigtiff) as writer:
+        for y in range(0, h, 100):
+            writer.paste(img[y:y + 100], 0, y)
+        with pytest.raises(ValueError):
+            writer.paste(img[:10], 0, 0)  # rows already flushed
+
+    with open(path, "rb") as f:
+        assert f.read(4) == (b"II+\x00" if bigtiff else b"II*\x00")
+    assert (tmp_path / "out.tfw").exists()
+
+    if not bigtiff:
+        tags = Tyf.open(path)[0]
+        assert tags[33922] == (0.0, 0.0, 0.0, 1000.0, 5000.0, 0.0)
+        assert tags[33550] == (10.0, 10.0, 0.0)
+        assert tags[34735][-4:] == (3072, 0, 1, 3857)
+
+    Image = pytest.importorskip("PIL.Image")
+    assert (np.asarray(Image.open(path)) == img).all()
+
+
+def test_geotiff_writer_abort(tmp_path):
+    import numpy as np
+    from core.georaster import GeoTiffWriter, GeoRef
+    from core.proj import SRS
+
+    georef = GeoRef((600, 500), (10, -10), (1000, 5000), pxCenter=False, crs=SRS(3857))
+    path = tmp_path / "out.tif"
+    writer = GeoTiffWriter(str(path), 600, 500, georef)
+    writer.paste(np.zeros((300, 600, 4), dtype=np.uint8), 0, 0)
+    writer.abort()
+    assert writer.closed and not path.exists() and not (tmp_path / "out.tfw").exists()
+
+    #an error while writing also drops the partial file
+    with pytest.raises(RuntimeError):
+        with GeoTiffWriter(str(path), 600, 500, georef) as writer:
+            raise RuntimeError
+    assert not path.exists()
+
+    #so does a writer dropped without being closed
+    writer = GeoTiffWriter(str(path), 600, 500, georef)
+    writer.paste(np.zeros((300, 600, 4), dtype=np.uint8), 0, 0)
+    del writer
+    assert not path.exists() and not (tmp_path / "out.tfw").exists()
@@ -0,0 +1,511 @@
+import sys
+import types
+from pathlib import Path
+import pytest
+
+# Stub bpy to satisfy addon initialization
+bpy_stub = types.SimpleNamespace(
+    app=types.SimpleNamespace(version=(2, 83, 0), background=True, tempdir="/tmp"),
+    types=types.SimpleNamespace(Operator=object, Menu=object, AddonPreferences=object, Panel=object),
+    utils=types.SimpleNamespace(register_class=lambda cls: None, unregister_class=lambda cls: None,
+                                previews=types.SimpleNamespace(new=lambda: types.SimpleNamespace(icon_id=0))),
+    ops=types.SimpleNamespace(),
+    context=types.SimpleNamespace(window_manager=types.SimpleNamespace(), area=types.SimpleNamespace(),
+                                  preferences=types.SimpleNamespace(addons={__package__: types.SimpleNamespace(preferences=None)})),
+    data=types.SimpleNamespace(texts={}),
+)
+sys.modules.setdefault("bpy", bpy_stub)
+
+pytest.importorskip("numpy")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture
+def gpkg(tmp_path):
+    from core.basemaps import GRIDS, TileMatrix, GeoPackage
+    return GeoPackage(str(tmp_path / "cache.gpkg"), TileMatrix(GRIDS["WM"]))
+
+
+def test_writer_batches(gpkg):
+    tiles = [(x, y, 5, bytes([x, y]) * 10) for x in range(10) for y in range(10)]
+    with gpkg.writer(maxTiles=30, maxBytes=10**9, maxDelay=3600) as writer:
+        for t in tiles[:50]:
+            writer.put(*t)
+        #one batch of 30 tiles written, 20 waiting in memory
+        assert writer.nbBatches == 1
+        assert len(gpkg.listExistingTiles([t[:3] for t in tiles])) == 30
+        writer.flush()
+        assert len(gpkg.listExistingTiles([t[:3] for t in tiles])) == 50
+        writer.putTiles(tiles[50:])
+    assert gpkg.listMissingTiles([t[:3] for t in tiles]) == set()
+    assert gpkg.getTile(3, 4, 5) == bytes([3, 4]) * 10
+
+    #byte size limit
+    with gpkg.writer(maxTiles=10**6, maxBytes=100, maxDelay=3600) as writer:
+        writer.putTiles([(0, 0, 6, b"x" * 60)])
+        assert writer.nbBatches == 0
+        writer.putTiles([(1, 0, 6, b"x" * 60)])
+        assert writer.nbBatches == 1
+
+    #time window, the tiles are written even if no other tile comes
+    import time
+    with gpkg.writer(maxTiles=10**6, maxBytes=10**9, maxDelay=0.1) as writer:
+        writer.put(2, 0, 6, b"late")
+        assert writer.nbBatches == 0
+        for i in range(50):
+            if writer.nbBatches:
+                break
+            time.sleep(0.05)
+        assert writer.nbBatches == 1 and gpkg.getTile(2, 0, 6) == b"late"
+        assert writer.timer is None
+
+
+def test_upgrade_previous_schema(tmp_path):
+    import sqlite3
+    from core.basemaps import GRIDS, TileMatrix, GeoPackage
+    from core.basemaps.gpkg import MISSING
+
+    tm = TileMatrix(GRIDS["WM"])
+    path = str(tmp_path / "old.gpkg")
+    GeoPackage(path, tm)
+    # rebuild the tiles and coverage tables and drop the negative cache as created by previous versions
+    db = sqlite3.connect(path)
+    db.executescript("""
+        DROP TABLE gpkg_tiles; DROP TABLE missing_tiles; DROP TABLE tile_coverage; DROP TABLE tile_coverage_state;
+        CREATE TABLE tile_coverage (zoom_level INTEGER NOT NULL, tile_row INTEGER NOT NULL, runs BLOB NOT NULL,
+            oldest DOUBLE NOT NULL, PRIMARY KEY (zoom_level, tile_row)) WITHOUT ROWID;
+        CREATE TABLE tile_coverage_state (version INTEGER NOT NULL, coverage_version INTEGER);
+        INSERT INTO tile_coverage_state VALUES (0, NULL);
+        CREATE TABLE gpkg_tiles (id INTEGER PRIMARY KEY AUTOINCREMENT, zoom_level INTEGER NOT NULL,
+            tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL, tile_data BLOB NOT NULL,
+            last_modified TIMESTAMP DEFAULT (datetime('now','localtime')), UNIQUE (zoom_level, tile_column, tile_row));
+        INSERT INTO gpkg_tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (1, 0, 0, x'00');
+    """)
+    db.close()
+
+    gpkg = GeoPackage(path, tm)
+    gpkg.putTiles([(1, 0, 1, b"data", '"etag"', None), (1, 1, 1, MISSING)])
+    assert gpkg.getTile(0, 0, 1) == b"\x00"
+    assert gpkg.getValidators([(1, 0, 1), (0, 0, 1)]) == {(1, 0, 1): ('"etag"', None)}
+    assert gpkg.listMissingTiles([(0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1)]) == {(1, 1, 1), (0, 1, 1)}
+    assert gpkg.listTilesToFetch([(0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1)]) == {(0, 1, 1)}
+    #the first vacuum enables incremental vacuum
+    gpkg.vacuum()
+    with gpkg.connection() as db:
+        assert db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert gpkg.getTile(1, 0, 1) == b"data"
+
+
+def test_expiry_boundary_west_of_utc(tmp_path, monkeypatch):
+    import sqlite3
+    import time
+    import numpy as np
+    from core.basemaps import GRIDS, TileMatrix, GeoPackage, RawTileStore
+
+    if not hasattr(time, "tzset"):
+        pytest.skip("time zone can not be changed")
+    monkeypatch.setenv("TZ", "America/Los_Angeles")
+    time.tzset()
+    try:
+        tm = TileMatrix(GRIDS["WM"])
+        gpkg = GeoPackage(str(tmp_path / "tz.gpkg"), tm)
+        raw = RawTileStore(str(tmp_path / "tz.raw"), tm)
+        tiles = [(0, 0, 2), (1, 0, 2)]
+        gpkg.putTiles([t + (b"tile",) for t in tiles])
+        raw.putTiles([t + (np.zeros((256, 256, 4), dtype=np.uint8),) for t in tiles])
+        #a few hours before and after the expiry, less than the offset from UTC
+        for path, table in ((gpkg.dbPath, "gpkg_tiles"), (raw.dbPath, "raw_tiles")):
+            db = sqlite3.connect(path)
+            with db:
+                db.execute("UPDATE {} SET last_modified = datetime('now', 'localtime', '-{} days', "
+                    "CASE tile_column WHEN 0 THEN '+3 hours' ELSE '-3 hours' END)".format(table, GeoPackage.MAX_DAYS))
+            db.close()
+        for store in (gpkg, raw):
+            #a tile listed as present is returned, so the mosaic has no hole
+            assert store.listTilesToFetch(tiles) == {(1, 0, 2)}
+            assert [t[:3] for t in store.getTiles(tiles)] == [(0, 0, 2)]
+        assert gpkg.listExistingTiles(tiles) == {(0, 0, 2)}
+        assert gpkg.getTile(0, 0, 2) == b"tile" and gpkg.getTile(1, 0, 2) is None
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_pooled_connections(gpkg):
+    import threading
+    gpkg.putTiles([(x, 0, 3, bytes([x])) for x in range(8)])
+    for i in range(20):
+        assert gpkg.getTile(i % 8, 0, 3) == bytes([i % 8])
+    assert gpkg.getTile(9, 0, 3) is None
+    #sequential calls reuse a single connection
+    assert len(gpkg.pool) == 1
+    with gpkg.connection() as db:
+        assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert db.execute("PRAGMA synchronous").fetchone()[0] == 1 #NORMAL
+
+    errors = []
+    def read():
+        try:
+            for i in range(50):
+                assert gpkg.getTile(i % 8, 0, 3) == bytes([i % 8])
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=read) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert 1 <= len(gpkg.pool) <= gpkg.POOL_SIZE
+
+    gpkg.close()
+    assert gpkg.pool == []
+    #connections are reopened on demand
+    assert gpkg.getTile(1, 0, 3) == b"\x01"
+
+
+def test_exact_tiles_lookup(gpkg):
+    #a sparse set of cached tiles spread over a large column/row range
+    cached = [(x, y, z, bytes([x % 256, y % 256, z])) for z in (10, 14) for x in range(0, 4000, 400) for y in range(0, 4000, 400)]
+    gpkg.putTiles(cached)
+    request = [(3600, 400, 14), (0, 0, 10), (1, 1, 10), (400, 3600, 10), (0, 0, 14)]
+    result = gpkg.getTiles(request)
+    #only the requested tiles, in the requested order
+    assert [t[:3] for t in result] == [(3600, 400, 14), (0, 0, 10), (400, 3600, 10), (0, 0, 14)]
+    assert result[0][3] == bytes([3600 % 256, 400 % 256, 14])
+    assert gpkg.listExistingTiles(request) == {(3600, 400, 14), (0, 0, 10), (400, 3600, 10), (0, 0, 14)}
+    assert gpkg.listMissingTiles(request) == {(1, 1, 10)}
+    assert gpkg.getTiles([]) == []
+
+    #existence checks do not read the tiles rows
+    from core.basemaps.gpkg import EXISTING_TILES_QUERY
+    with gpkg.connection() as db:
+        plan = db.execute("EXPLAIN QUERY PLAN " + EXISTING_TILES_QUERY, (90,)).fetchall()
+    assert any("COVERING INDEX gpkg_tiles_zxy_modified" in row[-1] for row in plan)
+
+
+def test_lru_eviction_and_vacuum(gpkg):
+    import os
+    import sqlite3
+    tiles = [(x, 0, 8, os.urandom(20000)) for x in range(60)]
+    gpkg.putTiles(tiles)
+    #tiles stored first are older, but the first ten are read afterwards
+    db = sqlite3.connect(gpkg.dbPath)
+    with db:
+        db.execute("UPDATE gpkg_tiles SET last_modified = datetime('now', 'localtime', '-' || (100 - tile_column) || ' minutes')")
+    db.close()
+    assert len(gpkg.getTiles([t[:3] for t in tiles[:10]])) == 10
+    assert len(gpkg.accessed) == 10 #not written yet
+
+    stats = gpkg.stats()
+    assert stats["tiles"] == 60 and stats["bytes"] == 60 * 20000
+    assert stats["ages"][1] == 60 and sum(stats["ages"].values()) == 60
+    used = gpkg.usedSize()
+    assert used > 60 * 20000
+
+    gpkg.MAX_SIZE = used // 2
+    assert gpkg.evict() > 0
+    assert gpkg.usedSize() <= gpkg.MAX_SIZE * gpkg.LOW_WATER
+    remaining = {t[0] for t in gpkg.getTiles([t[:3] for t in tiles])}
+    #recently read tiles are kept, the oldest never read ones are evicted
+    assert set(range(10)) <= remaining
+    assert 10 not in remaining and 59 in remaining
+    assert gpkg.evict() == 0
+
+    fileSize = os.path.getsize(gpkg.dbPath) + os.path.getsize(gpkg.dbPath + "-wal")
+    assert gpkg.vacuum() > 0
+    assert os.path.getsize(gpkg.dbPath) + os.path.getsize(gpkg.dbPath + "-wal") < fileSize
+    with gpkg.connection() as db:
+        assert db.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
+
+def test_mbtiles_backend(tmp_path):
+    import sqlite3
+    from core.basemaps import GRIDS, TileMatrix, MBTiles
+    from core.basemaps.gpkg import MISSING
+
+    tm = TileMatrix(GRIDS["WM"])
+    path = str(tmp_path / "cache.mbtiles")
+    mbt = MBTiles(path, tm, format="jpg")
+    tiles = [(x, y, 3, bytes([x, y])) for x in range(4) for y in range(4)]
+    with mbt.writer(maxTiles=5) as writer:
+        writer.putTiles(tiles)
+    mbt.putTiles([(7, 7, 3, MISSING)])
+    request = [(2, 1, 3), (7, 7, 3), (0, 0, 3), (1, 2, 3)]
+    assert mbt.getTiles(request) == [(2, 1, 3, b"\x02\x01"), (0, 0, 3, b"\x00\x00"), (1, 2, 3, b"\x01\x02")]
+    assert mbt.listMissingTiles(request) == {(7, 7, 3)}
+    assert mbt.getMetadata()["format"] == "jpg"
+    #rows are stored with the TMS numbering
+    db = sqlite3.connect(path)
+    assert db.execute("SELECT tile_row FROM tiles WHERE zoom_level=3 AND tile_column=2 AND tile_data=x'0201'").fetchone()[0] == 6
+    db.close()
+    mbt.close()
+    #reopening keeps the tiles
+    assert MBTiles(path, tm).getTile(1, 2, 3) == b"\x01\x02"
+
+
+def test_bulk_copy_between_backends(tmp_path):
+    from core.basemaps import GRIDS, TileMatrix, copyTiles, openTileStore, GeoPackage, MBTiles
+
+    tm = TileMatrix(GRIDS["WM"])
+    src = openTileStore(str(tmp_path / "src.gpkg"), tm)
+    assert isinstance(src, GeoPackage)
+    tiles = [(x, y, z, bytes([x, y, z]) * 3) for z in (2, 3) for x in range(4) for y in range(4)]
+    src.putTiles(tiles)
+
+    mbt = openTileStore(str(tmp_path / "copy.mbtiles"), tm)
+    assert isinstance(mbt, MBTiles)
+    assert copyTiles(src, mbt, batchSize=7) == len(tiles)
+    assert mbt.getTiles([t[:3] for t in tiles]) == tiles
+
+    dst = GeoPackage(str(tmp_path / "dst.gpkg"), tm)
+    assert copyTiles(mbt, dst, zooms=[3]) == 16
+    assert dst.getTiles([t[:3] for t in tiles]) == tiles[16:]
+
+    with pytest.raises(ValueError):
+        copyTiles(src, GeoPackage(str(tmp_path / "other.gpkg"), TileMatrix(GRIDS["WGS84"])))
+
+
+def test_deduplicated_layout(tmp_path):
+    import os
+    from core.basemaps import GRIDS, TileMatrix, GeoPackage, copyTiles
+
+    tm = TileMatrix(GRIDS["WM"])
+    ocean, land = b"o" * 5000, os.urandom(5000)
+    tiles = [(x, y, 6, ocean if (x + y) % 4 else land) for x in range(10) for y in range(10)]
+
+    gpkg = GeoPackage(str(tmp_path / "dedup.gpkg"), tm, dedup=True)
+    with gpkg.writer(maxTiles=30) as writer:
+        writer.putTiles(tiles)
+    assert gpkg.getTiles([t[:3] for t in tiles]) == tiles
+    assert gpkg.getTile(1, 0, 6) == ocean
+    stats = gpkg.stats()
+    assert stats["tiles"] == 100 and stats["blobs"] == 2 and stats["bytes"] == 10000
+
+    #inline caches can be converted, and copies into a deduplicated cache are hashed in SQL
+    inline = GeoPackage(str(tmp_path / "inline.gpkg"), tm)
+    inline.putTiles(tiles)
+    assert inline.stats()["bytes"] == 100 * 5000
+    copy = GeoPackage(str(tmp_path / "copy.gpkg"), tm, dedup=True)
+    assert copyTiles(inline, copy, batchSize=40) == 100
+    assert inline.deduplicate(batchSize=40) == 100
+    for cache in (inline, copy):
+        assert cache.stats()["blobs"] == 2
+        assert cache.getTiles([t[:3] for t in tiles]) == tiles
+
+    #blobs of the replaced and evicted tiles are collected
+    gpkg.putTiles([(x, y, 6, land) for x in range(10) for y in range(10) if (x + y) % 4 == 0 or x > 5])
+    assert gpkg.collectBlobs() == 0
+    gpkg.putTiles([(x, y, 6, land) for x in range(10) for y in range(10)])
+    assert gpkg.collectBlobs() == 1
+    assert gpkg.stats()["blobs"] == 1
+
+
+def test_coverage_index(gpkg):
+    import sqlite3
+    from core.basemaps import Coverage, coverageReport, formatCoverageReport
+
+    tiles = [(x, y, 7, b"tile") for x in range(20, 30) for y in range(40, 44)]
+    gpkg.putTiles(tiles[:20])
+    with gpkg.writer(maxTiles=7) as writer:
+        writer.putTiles(tiles[20:])
+    coverage = gpkg.getCoverage()
+    #one run of 10 columns per row
+    assert len(coverage) == 40 and coverage.rows[(7, 41)] == [20, 30]
+    request = [(x, y, 7) for x in range(15, 35) for y in range(40, 45)]
+    assert gpkg.listMissingTiles(request) == set(request) - set(t[:3] for t in tiles)
+
+    #the index is persisted, a new instance loads it without reading the tiles
+    other = type(gpkg)(gpkg.dbPath, gpkg.tm)
+    assert other.getCoverage().rows == coverage.rows
+
+    #tiles written by another application are detected and the index is rebuilt
+    db = sqlite3.connect(gpkg.dbPath)
+    with db:
+        db.execute("DELETE FROM gpkg_tiles WHERE tile_column = 25")
+        db.execute("INSERT INTO gpkg_tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (7, 31, 40, x'00')")
+    db.close()
+    assert gpkg.getCoverage().rows[(7, 40)] == [20, 25, 26, 30, 31, 32]
+    assert other.listMissingTiles([(25, 41, 7), (31, 40, 7)]) == {(25, 41, 7)}
+    with gpkg.connection() as db:
+        version, coverageVersion = db.execute("SELECT version, coverage_version FROM tile_coverage_state").fetchone()
+        assert version == coverageVersion
+
+    #rows holding expired tiles are checked against the timestamps
+    db = sqlite3.connect(gpkg.dbPath)
+    with db:
+        db.execute("UPDATE gpkg_tiles SET last_modified = datetime('now', 'localtime', '-1000 days') WHERE tile_row = 42 AND tile_column = 20")
+    db.close()
+    assert gpkg.listMissingTiles([(20, 42, 7), (21, 42, 7), (21, 43, 7)]) == {(20, 42, 7)}
+    #the not modified marker refreshes the tile
+    gpkg.putTiles([(20, 42, 7, "NOT_MODIFIED")])
+    assert gpkg.listMissingTiles([(20, 42, 7)]) == set()
+
+    gpkg.MAX_SIZE = 1
+    gpkg.evict(lowWater=0)
+    assert len(gpkg.getCoverage()) == 0
+    gpkg.putTiles(tiles)
+
+    #extent of 20 columns from the center of tile (20, 40) to the center of tile (39, 40)
+    xmin, ymin, xmax, ymax = gpkg.tm.getTileBbox(20, 40, 7)
+    cx, cy = (xmin + xmax) / 2, (ymin + ymax) / 2
+    width = xmax - xmin
+    report = coverageReport(gpkg, bbox=(cx, cy - 1, cx + 19 * width, cy), zooms=[7])
+    entry = report[0]
+    assert entry["tiles"] == 40 and entry["rows"] == 4 and entry["bounds"] == (20, 40, 29, 43)
+    assert entry["ratio"] == 0.5
+    assert "z7" in formatCoverageReport(report)
+
+    runs = [0, 5, 10, 20]
+    assert Coverage.decode(Coverage.encode(runs)) == runs
+
+
+def test_coverage_incremental_reload(gpkg):
+    import sqlite3
+
+    tiles = [(x, y, 7, b"tile") for x in range(20, 30) for y in range(40, 44)]
+    gpkg.putTiles(tiles)
+    other = type(gpkg)(gpkg.dbPath, gpkg.tm)
+    row41 = other.getCoverage().rows[(7, 41)]
+
+    #tiles written by another process, only the rows saved since are reloaded
+    gpkg.putTiles([(30, 40, 7, b"tile"), (0, 50, 7, b"tile")])
+    coverage = other.getCoverage()
+    assert coverage.rows[(7, 40)] == [20, 31] and coverage.rows[(7, 50)] == [0, 1]
+    assert coverage.rows[(7, 41)] is row41
+    assert other.listMissingTiles([(30, 40, 7), (30, 41, 7)]) == {(30, 41, 7)}
+
+    #emptied rows are seen too
+    gpkg.MAX_SIZE = 1
+    gpkg.evict(lowWater=0)
+    assert len(other.getCoverage()) == 0
+    other.putTiles([t for t in tiles if t[0] < 25 and t[1] < 42])
+    assert gpkg.getCoverage().rows == {(7, 40): [20, 25], (7, 41): [20, 25]}
+
+    #after a rebuild the whole index is reloaded
+    db = sqlite3.connect(gpkg.dbPath)
+    with db:
+        db.execute("DELETE FROM gpkg_tiles WHERE tile_row = 41")
+    db.close()
+    assert gpkg.getCoverage().rows == {(7, 40): [20, 25]}
+    assert other.getCoverage().rows == {(7, 40): [20, 25]}
+
+
+def test_raw_tile_store(tmp_path, monkeypatch):
+    import os
+    import numpy as np
+    from core.basemaps import GRIDS, TileMatrix, GeoPackage, MBTiles, RawTileStore, convertToRaw, openTileStore
+    from core.basemaps.gpkg import MISSING
+    from tileserver import make_png, tile_color
+
+    monkeypatch.setattr(RawTileStore, "SLOTS_GROWTH", 8)
+    tm = TileMatrix(GRIDS["WM"])
+    tiles = [(x, y, 4, make_png(256, 256, tile_color(x, y, 4))) for x in range(5) for y in range(4)]
+    gpkg = GeoPackage(str(tmp_path / "src.gpkg"), tm)
+    gpkg.putTiles(tiles)
+
+    raw = openTileStore(str(tmp_path / "raw.raw"), tm)
+    assert isinstance(raw, RawTileStore)
+    assert convertToRaw(gpkg, raw, batchSize=6) == 20
+    assert raw.stats() == {"tiles": 20, "bytes": 20 * 256 * 256 * 4, "slots": 20, "missing": 0}
+    assert os.path.getsize(raw.slotsPath) == 24 * 256 * 256 * 4
+    request = [(3, 2, 4), (9, 9, 4), (0, 0, 4)]
+    arrays = raw.getArrays(request)
+    assert [t[:3] for t in arrays] == [(3, 2, 4), (0, 0, 4)]
+    assert arrays[0][3].shape == (256, 256, 4) and not arrays[0][3].flags.writeable
+    assert tuple(arrays[0][3][10, 20]) == tile_color(3, 2, 4)
+    assert raw.listTilesToFetch(request) == {(9, 9, 4)}
+
+    #replaced tiles keep their slot, arrays and gray tiles are expanded to RGBA
+    gray = np.full((256, 256), 7, dtype=np.uint8)
+    raw.putTiles([(3, 2, 4, gray), (9, 9, 4, MISSING)])
+    assert raw.stats()["slots"] == 20
+    assert tuple(raw.getTiles([(3, 2, 4)])[0][3][0, 0]) == (7, 7, 7, 255)
+    #missing tiles are not requested again until their marker expires or the tile is written
+    assert raw.listTilesToFetch(request) == set()
+    assert raw.stats()["missing"] == 1
+    raw.putTiles([(9, 9, 4, gray)])
+    assert raw.stats()["missing"] == 0
+
+    #a reopened store reads the same file, and MBTiles rows are flipped
+    raw.close()
+    raw = RawTileStore(raw.dbPath, tm)
+    assert tuple(raw.getArrays([(0, 0, 4)])[0][3][0, 0]) == tile_color(0, 0, 4)
+    mbt = MBTiles(str(tmp_path / "src.mbtiles"), tm)
+    mbt.putTiles([(1, 1, 4, make_png(256, 256, (1, 2, 3, 255)))])
+    assert convertToRaw(mbt, raw) == 1
+    assert tuple(raw.getArrays([(1, 1, 4)])[0][3][0, 0]) == (1, 2, 3, 255)
+
+    #tiles are decoded by the writer caller, not while the lock shared with other cache operations is held
+    class Lock:
+        held = False
+        def acquire(self):
+            self.held = True
+        def release(self):
+            self.held = False
+    lock, decodedUnlocked = Lock(), []
+    toRGBA = raw.toRGBA
+    monkeypatch.setattr(raw, "toRGBA", lambda data: decodedUnlocked.append(not lock.held) or toRGBA(data))
+    with raw.writer(maxTiles=2, lock=lock) as writer:
+        writer.putTiles([t for t in tiles[:3]] + [(0, 9, 4, b"corrupted")])
+    assert decodedUnlocked == [True] * 4
+    assert raw.listTilesToFetch([t[:3] for t in tiles[:3]] + [(0, 9, 4)]) == {(0, 9, 4)}
+
+
+def test_shared_cache_claims_and_busy_retry(tmp_path, monkeypatch):
+    import sqlite3
+    import threading
+    import time
+    import pytest
+    from core.basemaps import GRIDS, TileMatrix, GeoPackage
+
+    monkeypatch.setattr(GeoPackage, "CLAIM_POLL", 0.05)
+    tm = TileMatrix(GRIDS["WM"])
+    path = str(tmp_path / "shared.gpkg")
+    #two stores on the same file stand for two processes
+    a, b = GeoPackage(path, tm), GeoPackage(path, tm)
+    tiles = [(x, 0, 6) for x in range(6)]
+    assert a.claimTiles(tiles[:4]) == (set(tiles[:4]), set())
+    claimed, awaited = b.claimTiles(tiles[2:])
+    assert claimed == set(tiles[4:]) and awaited == set(tiles[2:4])
+
+    def fetch():
+        time.sleep(0.2)
+        a.putTiles([tiles[2] + (b"data",)])
+        a.releaseClaims([tiles[3]]) #download failed
+    t = threading.Thread(target=fetch)
+    t.start()
+    #the written tile is awaited, the failed one is left to fetch
+    assert b.waitTiles(awaited) == {tiles[3]}
+    t.join()
+    assert b.claimTiles([tiles[3]])[0] == {tiles[3]}
+
+    #tiles kept claimed by a slow process are fetched locally after CLAIM_WAIT checks
+    monkeypatch.setattr(GeoPackage, "CLAIM_WAIT", 3)
+    assert a.claimTiles([tiles[0]])[0] == {tiles[0]}
+    start = time.monotonic()
+    assert b.waitTiles([tiles[0]]) == {tiles[0]}
+    assert time.monotonic() - start < 1
+
+    #claims of a killed process expire
+    a.CLAIM_TTL = -1
+    assert a.claimTiles([(0, 1, 6)])[0] == {(0, 1, 6)}
+    assert b.claimTiles([(0, 1, 6)])[0] == {(0, 1, 6)}
+
+    #a write blocked by another process is retried
+    monkeypatch.setattr(GeoPackage, "BUSY_TIMEOUT", 0.05)
+    monkeypatch.setattr(GeoPackage, "RETRY_DELAY", 0.1)
+    c = GeoPackage(path, tm)
+    other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.3, other.execute, ("COMMIT",)).start()
+    c.putTiles([(1, 1, 6, b"data")])
+    assert c.hasTile(1, 1, 6)
+
+    c.RETRIES = 0
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError):
+        c.putTiles([(2, 1, 6, b"data")])
+    other.execute("COMMIT")
+    other.close()
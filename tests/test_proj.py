@@ -30,3 +30,272 @@ def test_webmerc_roundtrip():
     lon2, lat2 = webMercToLonLat(x, y)
     assert math.isclose(lon, lon2, abs_tol=1e-6)
     assert math.isclose(lat, lat2, abs_tol=1e-6)
+
+
+@pytest.mark.parametrize("alg", ["NN", "BL", "CB"])
+def test_numpy_warp(alg):
+    import numpy as np
+    from core.proj.reproj import Reproj, reprojPt
+    from core.proj import warp
+
+    # source raster in lon/lat storing the coordinates of each pixel center
+    w, h, res = 400, 300, 0.01
+    lon0, lat0 = 0.0, 50.0
+    gx, gy = np.meshgrid(lon0 + (np.arange(w) + 0.5) * res, lat0 - (np.arange(h) + 0.5) * res)
+    data = np.dstack([gx, gy])
+    geoTrans1 = (lon0, res, 0, lat0, 0, -res)
+
+    xmin, ymax = reprojPt(4326, 3857, 0.5, 49.5)
+    geoTrans2 = (xmin, 300, 0, ymax, 0, -300)
+    out = warp.warp(data, geoTrans1, Reproj(3857, 4326), geoTrans2, (256, 256), alg, fill=-1)
+
+    for i, j in [(0, 0), (100, 37), (255, 200)]:
+        lon, lat = reprojPt(3857, 4326, xmin + (i + 0.5) * 300, ymax - (j + 0.5) * 300)
+        tol = res if alg == "NN" else 1e-4
+        assert math.isclose(out[j, i, 0], lon, abs_tol=tol)
+        assert math.isclose(out[j, i, 1], lat, abs_tol=tol)
+    # outside the source raster
+    xmin, ymax = reprojPt(4326, 3857, 0.5, 46.9)
+    out = warp.warp(data, geoTrans1, Reproj(3857, 4326), (xmin, 300, 0, ymax, 0, -300), (16, 16), alg, fill=-1)
+    assert (out == -1).all()
+
+
+def test_builtin_array_reprojection():
+    import numpy as np
+    from core.proj.reproj import Reproj, lonLatToWebMercArray, webMercToLonLatArray
+    from core.proj.utm import UTM
+    from core.errors import ReprojError
+
+    rng = np.random.default_rng(0)
+    lonlat = np.column_stack((rng.uniform(-180, 180, 500), rng.uniform(-85, 85, 500)))
+    xy = lonLatToWebMercArray(lonlat)
+    assert xy.shape == (500, 2) and xy.dtype == np.float64
+    for (lon, lat), (x, y) in zip(lonlat[:20], xy[:20]):
+        x2, y2 = lonLatToWebMerc(lon, lat)
+        assert math.isclose(x, x2, abs_tol=1e-6) and math.isclose(y, y2, abs_tol=1e-6)
+    assert np.allclose(webMercToLonLatArray(xy), lonlat, atol=1e-9)
+
+    # UTM, projected coordinates computed with PROJ, lon/lat back from the baseline scalar code
+    # (its series loses a few 1e-6 degrees far from the central meridian)
+    refs = [
+        (31, True, 2.35, 48.85, 452314.8912, 5410984.8876, 2.3499999863, 48.8499999991),
+        (31, True, 0.5, 0.5, 221734.2217, 55318.0400, 0.4999959815, 0.5000000296),
+        (31, True, 5.9, 79.5, 558974.6426, 8827246.8628, 5.9000000121, 79.5000000116),
+        (33, False, 14.5, -33.9, 453771.8237, 6248819.2302, 14.4999999850, -33.8999999998),
+        (60, False, 178.1, -41.3, 592091.6886, 5427355.7313, 178.1000001084, -41.2999999970),
+    ]
+    for zone, north, lon, lat, e, n, lon2, lat2 in refs:
+        utm = UTM(zone, north)
+        en = utm.lonlat_to_utm_array(np.array([[lon, lat]]))
+        assert np.allclose(en, [[e, n]], rtol=0, atol=1e-3)
+        assert utm.lonlat_to_utm(lon, lat) == pytest.approx((e, n), abs=1e-3)
+        assert np.allclose(utm.utm_to_lonlat_array(np.array([[e, n]])), [[lon2, lat2]], rtol=0, atol=1e-9)
+    utm = UTM(31, True)
+    lonlat = np.column_stack((rng.uniform(0, 6, 200), rng.uniform(0, 80, 200)))
+    assert np.allclose(utm.utm_to_lonlat_array(utm.lonlat_to_utm_array(lonlat)), lonlat, atol=1e-5)
+
+    rprj = Reproj(4326, 32631)
+    pts = [(2.35, 48.85), (3.0, 45.0)]
+    arr = rprj.ptsArray(pts)
+    assert arr.shape == (2, 2) and arr.dtype == np.float64
+    assert rprj.pts(pts) == [tuple(pt) for pt in arr.tolist()]
+    assert rprj.ptsArray(np.empty((0, 2))).shape == (0, 2)
+    with pytest.raises(ReprojError):
+        rprj.ptsArray([(1, 2, 3)])
+
+
+def test_reproj_registry():
+    import threading
+    from core import settings
+    from core.proj.reproj import ReprojRegistry, reprojRegistry, getReproj, reprojPt
+
+    registry = ReprojRegistry(maxSize=2)
+    rprj = registry.get(4326, 3857)
+    assert registry.get('EPSG:4326', '3857') is rprj
+    assert registry.get('epsg:4326', 3857) is rprj
+    registry.get(4326, 32631)
+    registry.get(3857, 4326)
+    assert len(registry) == 2
+    assert registry.get(4326, 3857) is not rprj  # dropped as least recently used
+
+    # a change of proj engine empties the registry
+    rprj = registry.get(4326, 3857)
+    engine = settings.proj_engine
+    try:
+        settings.proj_engine = 'BUILTIN' if engine != 'BUILTIN' else 'AUTO'
+        assert registry.get(4326, 3857) is not rprj
+        assert len(registry) == 1
+    finally:
+        settings.proj_engine = engine
+
+    # module helpers share the registry objects, concurrent callers get a same object
+    results = []
+    reprojRegistry.clear()
+    threads = [threading.Thread(target=lambda: results.append(getReproj(4326, 32632))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(map(id, results))) == 1
+    x, y = reprojPt(4326, 32632, 9.0, 45.0)
+    assert math.isclose(x, 500000, abs_tol=1e-3)
+
+
+def test_pyproj_transformer():
+    pytest.importorskip("pyproj")
+    import numpy as np
+    from core import settings
+    from core.proj.reproj import Reproj, lonLatToWebMercArray
+    from core.proj.utm import UTM
+
+    engine = settings.proj_engine
+    settings.proj_engine = 'PYPROJ'
+    try:
+        rng = np.random.default_rng(1)
+        lonlat = np.column_stack((rng.uniform(0, 6, 100), rng.uniform(0, 80, 100)))
+        rprj = Reproj(4326, 3857)
+        assert rprj.iproj == 'PYPROJ'
+        transformer = rprj.transformer
+        xy = rprj.ptsArray(lonlat)
+        assert rprj.transformer is transformer
+        assert xy.shape == (100, 2) and xy.dtype == np.float64
+        assert np.allclose(xy, lonLatToWebMercArray(lonlat), atol=1e-3)
+        # longitude stays first for geographic crs on both sides
+        assert np.allclose(Reproj(3857, 4326).ptsArray(xy), lonlat, atol=1e-9)
+        en = Reproj(4326, 32631).ptsArray(lonlat)
+        assert np.allclose(en, UTM(31, True).lonlat_to_utm_array(lonlat), atol=1e-3)
+        assert Reproj(4326, 32631).pts([(3.0, 0.0)]) == [pytest.approx((500000, 0), abs=1e-6)]
+    finally:
+        settings.proj_engine = engine
+
+
+# (epsg, [(lon, lat, x, y)]) reference values computed with PROJ 9.5
+CONFORMAL_REFS = [
+    (2154, [  # LCC 2SP
+        (2.35, 48.85, 652301.5648, 6861302.7259),
+        (-4.5, 48.4, 145709.7889, 6837422.0826),
+        (7.75, 43.7, 1082753.8516, 6300512.2410),
+    ]),
+    (3944, [
+        (1.44, 43.6, 1574055.9897, 3156751.1904),
+        (3.88, 43.61, 1771036.3740, 3157050.0374),
+    ]),
+    (3448, [  # LCC 1SP
+        (-76.8, 18.0, 771180.9924, 650011.4237),
+        (-78.3, 18.4, 612635.0655, 694754.9921),
+    ]),
+    (2263, [  # LCC 2SP in US feet
+        (-73.97, 40.78, 992558.4427, 223453.2998),
+        (-74.2, 40.5, 928627.5187, 121503.6765),
+    ]),
+    (2193, [  # TM
+        (174.76, -36.85, 1756911.9449, 5920321.8182),
+        (168.66, -45.03, 1258120.2390, 5004547.5801),
+        (178.0, -38.0, 2039122.4138, 5782371.7568),
+    ]),
+    (2180, [
+        (21.01, 52.23, 637231.0903, 486786.3937),
+        (14.55, 53.43, 204509.2970, 627553.3126),
+    ]),
+    (25832, [  # UTM on GRS80
+        (9.0, 50.0, 500000.0000, 5538630.7027),
+        (6.1, 54.9, 314057.0395, 6087514.9578),
+        (12.0, 47.5, 725931.3920, 5265092.5490),
+    ]),
+    (28355, [
+        (144.96, -37.81, 320422.8203, 5813305.2226),
+        (147.3, -42.88, 524500.0455, 5252467.2138),
+    ]),
+    (3413, [  # polar stereographic with standard parallel
+        (-45.0, 70.0, 0.0000, -2187927.6493),
+        (10.0, 80.0, 889533.8315, -622858.2943),
+        (150.0, 65.0, -711816.4758, 2656535.2532),
+    ]),
+    (3031, [
+        (0.0, -71.0, 0.0000, 2082760.1085),
+        (166.67, -77.85, 305467.1627, -1289201.5377),
+        (-60.0, -65.0, -2388932.7669, 1379250.9760),
+    ]),
+    (32661, [  # polar stereographic with scale factor
+        (45.0, 88.0, 2157026.6860, 1842973.3140),
+        (-30.0, 85.0, 1722271.3043, 1518959.7883),
+        (120.0, 84.0, 2577403.1288, 2333363.8518),
+    ]),
+    (32761, [
+        (0.0, -85.0, 2000000.0000, 2555457.3914),
+        (100.0, -80.5, 3040992.5786, 1816444.9217),
+    ]),
+]
+
+
+@pytest.mark.parametrize("epsg,refs", CONFORMAL_REFS)
+def test_builtin_conformal_projections(epsg, refs):
+    import numpy as np
+    from core import settings
+    from core.proj.reproj import Reproj
+
+    engine = settings.proj_engine
+    settings.proj_engine = 'BUILTIN'
+    try:
+        lonlat = np.array([ref[:2] for ref in refs])
+        xy = np.array([ref[2:] for ref in refs])
+        assert np.allclose(Reproj(4326, epsg).ptsArray(lonlat), xy, rtol=0, atol=1e-3)
+        assert np.allclose(Reproj(epsg, 4326).ptsArray(xy), lonlat, rtol=0, atol=1e-8)
+    finally:
+        settings.proj_engine = engine
+
+
+def test_builtin_projected_to_projected():
+    from core import settings
+    from core.proj.reproj import Reproj
+    from core.proj.conformal import fromProj4
+    from core.errors import ReprojError
+
+    engine = settings.proj_engine
+    settings.proj_engine = 'BUILTIN'
+    try:
+        # Lambert 93 to ETRS89 UTM 31N, through WGS84 lon/lat
+        x, y = Reproj(2154, 25831).pt(652000.0, 6862000.0)
+        assert x == pytest.approx(452013.6231, abs=1e-3) and y == pytest.approx(5411682.0730, abs=1e-3)
+        # proj4 strings are handled too
+        x, y = Reproj('+proj=lcc +lat_0=46.5 +lon_0=3 +lat_1=49 +lat_2=44 +x_0=700000 +y_0=6600000 +ellps=GRS80 +units=m', 3857).pt(700000, 6600000)
+        assert x == pytest.approx(3 * 20037508.342789244 / 180, abs=1e-3)
+        # datum shifts are not supported
+        with pytest.raises(ValueError):
+            fromProj4('+proj=tmerc +lat_0=0 +lon_0=24 +k=0.9996 +x_0=500000 +ellps=GRS80 +towgs84=-199.87,74.79,246.62')
+        with pytest.raises(ValueError):
+            fromProj4('+proj=utm +zone=30 +a=6378249.145 +rf=293.465 +units=m')
+        with pytest.raises(ReprojError):
+            Reproj(4326, 27700)
+    finally:
+        settings.proj_engine = engine
+
+
+def test_epsg_database(tmp_path):
+    from core.proj.epsgdb import EpsgDB, epsgDB
+    from core.proj.srs import SRS
+
+    crs = epsgDB.get(2154)
+    assert crs['name'] == 'RGF93 v1 / Lambert-93' and crs['kind'] == 'projected' and crs['wgs84']
+    assert not epsgDB.get(27700)['wgs84']
+    assert epsgDB.get(999999) is None
+    assert '+proj=lcc' in epsgDB.getProj4(2154)
+    # search by code, name or alias
+    assert epsgDB.search('EPSG:3857')[0]['code'] == '3857'
+    assert epsgDB.search('2154')[0]['code'] == '2154'
+    assert epsgDB.search('web mercator')[0]['code'] == '3857'
+    assert epsgDB.search('lambert 93')[0]['code'] == '2154'
+    assert epsgDB.search('wgs 84')[0]['code'] == '4326'
+    # srs lookups are done offline
+    assert SRS(2154).loadProj4()['+lat_1'] == 49.0
+    assert 'Lambert_Conformal_Conic' in SRS(2154).getWKT()
+    assert SRS(4258).isGeo and not SRS(2154).isGeo
+    assert SRS(2154).name == 'RGF93 v1 / Lambert-93'
+    # fallback without full text index
+    db = EpsgDB()
+    db.hasFTS = False
+    assert '2154' in [r['code'] for r in db.search('lambert 93')]
+    # missing database
+    db = EpsgDB(str(tmp_path / 'missing.sqlite'))
+    assert not db.available
+    assert db.get(2154) is None and db.search('lambert') == []
@@ -0,0 +1,130 @@
+"""Local http tile server used as a map service stand-in by tests and benchmarks."""
+import re
+import struct
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_png(w, h, color):
+    """Encode a solid color RGBA png without any imaging library"""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+    row = b"\x00" + bytes(color) * w
+    raw = zlib.compress(row * h)
+    ihdr = struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+
+def tile_color(x, y, z):
+    return ((x * 37 + z * 11) % 256, (y * 53 + z * 7) % 256, (x + y) % 256, 255)
+
+
+class TileServer:
+    """
+    Serve /{z}/{x}/{y}.png tiles over HTTP/1.1 with keep-alive
+
+    missing : set of (x, y, z) answered with a 404
+    errors : set of (x, y, z) answered with a 503
+    latency : seconds slept before each answer, to mimic a remote server
+
+    Tiles are served with an ETag and a Last-Modified header, conditional requests
+    matching the current ETag are answered with a 304. Bump `version` to change all ETags.
+    """
+
+    def __init__(self, tile_size=256, missing=(), errors=(), latency=0):
+        self.tile_size = tile_size
+        self.missing = set(missing)
+        self.errors = set(errors)
+        self.latency = latency
+        self.version = 1
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with server.lock:
+                    server.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    @property
+    def template(self):
+        return self.url + "/{Z}/{X}/{Y}.png"
+
+    def tile(self, x, y, z):
+        return make_png(self.tile_size, self.tile_size, tile_color(x, y, z))
+
+    def handle(self, rq):
+        if self.latency:
+            import time
+            time.sleep(self.latency)
+        m = re.match(r"^/(\d+)/(\d+)/(\d+)\.png", rq.path)
+        with self.lock:
+            self.requests.append((rq.path, dict(rq.headers)))
+        if m is None:
+            self.send(rq, 400)
+            return
+        z, x, y = map(int, m.groups())
+        if (x, y, z) in self.missing:
+            self.send(rq, 404)
+            return
+        if (x, y, z) in self.errors:
+            self.send(rq, 503)
+            return
+        etag = '"{}-{}-{}-v{}"'.format(x, y, z, self.version)
+        headers = {"ETag": etag, "Last-Modified": "Mon, 05 Oct 2026 10:00:00 GMT"}
+        if rq.headers.get("If-None-Match") == etag:
+            self.send(rq, 304, headers=headers)
+            return
+        headers["Content-Type"] = "image/png"
+        self.send(rq, 200, self.tile(x, y, z), headers)
+
+    def send(self, rq, status, body=b"", headers=None):
+        rq.send_response(status)
+        for k, v in (headers or {}).items():
+            rq.send_header(k, v)
+        rq.send_header("Content-Length", str(len(body)))
+        rq.end_headers()
+        rq.wfile.write(body)
+
+    def source(self, name="Local stand-in", zmax=22, fmt="png"):
+        """Return a SOURCES entry pointing to this server"""
+        return {
+            "name": name,
+            "description": "local tiles",
+            "service": "TMS",
+            "grid": "WM",
+            "quadTree": False,
+            "layers": {
+                "BASIC": {"urlKey": "", "name": "basic", "description": "", "format": fmt, "zmin": 0, "zmax": zmax}
+            },
+            "urlTemplate": self.template,
+            "referer": "",
+        }
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()